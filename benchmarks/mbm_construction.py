@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+"""Measure the time and memory (peak RSS) taken by `mbm_pipeline` to construct the stages
+of a model-building pipeline for studies of various sizes, e.g.:
+
+    python3 benchmarks/mbm_construction.py 100 300 1000 3000
+
+Each size is measured in a separate process so that the peak RSS figures are independent.
+The input files needn't exist (only their names are used, since the resolution is given
+and the first input is used as the LSQ6 target), and MAGeT is turned off.  Extra arguments
+for the MBM parser (e.g., a different --nlin-protocol) can be given with --mbm-args.
+"""
+
+import argparse
+import os
+import resource
+import shlex
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+from pydpiper.core.arguments import (AnnotatedParser, CompoundParser, application_parser, execution_parser,
+                                     registration_parser, parse)
+from pydpiper.pipelines.MBM import mbm_pipeline, mk_mbm_parser
+
+
+def max_rss_mb():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(n_subjects, extra_args):
+    with tempfile.TemporaryDirectory() as d:
+        # (mbm_pipeline writes some CSVs to the current directory)
+        os.chdir(d)
+        files = [os.path.join(d, "inputs", "subject%d.mnc" % i) for i in range(n_subjects)]
+        p = CompoundParser([application_parser, registration_parser, execution_parser,
+                            AnnotatedParser(parser=mk_mbm_parser(), namespace='mbm')])
+        options = parse(p, ["--pipeline-name=bench", "--output-dir=%s" % d, "--no-execute",
+                            "--resolution=0.2", "--bootstrap", "--no-run-maget", "--maget-no-mask"]
+                           + extra_args + ["--files"] + files)
+        base_rss = max_rss_mb()
+        t0 = time.time()
+        result = mbm_pipeline(options)
+        t1 = time.time()
+        # the deferred stages are flattened (and deduplicated) when first iterated over
+        n_stages = len(result.stages)
+        t2 = time.time()
+        return (n_subjects, n_stages, t1 - t0, t2 - t1, max_rss_mb() - base_rss)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("subjects", type=int, nargs="*", default=[100, 300, 1000, 3000])
+    parser.add_argument("--mbm-args", type=str, default="", help="extra arguments for the MBM parser")
+    args = parser.parse_args()
+    extra_args = shlex.split(args.mbm_args)
+    print("%10s %10s %12s %12s %10s" % ("subjects", "stages", "construct s", "flatten s", "RSS MB"))
+    for n in args.subjects:
+        with Pool(1) as pool:
+            print("%10d %10d %12.2f %12.2f %10.1f" % pool.apply(measure, (n, extra_args)))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
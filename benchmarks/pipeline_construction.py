@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""Measure the time and memory (peak RSS) taken to construct the server's in-memory
+representation of synthetic pipelines of various sizes, e.g.:
+
+    python3 benchmarks/pipeline_construction.py 10000 100000 1000000
+
+Each size is measured in a separate process so that the peak RSS figures are independent.
+With --batch-size, the stages are instead added in batches of that size, as when a pipeline is run
+while it's still being constructed (see `Pipeline.add_streamed_stages`).
+The synthetic pipelines mimic a model-building pipeline: each of a number of subjects goes
+through a chain of per-subject stages in each generation, after which all the subjects' outputs
+are averaged, and the average is used by the next generation's per-subject stages.
+"""
+
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+from pydpiper.core.arguments import CompoundParser, application_parser, execution_parser, parse
+from pydpiper.execution.pipeline import CmdStage, InputFile, OutputFile, Pipeline
+from pydpiper.execution.streaming import StageStream
+
+CHAIN = ["mincblur", "minctracc", "mincresample", "xfminvert"]
+
+
+def synthetic_stages(n_stages, n_subjects=100):
+    stages = []
+    gen = 0
+    avg = "/scratch/bench/avg_-1.mnc"
+    while len(stages) < n_stages:
+        for subj in range(n_subjects):
+            prev = avg
+            for step, prog in enumerate(CHAIN):
+                out = "/scratch/bench/gen%d/subj%d_%s.mnc" % (gen, subj, prog)
+                stages.append(CmdStage([prog, "-clobber", InputFile(prev), OutputFile(out)]))
+                prev = out
+        avg = "/scratch/bench/avg_%d.mnc" % gen
+        stages.append(CmdStage(["mincaverage", "-clobber"]
+                               + [InputFile("/scratch/bench/gen%d/subj%d_%s.mnc" % (gen, subj, CHAIN[-1]))
+                                  for subj in range(n_subjects)]
+                               + [OutputFile(avg)]))
+        gen += 1
+    return stages[:n_stages]
+
+
+def max_rss_mb():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(n_stages, batch_size=None):
+    with tempfile.TemporaryDirectory() as d:
+        options = parse(CompoundParser([application_parser, execution_parser]),
+                        ["--pipeline-name=bench", "--output-dir=%s" % d, "--no-execute"])
+        os.chdir(d)
+        base_rss = max_rss_mb()
+        stages = synthetic_stages(n_stages)
+        stages_rss = max_rss_mb()
+        t0 = time.time()
+        if batch_size is None:
+            p = Pipeline(stages, options)
+        else:
+            stream = StageStream()
+            p = Pipeline([], options, stream=stream)
+            for i in range(0, len(stages), batch_size):
+                stream.put(stages[i:i + batch_size])
+                p.add_streamed_stages()
+            stream.finish()
+            p.add_streamed_stages()
+        t1 = time.time()
+        return (n_stages, p.G.number_of_edges(), t1 - t0, stages_rss - base_rss, max_rss_mb() - base_rss)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("sizes", type=int, nargs="*", default=[10000, 100000, 1000000])
+    parser.add_argument("--batch-size", type=int, default=None)
+    args = parser.parse_args()
+    print("%10s %10s %12s %14s %14s" % ("stages", "edges", "construct s", "stages RSS MB", "total RSS MB"))
+    for n in args.sizes:
+        with Pool(1) as pool:
+            print("%10d %10d %12.2f %14.1f %14.1f" % pool.apply(measure, (n, args.batch_size)))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+"""Compare the time taken to check the outputs of a synthetic pipeline's finished stages on restart
+by stat-ing every file in turn (as skip_completed_stages used to) with using the restart manifest,
+both without (cold) and with (warm) directory mtimes recorded, e.g.:
+
+    python3 benchmarks/restart_validation.py --stages 500000 --dir /path/on/nfs
+
+Each synthetic stage has one input and one output, spread over directories of 100 files,
+as in a registration pipeline's per-subject output directories.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from pydpiper.execution.restart import RestartManifest, output_record
+
+
+def make_files(root, n_files, files_per_dir=100):
+    files = []
+    for i in range(n_files):
+        d = os.path.join(root, "dir%d" % (i // files_per_dir))
+        if i % files_per_dir == 0:
+            os.makedirs(d)
+        f = os.path.join(d, "file%d.mnc" % i)
+        with open(f, 'w') as fh:
+            fh.write("x")
+        files.append(f)
+    return files
+
+
+def sequential_stats(files):
+    return { f : os.stat(f).st_mtime for f in files }
+
+
+def timed(f, *args):
+    t0 = time.time()
+    f(*args)
+    return time.time() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--stages", type=int, default=50000)
+    parser.add_argument("--dir", type=str, default=None,
+                        help="where to create the files (e.g., on the filesystem of interest)")
+    options = parser.parse_args()
+    root = tempfile.mkdtemp(dir=options.dir)
+    try:
+        files = make_files(root, 2 * options.stages)
+        manifest = RestartManifest(os.path.join(root, "manifest.db"))
+        manifest.record({ f : output_record(f) for f in files })
+        # drop the directory mtimes to get a cold run, as after a crash
+        manifest._connection().execute("DELETE FROM dirs")
+        manifest._connection().commit()
+        print("%d stages (%d files):" % (options.stages, len(files)))
+        print("  sequential os.stat:  %8.2fs" % timed(sequential_stats, files))
+        print("  manifest (cold):     %8.2fs" % timed(manifest.current_stats, files))
+        manifest.snapshot_dirs()
+        print("  manifest (parallel): %8.2fs" % timed(manifest.current_stats, files))
+        print("  manifest (trusting directory mtimes): %8.2fs"
+              % timed(lambda fs: manifest.current_stats(fs, trust_dirs=True), files))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
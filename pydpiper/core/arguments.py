@@ -224,6 +224,11 @@ def _mk_application_parser(p: ArgParser) -> ArgParser:
     g.add_argument("--smart-restart", dest="smart_restart",
                    action="store_true", default=False,
                    help="Restart pipeline using backup files accounting for modifications. [default = %(default)s]")
+    g.add_argument("--trust-directory-mtimes", dest="trust_directory_mtimes",
+                   action="store_true", default=False,
+                   help="On a --smart-restart, don't stat finished stages' outputs in directories unchanged "
+                        "since the last run (much faster on network filesystems, but misses files "
+                        "modified in place). [default = %(default)s]")
     g.add_argument("--pipeline-name", dest="pipeline_name", type=str,
                    default=time.strftime("pipeline-%d-%m-%Y-at-%H-%m-%S"),
                    help="Name of pipeline and prefix for models.")
@@ -282,6 +287,22 @@ def _mk_execution_parser(p: ArgParser) -> ArgParser:
     group.add_argument("--use-ns", dest="use_ns",
                        action="store_true",
                        help="Use the Pyro NameServer to store object locations. Currently a Pyro nameserver must be started separately for this to work.")
+    group.add_argument("--server-transport", dest="server_transport",
+                       type=str, default="pyro", choices=["pyro", "asyncio"],
+                       help="How the server communicates with executors: 'pyro' runs a Pyro daemon "
+                            "(with executor management in a separate process polling it), 'asyncio' runs "
+                            "an event-driven server handling executors and executor management in one process. "
+                            "[Default = %(default)s]")
+    group.add_argument("--stream-construction", dest="stream_construction",
+                       action="store_true", default=False,
+                       help="Start running stages while the rest of the pipeline is still being constructed "
+                            "(for pipelines which support this, e.g., MBM, MAGeT and two-level model building); "
+                            "requires --server-transport=asyncio and isn't used when restarting "
+                            "a previous run or with --create-graph. [Default = %(default)s]")
+    group.add_argument("--server-socket", dest="server_socket",
+                       type=str, default=None,
+                       help="With --server-transport=asyncio, listen on this Unix socket instead of a TCP port "
+                            "(only useful if all executors run on the server's machine). [Default = %(default)s]")
     group.add_argument("--latency-tolerance", dest="latency_tolerance",
                        type=float, default=600.0,
                        help="Allowed grace period by which an executor may miss a heartbeat tick before being considered failed [Default = %(default)s.")
@@ -335,6 +356,14 @@ def _mk_execution_parser(p: ArgParser) -> ArgParser:
     group.add_argument("--time-to-accept-jobs", dest="time_to_accept_jobs",
                        type=int,
                        help="The number of minutes after which an executor will not accept new jobs anymore. This can be useful when running executors on a batch system where other (competing) jobs run for a limited amount of time. The executors can behave in a similar way by given them a rough end time. [Default = %(default)s]")
+    group.add_argument("--reattach-time", dest="reattach_time",
+                       type=float, default=0,
+                       help="The number of minutes an executor which loses its server (e.g., because the server "
+                            "ran out of walltime and a new one has been submitted) keeps running its stages while "
+                            "waiting for a new server (found via the uri file) to reattach to, reporting to it any "
+                            "stages which finished in the meantime; a restarted server gives such executors "
+                            "a chance to reattach before running their stages again. 0 to shut down instead, "
+                            "killing any running stages. [Default = %(default)s]")
     group.add_argument('--local', dest="local", action='store_true',
                        help="Don't submit anything to any specified queueing system but instead run as a server/executor")
     group.add_argument("--config-file", type=str, metavar='config_file', is_config_file=True,
@@ -348,11 +377,30 @@ def _mk_execution_parser(p: ArgParser) -> ArgParser:
     group.add_argument("--default-job-mem", dest="default_job_mem",
                        type=float, default=1.75,
                        help="Memory (in GB) to allocate to jobs which don't make a request. [Default=%(default)s]")
+    group.add_argument("--runnable-hook-timeout", dest="runnable_hook_timeout",
+                       type=float, default=60,
+                       help="Time (sec) to wait for a runnable stage's memory estimate (which may require reading "
+                            "its input files) before giving it the --default-job-mem instead. [Default=%(default)s]")
     group.add_argument("--memory-factor", dest="memory_factor",
                        type=float, default=1,
                        help="Overall factor by which to scale all memory estimates/requests (including default job memory, "
                             "but not executor totals (--mem)), say due to system differences or overcommitted nodes. "
                             "[Default=%(default)s]")
+    group.add_argument("--enforce-stage-mem", dest="enforce_stage_mem",
+                       type=str, default="none", choices=["none", "rlimit", "cgroup"],
+                       help="Kill stages using more than --stage-mem-limit-factor times the memory they request: "
+                            "'rlimit' limits the address space of each of a stage's processes; 'cgroup' limits the "
+                            "memory of all of them together (and measures it precisely) using a cgroup (v2) per stage, "
+                            "which requires the executor's cgroup to be delegated to it (and not to contain other "
+                            "processes), otherwise falling back to 'rlimit'. [Default = %(default)s]")
+    group.add_argument("--stage-mem-limit-factor", dest="stage_mem_limit_factor",
+                       type=float, default=1.25,
+                       help="Factor by which a stage may exceed its memory request with --enforce-stage-mem. "
+                            "[Default = %(default)s]")
+    group.add_argument("--pin-stages", dest="pin_stages",
+                       action="store_true", default=False,
+                       help="Pin each stage to its own set of as many CPUs as it uses (from a single NUMA node where "
+                            "possible), so that multi-threaded stages don't compete for processors. [Default = %(default)s]")
     group.add_argument("--cmd-wrapper", dest="cmd_wrapper",
                        type=str, default="",
                        help="Wrapper inside of which to run the command, e.g., '/usr/bin/time -v'. [Default='%(default)s']")
@@ -369,15 +417,67 @@ def _mk_execution_parser(p: ArgParser) -> ArgParser:
                        action="store_false",
                        help="Opposite of --check-outputs.")
     group.set_defaults(check_outputs=False)
+    group.add_argument("--hash-outputs", dest="hash_outputs",
+                       action="store_true", default=False,
+                       help="Record a fast content hash of each stage output in the restart manifest, so that "
+                            "on a --smart-restart outputs whose timestamps have changed but whose contents "
+                            "haven't (e.g., copied files) needn't be regenerated. [Default = %(default)s]")
+    group.add_argument("--result-cache", dest="result_cache",
+                       type=str, default=None,
+                       help="Directory of the outputs of previously run stages, which can be shared between pipelines; "
+                            "a stage whose command and input file contents match a cached one has its outputs "
+                            "restored from the cache (by reflink where supported) instead of being run. "
+                            "[Default = %(default)s, i.e., no caching]")
+    group.add_argument("--result-cache-max-size", dest="result_cache_max_size",
+                       type=float, default=None,
+                       help="Size (in GB) beyond which the least recently used entries are removed from the result cache "
+                            "when a pipeline starts. [Default = %(default)s]")
+    group.add_argument("--result-cache-max-age", dest="result_cache_max_age",
+                       type=float, default=None,
+                       help="Age (in days since last use) beyond which entries are removed from the result cache "
+                            "when a pipeline starts. [Default = %(default)s]")
     group.add_argument("--fs-delay", dest="fs_delay",
                        type=float, default=5,
-                       help="Time (sec) to allow for NFS to become consistent after stage completion [Default=%(default)s]")
+                       help="Maximum time (sec) to wait after a stage completes for its outputs to become visible, "
+                            "e.g., on NFS; the stage is reported as finished as soon as they are. [Default=%(default)s]")
+    group.add_argument("--scratch-dir", dest="scratch_dir",
+                       type=str, default=None,
+                       help="Node-local directory (e.g., /tmp or /dev/shm) in which executors run stages whose outputs "
+                            "all appear in their commands, copying the outputs back to the pipeline directory "
+                            "when the stage finishes and caching them for later stages on the same node "
+                            "(see --scratch-size). [Default = %(default)s, i.e., no staging]")
+    group.add_argument("--scratch-size", dest="scratch_size",
+                       type=float, default=10,
+                       help="Size (in GB) of each executor's cache of the outputs of the stages it has run "
+                            "in the --scratch-dir. [Default = %(default)s]")
     group.add_argument("--executor_wrapper", dest="executor_wrapper",
                        type=str, default="",
                        help="Command inside of which to run the executor. [Default='%(default)s']")
     group.add_argument("--defer-directory-creation", default=False,
                        action="store_true", dest="defer_directory_creation",
                        help="Create relevant directories when a stage is run instead of at startup [Default=%(default)s]")
+    group.add_argument("--learned-memory-estimates", dest="learned_memory_estimates",
+                       action="store_true",
+                       help="Estimate stage memory from the peak memory usage of previous runs of the same program "
+                            "(see --stage-history-file) instead of the built-in per-program formulas, when "
+                            "enough history is available. [Default = %(default)s]")
+    group.add_argument("--no-learned-memory-estimates", dest="learned_memory_estimates",
+                       action="store_false",
+                       help="Opposite of --learned-memory-estimates.")
+    group.set_defaults(learned_memory_estimates=False)
+    group.add_argument("--memory-estimate-margin", dest="memory_estimate_margin",
+                       type=float, default=1.25,
+                       help="Safety factor by which to scale learned memory estimates. [Default = %(default)s]")
+    group.add_argument("--minc-header-cache", dest="minc_header_cache",
+                       type=str, default=None,
+                       help="SQLite database in which to keep the headers (dimensions, step sizes, data type) of "
+                            "MINC files read while constructing and running the pipeline, so that later runs "
+                            "needn't read them again; can be shared between pipelines. [Default = %(default)s]")
+    group.add_argument("--stage-history-file", dest="stage_history_file",
+                       type=str, default=None,
+                       help="SQLite database in which to record the runtime and memory usage of finished stages; "
+                            "can be shared between pipelines. [Default = <pipeline-name>_stage_history.db "
+                            "in the output directory]")
     return p
 
 
@@ -1,4 +1,6 @@
+import itertools
 import os
+import sys
 
 import ordered_set
 import shlex
@@ -23,11 +25,15 @@ class CmdStage(object):
                  log_file : Optional[str] = None,
                  env_vars : Dict[str,str] = None) -> None:
         # TODO: rather than having separate cmd_stage fn, might want to make inputs/outputs optional here
-        self.inputs  = inputs          # type: Tuple[FileAtom, ...]
+        self._inputs  = tuple(inputs)  # type: Tuple[FileAtom, ...]
         # TODO: might be better to dereference inputs -> inputs.path here to save mem
-        self.outputs = outputs         # type: Tuple[FileAtom, ...]
+        self._outputs = tuple(outputs) # type: Tuple[FileAtom, ...]
         #self.conf    = conf           # not needed at present -- see note on render_fn
-        self._cmd    = [str(x) for x in cmd] # type: List[str]
+        # the same paths and flags occur in many stages, so share the strings; this also makes
+        # comparing equal commands cheap, as (interned) equal strings are usually identical
+        self._cmd    = tuple(sys.intern(str(x)) for x in cmd) # type: Tuple[str, ...]
+        # stages are hashed each time they're added to a `Stages`, so compute this just once
+        self._hash   = hash(self._cmd)
         # TODO: why not expose this publicly?
         self.when_runnable_hooks = []  # type: List[Callable[[], Any]]
         # TODO: make the hooks accessible via the constructor?
@@ -47,11 +53,21 @@ class CmdStage(object):
         self.env_vars = env_vars if env_vars is not None else {}
     # NB: __hash__ and __eq__ ignore hooks, memory
     # Also, we assume cmd determines inputs, outputs so ignore it in hash/eq calculations
-    # FIXME: we should make the CmdStage fields immutable (via properties) to prevent hashing-related bugs
+    # (the command, inputs and outputs are immutable (read-only properties) so that the hash stays valid)
     def __hash__(self) -> int:
-        return hash(self.cmd_to_string())
+        return self._hash
     def __eq__(self, c) -> bool:
-        return self._cmd == c._cmd
+        return self is c or (self._hash == c._hash and self._cmd == c._cmd)
+    def __setstate__(self, state : Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        # string hashes differ between processes
+        self._hash = hash(self._cmd)
+    @property
+    def inputs(self) -> Tuple[FileAtom, ...]:
+        return self._inputs
+    @property
+    def outputs(self) -> Tuple[FileAtom, ...]:
+        return self._outputs
     # Originally I had `render_fn` : inputs, outputs, conf -> [str] instead of `cmd` : [str] to
     # (1) reduce duplication by not encoding the inputs/outputs in two places
     # (2) abstract away some of the boring parts, like getting the name fields out of atoms
@@ -66,7 +82,7 @@ class CmdStage(object):
         return ' '.join(str(x) for x in self._cmd)
     def to_array(self) -> List[str]:
         """Form usable for Python subprocess call."""
-        return self._cmd
+        return list(self._cmd)
     def set_log_file(self, log_file_name: str) -> None:
         self.log_file = log_file_name
 
@@ -117,16 +133,101 @@ class Stages(ordered_set.OrderedSet):
     Note: PydPiper 1.x uses a Pipeline where we use a Stages, but 
     we create many intermediate structures for which the extra fields of a pipeline
     don't have any meaning, so this might be worth changing for clarity.
+
+    Since the stages of a pipeline are deferred through many levels of procedures
+    (e.g., minctracc -> ... -> build_model -> mbm), copying and rehashing them at every level
+    would make constructing a deep pipeline quadratic.  Instead, adding stages (in particular,
+    deferring another `Stages`) just records them (or a reference to the other `Stages`),
+    and the set is only flattened and deduplicated when its contents are needed, e.g., when it's
+    iterated over -- usually just once, for the whole pipeline.  (Hence a `Stages` shouldn't be
+    changed once it's been deferred into another one, and `add` and `update` don't return indices.)
+    >>> a, b = parse('mincblur ,in.mnc @blur.mnc'), parse('mincmath ,blur.mnc @out.mnc')
+    >>> s = Stages([a]); t = Stages()
+    >>> t.defer(Result(stages=s, output=None)); t.add(b); t.add(a)
+    >>> [x.render() for x in t]
+    ['mincblur in.mnc blur.mnc', 'mincmath blur.mnc out.mnc']
     """
     def __init__(self, e : Union[Iterable[CmdStage], List[CmdStage]] = ()) -> None:
-        super(self.__class__, self).__init__(iter(e))
+        # stages and other `Stages` added since the set was last flattened
+        self._pending = []  # type: List[Union[CmdStage, Stages]]
+        super().__init__(iter(e))
     def defer(self, result : 'Result[T]') -> T:
         self.update(result.stages)
         return result.output
+    def add(self, stage : CmdStage) -> None:
+        self._pending.append(stage)
+    append = add
+    def update(self, stages : Iterable[CmdStage]) -> None:
+        if isinstance(stages, Stages):
+            # (procedures given an accumulator return it, which their caller then defers into itself)
+            if stages is not self:
+                self._pending.append(stages)
+        else:
+            self._pending.extend(stages)
+    def _flatten(self) -> None:
+        if len(self._pending) == 0:
+            return
+        pending, self._pending = self._pending, []
+        items, index = self._items, self._map
+        # depth-first through the deferred `Stages` (without flattening them), visiting each only once
+        visited = {id(self)}
+        todo = [iter(pending)]
+        while todo:
+            for x in todo[-1]:
+                if isinstance(x, Stages):
+                    if id(x) not in visited:
+                        visited.add(id(x))
+                        todo.append(itertools.chain(x._items, x._pending))
+                        break
+                elif x not in index:
+                    index[x] = len(items)
+                    items.append(x)
+            else:
+                todo.pop()
+    # OrderedSet's methods all go through these, so flatten first
+    @property
+    def items(self) -> List[CmdStage]:
+        self._flatten()
+        return self._items
+    @items.setter
+    def items(self, items : List[CmdStage]) -> None:
+        self._items = items
+    @property
+    def map(self) -> Dict[CmdStage, int]:
+        self._flatten()
+        return self._map
+    @map.setter
+    def map(self, m : Dict[CmdStage, int]) -> None:
+        self._map = m
     # TODO this now remembers the order stages were added (due to use of the strangely-named `OrderedSet` package)
     # but due to randomization in iteration order over various data structures, the pipeline_stages files will
     # still be reordered across runs, which is annoying ... might want to fix the random seed or something ...
 
+class StreamingStages(Stages):
+    """A `Stages` which also passes the stages added to it on to `sink` as they're added
+    (a whole `update` - hence a `defer` - at a time), so that a pipeline constructed
+    into it can start running before construction is complete.  Pipeline procedures which
+    accept a `stages` accumulator (e.g., `mbm`) add to it as they go.
+    >>> batches = []
+    >>> s = StreamingStages(sink=batches.append)
+    >>> c = parse('mincblur ,in.mnc @out.mnc')
+    >>> _ = s.update([c, parse('mincmath ,out.mnc @out2.mnc')])
+    >>> _ = s.add(c)  # already added
+    >>> [[x.render() for x in b] for b in batches]
+    [['mincblur in.mnc out.mnc', 'mincmath out.mnc out2.mnc']]
+    """
+    def __init__(self, sink : Callable[[List[CmdStage]], Any], e : Iterable[CmdStage] = ()) -> None:
+        self.sink = sink
+        super().__init__(e)
+    def add(self, stage : CmdStage) -> None:
+        self.update([stage])
+    append = add
+    def update(self, stages : Iterable[CmdStage]) -> None:
+        n = len(self)
+        super().update(stages)
+        if len(self) > n:
+            self.sink(self.items[n:])
+
 # TODO make it possible to inline many inputs somehow (using cooperation from the string formatter?)
 def parse(cmd_str : str) -> CmdStage:
     """Create a CmdStage object from a string.  (Per Jason's suggestion, we could make
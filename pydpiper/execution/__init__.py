@@ -1,2 +1,2 @@
-__all__ = ["pipeline", "pipeline_executor", "queueing", "file_handling", "application"]
+__all__ = ["pipeline", "pipeline_executor", "queueing", "scheduling", "history", "estimation", "transport", "graph", "restart", "journal", "cache", "streaming", "validation", "readiness", "directories", "limits", "scratch", "file_handling", "application"]
 
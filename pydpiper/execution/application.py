@@ -1,25 +1,26 @@
-import concurrent.futures
-from collections import defaultdict
+import inspect
 import pkg_resources
 import logging
 import networkx as nx
 import pandas as pd
 import os
 import sys
-import shutil
 import time
 
 from typing import NamedTuple, List, Callable, Any
 
-from pydpiper.core.stages import Result
+from pydpiper.core.stages import Result, StreamingStages
 from pydpiper.core.arguments import (CompoundParser, AnnotatedParser, application_parser,
                                      registration_parser, execution_parser, parse)
 from pydpiper.execution.pipeline import Pipeline, pipelineDaemon
 from pydpiper.execution.queueing import runOnQueueingSystem
 from pydpiper.execution.pipeline_executor import ensure_exec_specified
+from pydpiper.execution.streaming import StageStream, construct_in_background
+from pydpiper.execution.validation import record_outputs, validate_stages
+from pydpiper.execution.directories import known_directories
 from pydpiper.core.util import output_directories
 from pydpiper.core.conversion import convertCmdStage
-from pydpiper.minc.registration import can_read_MINC_file
+from pydpiper.minc.files import minc_headers, validate_minc_files
 
 PYDPIPER_VERSION = pkg_resources.get_distribution("pydpiper").version  # pylint: disable=E1101
 
@@ -61,69 +62,6 @@ def file_graph(stages, pipeline_dir):
     # need to use something like nx.to_pydot to convert
 
 
-def ensure_short_output_paths(stages, max_len=255):  # magic no. for EXT3, EXT4, NFS (?), Linux NAME_MAX, etc.
-    # N.B. - at some point we had 245 instead of 255 -- a typo, a program-specific buffer size,
-    # or something to do with one of the file systems (NFS, SciNet's IBM GPFS, etc. ...)?
-    # TODO check the other parts of the path aren't too long either (much less likely)?
-    for s in stages:
-        for o in [o.filename_wo_ext for o in s.outputs] + [os.path.basename(s.log_file)]:
-            if len(o) > max_len:
-                raise ValueError("output filename '%s' of command '%s' too long (more than %s chars)" %
-                                 (o, s.render(), max_len))
-
-
-def ensure_output_paths_in_dir(stages, d):
-    # TODO also check the logfiles ... should these be counted as stage outputs (tedious to add by hand ...)?
-    not_in_dir = []
-    for s in stages:
-        for o in s.outputs:
-            if os.path.relpath(o.path, d).startswith('..'):
-                not_in_dir.append([o.path,s.cmd_to_string()])
-    if (not_in_dir):
-        # import pdb; pdb.set_trace()
-        raise ValueError(["output %s of stage '%s' not contained inside pipeline directory %s"
-                          % (item[0], item[1], d) for item in not_in_dir])
-
-
-# TODO: where should this live - util?
-# TODO: write some tests to check that this might be working
-# TODO: could generalize to '(non)distinctOn' but nobody would ever use ...
-def nondistinct_outputs(stages):
-    """
-    TODO: move this doctest to a proper test in test/
-    >>> c1 = CmdStage(argArray=["touch", OutputFile("/tmp/foo.txt")])
-    >>> c2 = CmdStage(argArray=[">",     OutputFile("/tmp/foo.txt")])
-    >>> nondistinct_outputs([c1, c2]) == { '/tmp/foo.txt' : set([c1,c2]) }
-    True
-    """
-    m = ((o, s) for s in stages for o in s.outputFiles)
-    d = defaultdict(set)
-    for o, s in m:
-        d[o].add(s)
-    bad_outputs = { o : ss for o, ss in d.items() if len(ss) > 1 }
-    return bad_outputs
-
-
-def ensure_distinct_outputs(stages):
-    # TODO logfiles as well? (see comment in `ensure_output_paths_in_dir`)
-    bad_outputs = nondistinct_outputs(stages)
-    if len(bad_outputs) >= 1:
-        print("Uh-oh - some files appear as outputs of multiple stages, to wit:", file=sys.stderr)
-        for o, ss in bad_outputs.items():
-            print("output: %s\nstages:\n" % o, file=sys.stderr)
-            for s in ss:
-                print("%s\n" % s, file=sys.stderr)
-            print("\n", file=sys.stderr)
-        raise ValueError("Conflicting outputs:", bad_outputs)
-
-
-def ensure_commands_exist(stages):
-    cmds = set((s.to_array()[0] for s in stages))
-    bad_cmds = [cmd for cmd in cmds if shutil.which(cmd) is None]
-    if len(bad_cmds) > 0:
-        raise ValueError("Missing executables: %s" % bad_cmds)
-
-
 #TODO: change this to ...(static_pipeline, options)?
 def execute(stages, options):
     """Basically just looks at the arguments and exits if `--no-execute` is specified,
@@ -132,6 +70,8 @@ def execute(stages, options):
     # if options.application.output_directory:
     #     os.chdir(options.application.output_directory)
 
+    use_minc_header_cache(options)
+
     # TODO: logger.info('Constructing pipeline...')
     pipeline = Pipeline(stages=[convertCmdStage(s) for s in stages],
                         options=options)
@@ -144,16 +84,17 @@ def execute(stages, options):
     if options.application.create_graph:
         # TODO: these could have more descriptive names ...
         logger.debug("Writing dot file...")
-        nx.drawing.nx_agraph.write_dot(pipeline.G, str(options.application.pipeline_name) + "_labeled-tree.dot")
+        nx.drawing.nx_agraph.write_dot(pipeline.G.to_networkx(lambda i: { "label" : pipeline.stages[i].name,
+                                                                           "color" : pipeline.stages[i].colour }),
+                                       str(options.application.pipeline_name) + "_labeled-tree.dot")
         nx.drawing.nx_agraph.write_dot(file_graph(stages, options.application.output_directory),
                                        str(options.application.pipeline_name) + "_labeled-tree-alternate.dot")
         logger.debug("Done.")
 
     # for debugging reasons, it's best if these come after writing stages, drawing graph, ...
-    ensure_short_output_paths(stages)  # TODO convert to new `CmdStage`s
-    ensure_output_paths_in_dir(stages, options.application.output_directory)
-    ensure_distinct_outputs([convertCmdStage(s) for s in stages])
-    ensure_commands_exist(stages)
+    validate_stages(pipeline.stages, options.application.output_directory,
+                    duplicate_outputs=[(o, pipeline.stages[i], pipeline.stages[j])
+                                       for o, i, j in pipeline.duplicate_outputs])
 
     if not options.application.execute:
         print("Not executing the command (--no-execute is specified).\nDone.")
@@ -162,21 +103,13 @@ def execute(stages, options):
     def check_inputs():
         # TODO: probably inefficient to reconstruct inputs from graph here instead of once and for all ...
         # TODO: or check inputs to unfinished stages lying outside the unfinished set, instead of the 'overall' inputs!
-        inputs = [ i for s in pipeline.G
+        inputs = { i : None for s in pipeline.G
                    for i in pipeline.stages[s].inputFiles
-                   if pipeline.G.in_degree(s) == 0 ]
-
-        def input_ok(input_file):
-            # TODO: the `.endswith` call here is because in the old code the inputs/outputs are strings, not `Stage`s
-            minc_ok = can_read_MINC_file(input_file) if input_file.endswith(".mnc") else True
-            # TODO: check non-MINC files somehow!  (So far we usually don't encounter this case ...)
-            return minc_ok
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:  # is 8 a good value?
-            bad_inputs = [input_file for input_file, ok in zip(inputs, executor.map(input_ok, inputs)) if not ok]
-            if len(bad_inputs) > 0:
-                # TODO check that this properly quotes input files, e.g. making extra spaces visible ...
-                raise ValueError("bad inputs: %s" % bad_inputs)
+                   if pipeline.G.in_degree(s) == 0 }
+        # TODO: the `.endswith` call here is because in the old code the inputs/outputs are strings, not `Stage`s
+        # TODO: check non-MINC files somehow!  (So far we usually don't encounter this case ...)
+        # (raises a ValueError listing all the bad inputs; the headers read are cached for the memory hooks)
+        validate_minc_files([i for i in inputs if i.endswith(".mnc")])
 
     # TODO lots of optimizations/improvements possible here, e.g., check only 'live' ancestors, not original ones
     if options.execution.check_input_files:
@@ -194,6 +127,93 @@ def execute(stages, options):
     execution_proc(pipeline, options)
 
 
+class IncrementalChecks(object):
+    """The checks `execute` makes of a pipeline's stages, made a batch of stages at a time
+    as they're constructed (see `execute_streaming`)."""
+    def __init__(self, options):
+        self.options = options
+        # each output of the stages so far -> the (converted) stage producing it
+        self.outputs = {}
+        self.checked_inputs = set()
+
+    def check(self, stages):
+        """Check a batch of stages, creating their directories; returns them converted to pipeline stages."""
+        converted = [convertCmdStage(s) for s in stages]
+        # (executables already looked up for earlier batches are remembered by `validation.which`)
+        validate_stages(converted, self.options.application.output_directory,
+                        duplicate_outputs=record_outputs(self.outputs, converted))
+        if self.options.execution.check_input_files:
+            # as in `execute`, the inputs of stages which don't depend on others
+            inputs = { i : None for s in converted
+                       if not any(i in self.outputs for i in s.inputFiles)
+                       for i in s.inputFiles
+                       if i.endswith(".mnc") and i not in self.checked_inputs }
+            validate_minc_files(list(inputs))
+            self.checked_inputs.update(inputs)
+        if not self.options.execution.defer_directory_creation:
+            create_directories(converted)
+        return converted
+
+
+def stream_construction(pipeline, options):
+    """Whether to run `pipeline` while it's being constructed (see `execute_streaming`),
+    i.e., whether --stream-construction is given and possible."""
+    if not options.execution.stream_construction:
+        return False
+    reasons = []
+    if options.execution.server_transport != "asyncio":
+        reasons.append("it requires --server-transport=asyncio")
+    if options.execution.submit_server and not options.execution.local:
+        reasons.append("the server is submitted to the queue")
+    if not options.application.execute:
+        reasons.append("--no-execute is specified")
+    if options.application.create_graph:
+        reasons.append("--create-graph needs the whole pipeline")
+    # (skipping stages finished by a previous run needs the whole pipeline)
+    if options.application.restart and os.path.exists(options.application.pipeline_name + "_finished_stages"):
+        reasons.append("restarting a previous run")
+    if "stages" not in inspect.signature(pipeline).parameters:
+        reasons.append("this pipeline can't be constructed incrementally")
+    if len(reasons) > 0:
+        logger.warning("Constructing the whole pipeline before running it (%s)", "; ".join(reasons))
+        return False
+    return True
+
+
+def execute_streaming(construct, options):
+    """Like `execute`, but runs the pipeline while `construct` (a function taking the `Stages` to which
+    to add the pipeline's stages) is constructing it in another thread, so that the first stages
+    (e.g., the LSQ6 registrations of a big study) can run long before the whole pipeline has been
+    constructed.  The checks `execute` makes are made as each batch of stages is constructed;
+    if one fails, the pipeline is shut down."""
+    use_minc_header_cache(options)
+    reconstruct_command(options)
+    ensure_exec_specified(options.execution.num_exec)
+
+    stream = StageStream()
+    checks = IncrementalChecks(options)
+    stages = StreamingStages(sink=lambda batch: stream.put(checks.check(batch)))
+
+    def construct_all():
+        construct(stages)
+        write_stages(stages, options.application.pipeline_name)
+        logger.info("Constructed %d stages", len(stages))
+
+    pipeline = Pipeline(stages=[], options=options, stream=stream)
+    construct_in_background(construct_all, stream)
+    normal_execute(pipeline, options)
+
+
+def construct_and_execute(pipeline, options):
+    """Construct the pipeline given by `pipeline` (a function of the options returning a `Result`
+    and optionally accepting a `stages` accumulator) and execute it, or do both at once
+    with --stream-construction."""
+    if stream_construction(pipeline, options):
+        execute_streaming(lambda stages: pipeline(options, stages=stages), options)
+    else:
+        execute(pipeline(options).stages, options)
+
+
 def mk_application(parsers: List[AnnotatedParser], pipeline: Callable[[Any], Result[Any]]) -> Callable[[], Any]:
     """Wire up a pure-python pipeline application into a command-line application."""
     # TODO the type isn't very precise ...
@@ -203,23 +223,23 @@ def mk_application(parsers: List[AnnotatedParser], pipeline: Callable[[Any], Res
                         ] + parsers)
     def f():
         options = parse(p, sys.argv[1:])
-        execute(pipeline(options).stages, options)
+        # constructing the pipeline may also read headers (e.g., to determine the resolution)
+        use_minc_header_cache(options)
+        construct_and_execute(pipeline, options)
     return f
 
 
+def use_minc_header_cache(options):
+    if options.execution.minc_header_cache and minc_headers.filename != options.execution.minc_header_cache:
+        minc_headers.persist_to(options.execution.minc_header_cache)
+
+
 def backend(options):
     return grid_only_execute if options.execution.submit_server and not options.execution.local else normal_execute
 
-# TODO: should create_directories be added as a method to Pipeline?
 def create_directories(stages):
-    dirs = output_directories(stages)
-    for d in dirs:
-        # some files that are created by the pipeline end up in the
-        # output directory which can be ''. In that case, one of the
-        # directories returned in dirs is in fact '', but we should
-        # not try to create it...
-        if d != '':
-            os.makedirs(d, exist_ok=True)
+    # (directories already created, e.g., for an earlier batch of stages, are skipped)
+    known_directories.prepare(output_directories(stages))
 
 # The old AbstractApplication class has been removed due to its non-obvious API.  In its place,
 # we currently provide an `execute` function and some helper functions for command-line parsing, as well
@@ -232,7 +252,7 @@ def normal_execute(pipeline, options):
     logger.info("Starting pipeline daemon...")
     # TODO: make a flag to disable this in case already created, wish to create later, etc.
     if not options.execution.defer_directory_creation:
-        create_directories(pipeline.stages) # TODO: or whatever
+        known_directories.prepare(pipeline.output_directories())
     pipelineDaemon(pipeline, options, sys.argv[0])
     logger.info("Server has stopped.  Quitting...")
 
@@ -0,0 +1,271 @@
+import errno
+import fcntl
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# bump this to invalidate existing cache entries if the key or entry format changes
+CACHE_VERSION = 1
+
+# ioctl (Linux) asking the filesystem (btrfs, XFS, ...) to share a file's blocks with another
+FICLONE = 0x40049409
+
+_HASH_BLOCK = 1 << 20
+
+# files which may refer to others not declared as inputs or outputs: a nonlinear transform refers
+# to the displacement grid (e.g., `x_grid_0.mnc`) written next to it, so neither a stage writing one
+# (whose cached outputs would lack the grid) nor one reading one (whose key wouldn't reflect the grid)
+# can be cached
+UNCACHEABLE_SUFFIXES = (".xfm",)
+
+
+def cacheable(input_files: Sequence[str], output_files: Sequence[str]) -> bool:
+    """Whether a stage's inputs and outputs are (as far as we can tell) all the files it uses.
+
+    >>> cacheable(["/a/atlas.mnc"], ["/o/atlas_blur.mnc"]), cacheable(["/a/atlas.mnc"], [])
+    (True, False)
+    >>> cacheable(["/o/img.mnc", "/o/nlin.xfm"], ["/o/img_resampled.mnc"])
+    False
+    """
+    return len(output_files) > 0 and not any(f.endswith(UNCACHEABLE_SUFFIXES)
+                                             for f in itertools.chain(input_files, output_files))
+
+
+def normalize_command(cmd: Sequence[str], input_files: Sequence[str], output_files: Sequence[str]) -> List[str]:
+    """The command with each input and output path replaced by a placeholder for its position,
+    so that the same command run on (copies of) the same inputs in another pipeline
+    (or another output directory) has the same normalized form.
+
+    >>> normalize_command(["mincblur", "-fwhm", "0.5", "/a/atlas.mnc", "/out/atlas_fwhm0.5", "-clobber"],
+    ...                   input_files=["/a/atlas.mnc"], output_files=["/out/atlas_fwhm0.5"])
+    ['mincblur', '-fwhm', '0.5', '{in0}', '{out0}', '-clobber']
+    >>> normalize_command(["xfminvert", "--output=/o/x_inv.xfm", "/i/x.xfm"], ["/i/x.xfm"], ["/o/x_inv.xfm"])
+    ['xfminvert', '--output={out0}', '{in0}']
+    """
+    placeholders = ([(f, "{in%d}" % i) for i, f in enumerate(input_files)]
+                    + [(f, "{out%d}" % i) for i, f in enumerate(output_files)])
+    exact = dict(placeholders)
+    # replace longer paths first in case one is a prefix of another
+    by_length = sorted(placeholders, key=lambda p: -len(p[0]))
+    normalized = []
+    for arg in cmd:
+        if arg in exact:
+            normalized.append(exact[arg])
+        else:
+            for path, placeholder in by_length:
+                if path in arg:
+                    arg = arg.replace(path, placeholder)
+            normalized.append(arg)
+    return normalized
+
+
+# content hashes of the files we've seen in this process, keyed by (path, device, inode, size, mtime),
+# since the same inputs (atlases, models, ...) are used by many stages
+_content_hashes = {}  # type: Dict[Tuple[str, int, int, int, int], str]
+_content_hashes_lock = threading.Lock()
+
+
+def content_hash(path: str) -> str:
+    """A hash of the entire contents of a file (unlike `restart.fast_hash`, since results
+    are reused on the strength of it)."""
+    st = os.stat(path)
+    key = (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    with _content_hashes_lock:
+        if key in _content_hashes:
+            return _content_hashes[key]
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK), b""):
+            h.update(block)
+    digest = h.hexdigest()
+    with _content_hashes_lock:
+        _content_hashes[key] = digest
+    return digest
+
+
+def _reflink(src: str, dst: str) -> None:
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def clone_or_copy(src: str, dst: str) -> None:
+    """Make `dst` an independent file with the contents of `src` as cheaply as possible:
+    a reflink (sharing blocks until either is written) if supported, else a copy.
+    (Not a hard link, since tools rewrite outputs in place, e.g., with -clobber,
+    which would then change the cache entry and every other pipeline's copy of the file.)"""
+    try:
+        _reflink(src, dst)
+        shutil.copystat(src, dst)
+        return
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+    shutil.copy2(src, dst)
+
+
+class ResultCache(object):
+    """A directory of the outputs of previously run stages, shared between pipelines (and runs),
+    keyed by the stage's normalized command (see `normalize_command`), environment and the contents
+    (not the paths) of its inputs, so that a stage identical to one run before -- e.g., blurring
+    the same atlas at the same FWHM in another MAGeT run -- needn't be rerun: its outputs are
+    restored from the cache instead (by reflink where supported, so they take no extra space).
+
+    Each entry is a directory `<key[:2]>/<key>` containing the outputs (named by position)
+    and a `meta.json` recording the command and the size and mtime of each output;
+    an entry whose files have since been changed no longer matches these and is discarded.  Entries are created under `tmp/` and renamed into place,
+    so concurrent executors never see a partial entry.  Only stages whose inputs and outputs
+    are all declared (as InputFile/OutputFile) should be cached, since other files don't affect the key
+    (`key` refuses to cache the stages known not to be, see `cacheable`).
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> with open(os.path.join(d, "in.mnc"), 'w') as f: _ = f.write("voxels")
+    >>> with open(os.path.join(d, "out.mnc"), 'w') as f: _ = f.write("blurred voxels")
+    >>> cache = ResultCache(os.path.join(d, "cache"))
+    >>> key = cache.key(["blur", os.path.join(d, "in.mnc"), os.path.join(d, "out.mnc")],
+    ...                 input_files=[os.path.join(d, "in.mnc")], output_files=[os.path.join(d, "out.mnc")])
+    >>> cache.store(key, [os.path.join(d, "out.mnc")])
+    True
+    >>> cache.materialize(key, [os.path.join(d, "elsewhere", "out.mnc")])
+    True
+    >>> open(os.path.join(d, "elsewhere", "out.mnc")).read()
+    'blurred voxels'
+    """
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def key(self, cmd: Sequence[str], input_files: Sequence[str], output_files: Sequence[str],
+            env_vars: Optional[Dict[str, str]] = None) -> Optional[str]:
+        """The cache key of a stage, or None if it can't be cached (see `cacheable`; also, e.g.,
+        if an input isn't a regular file)."""
+        if not cacheable(input_files, output_files):
+            return None
+        try:
+            input_hashes = [content_hash(f) for f in input_files]
+        except OSError:
+            return None
+        description = json.dumps([CACHE_VERSION, normalize_command(cmd, input_files, output_files),
+                                  input_hashes, sorted((env_vars or {}).items())])
+        return hashlib.blake2b(description.encode(), digest_size=20).hexdigest()
+
+    def entry(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _read_meta(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.entry(key), "meta.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def materialize(self, key: str, output_files: Sequence[str]) -> bool:
+        """Restore the cached outputs of the stage with the given key to `output_files`
+        (replacing any existing files), returning whether there was a (valid) entry to restore."""
+        meta = self._read_meta(key)
+        if meta is None or len(meta["outputs"]) != len(output_files):
+            return False
+        entry = self.entry(key)
+        cached = [os.path.join(entry, str(i)) for i in range(len(output_files))]
+        try:
+            if any(_size_and_mtime(c) != tuple(r) for c, r in zip(cached, meta["outputs"])):
+                raise ValueError("cache entry %s has been modified" % entry)
+            for c, o in zip(cached, output_files):
+                os.makedirs(os.path.dirname(o) or ".", exist_ok=True)
+                # restore under a temporary name so that a failure doesn't leave a partial output
+                tmp = "%s.cache-%s" % (o, uuid.uuid4().hex[:8])
+                clone_or_copy(c, tmp)
+                os.replace(tmp, o)
+                # as if just produced (rather than when the entry was made), so that it's newer than
+                # the stage's inputs and a --smart-restart doesn't take it to be out of date
+                os.utime(o)
+        except (OSError, ValueError):
+            self.remove(key)
+            return False
+        # the mtime of meta.json records when the entry was last used (for eviction)
+        try:
+            os.utime(os.path.join(entry, "meta.json"))
+        except OSError:
+            pass
+        return True
+
+    def store(self, key: str, output_files: Sequence[str], cmd: Optional[Sequence[str]] = None) -> bool:
+        """Add the outputs of a stage which has just run successfully to the cache,
+        returning whether they were added."""
+        if not all(os.path.isfile(o) for o in output_files):
+            return False
+        if os.path.exists(self.entry(key)):
+            return False
+        tmp = os.path.join(self.directory, "tmp", uuid.uuid4().hex)
+        try:
+            os.makedirs(tmp)
+            records = []
+            for i, o in enumerate(output_files):
+                clone_or_copy(o, os.path.join(tmp, str(i)))
+                records.append(_size_and_mtime(os.path.join(tmp, str(i))))
+            with open(os.path.join(tmp, "meta.json"), 'w') as f:
+                json.dump({ "cmd" : list(cmd) if cmd is not None else None, "outputs" : records,
+                            "created" : time.time() }, f)
+            os.makedirs(os.path.dirname(self.entry(key)), exist_ok=True)
+            os.rename(tmp, self.entry(key))
+        except OSError as e:
+            shutil.rmtree(tmp, ignore_errors=True)
+            # another executor may have stored the same results in the meantime
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            return False
+        return True
+
+    def remove(self, key: str) -> None:
+        shutil.rmtree(self.entry(key), ignore_errors=True)
+
+    def entries(self) -> List[Tuple[str, float, int]]:
+        """(key, time of last use, size in bytes) of each entry in the cache."""
+        result = []
+        for prefix in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            if len(prefix) != 2:
+                continue
+            for key in os.listdir(os.path.join(self.directory, prefix)):
+                entry = os.path.join(self.directory, prefix, key)
+                try:
+                    last_used = os.stat(os.path.join(entry, "meta.json")).st_mtime
+                    size = sum(e.stat().st_size for e in os.scandir(entry))
+                except OSError:
+                    continue
+                result.append((key, last_used, size))
+        return result
+
+    def evict(self, max_bytes: Optional[int] = None, max_age: Optional[float] = None) -> int:
+        """Remove entries unused for more than `max_age` seconds and then the least recently
+        used ones until the cache takes at most `max_bytes`; returns the number removed.
+        (Sizes are apparent sizes, so reflinked entries may take less space than counted.)"""
+        entries = sorted(self.entries(), key=lambda e: e[1])
+        now = time.time()
+        total = sum(size for _, _, size in entries)
+        removed = 0
+        for key, last_used, size in entries:
+            if (max_age is not None and now - last_used > max_age) or (max_bytes is not None and total > max_bytes):
+                self.remove(key)
+                total -= size
+                removed += 1
+        # remove leftovers of stores interrupted by a crash
+        tmp = os.path.join(self.directory, "tmp")
+        for name in os.listdir(tmp) if os.path.isdir(tmp) else []:
+            path = os.path.join(tmp, name)
+            try:
+                if now - os.stat(path).st_mtime > 24 * 3600:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+        return removed
+
+
+def _size_and_mtime(path: str) -> Tuple[int, int]:
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
@@ -6,7 +6,7 @@ import signal
 
 signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
-import Pyro4
+from pydpiper.execution.transport import connect
 
 """ check the status of a pydpiper pipeline by querying the server using its uri"""
 
@@ -22,13 +22,13 @@ if __name__ == '__main__':
     # find the server
     try:
         uf = open(uri_file)
-        serverURI = Pyro4.URI(uf.readline())
+        serverURI = uf.readline().strip()
         uf.close()
     except:
         print("There is a problem opening the specified uri file: %s" % uri_file)
         raise
 
-    proxyServer = Pyro4.Proxy(serverURI)
+    proxyServer = connect(serverURI)
 
     # total number of stages in the pipeline:
     numStages = proxyServer.getTotalNumberOfStages()
@@ -62,7 +62,7 @@ if __name__ == '__main__':
 
     # memory requirements for runnable stages:
     memArray = proxyServer.getMemoryRequirementsRunnable()
-    print("\nMemory requirement of runnable stages: %s" % memArray)
+    print("\nMemory requirements of runnable stages (memory: number of stages): %s" % memArray)
     # memory available in registered executors:
     memAvailable = proxyServer.getMemoryAvailableInClients()
     print("Memory available in registered clients: %s \n" %
@@ -0,0 +1,67 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Iterable, List, Set
+
+# each `makedirs` is (at least) a metadata round-trip to the (NFS) server, so create the directories
+# of a big pipeline concurrently, but not so many at once as to swamp the server
+MKDIR_THREADS = 16
+
+
+def unique_directories(paths: Iterable[str]) -> List[str]:
+    """The (sorted) distinct directories containing `paths`, omitting those containing any of the others,
+    since these are created along with them.
+
+    >>> unique_directories(["/o/a/x.mnc", "/o/a/y.mnc", "/o/a/b/z.xfm", "/o/c/w.mnc", "/o/log/x.log", "top.log"])
+    ['/o/a/b', '/o/c', '/o/log']
+    """
+    dirs = {os.path.normpath(d) for d in {os.path.dirname(p) for p in paths} if d != ''}
+    ancestors = set()  # type: Set[str]
+    for d in dirs:
+        d = os.path.dirname(d)
+        while d not in ancestors and d not in ('', os.sep):
+            ancestors.add(d)
+            d = os.path.dirname(d)
+    return sorted(dirs - ancestors)
+
+
+class DirectoryCache(object):
+    """The directories known to exist, so that creating them again needn't go to the filesystem."""
+    def __init__(self) -> None:
+        self.known = set()  # type: Set[str]
+        self.lock = threading.Lock()
+
+    def makedirs(self, d: str) -> None:
+        """`os.makedirs(d, exist_ok=True)`, unless `d` is already known to exist.
+
+        >>> import tempfile
+        >>> c, d = DirectoryCache(), os.path.join(tempfile.mkdtemp(), "a", "b")
+        >>> c.makedirs(d); os.path.isdir(d)
+        True
+        >>> os.rmdir(d); c.makedirs(d); os.path.isdir(d)  # (not recreated)
+        False
+        >>> os.path.dirname(d) in c.known
+        True
+        """
+        d = os.path.normpath(d)
+        if d in self.known:
+            return
+        os.makedirs(d, exist_ok=True)
+        with self.lock:
+            while d not in self.known and d not in ('', os.sep):
+                self.known.add(d)
+                d = os.path.dirname(d)
+
+    def prepare(self, dirs: Iterable[str], threads: int = MKDIR_THREADS) -> None:
+        """Create all of `dirs` not already known to exist, up to `threads` at a time."""
+        dirs = [d for d in unique_directories(os.path.join(d, "") for d in dirs) if d not in self.known]
+        if len(dirs) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=min(threads, len(dirs))) as pool:
+            # (`list` to raise any exception)
+            list(pool.map(self.makedirs, dirs))
+
+
+# the directories this process has created or found to exist (by the stages an executor's worker has run, say)
+known_directories = DirectoryCache()
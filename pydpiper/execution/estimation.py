@@ -0,0 +1,88 @@
+import bisect
+from typing import Dict, List, Optional, Tuple
+
+from pydpiper.execution.history import StageHistory
+from pydpiper.execution.scheduling import program_name
+
+
+class LinearMemModel(object):
+    """An upper envelope for peak memory as a function of input size: a least-squares line
+    through the observed (input voxels, peak RSS) pairs, shifted up by its largest residual
+    so that it bounds every observation.  Larger inputs are assumed never to need less memory:
+    the slope is at least 0 and the estimate at least the largest peak RSS observed for inputs
+    no larger.
+
+    >>> m = LinearMemModel([(100, 3.0), (200, 2.0), (300, 1.0)])
+    >>> m.mem_per_voxel, m.predict(50), m.predict(1000)
+    (0.0, 3.0, 3.0)
+    """
+    def __init__(self, observations: List[Tuple[int, float]]) -> None:
+        n = len(observations)
+        mean_x = sum(x for x, _ in observations) / n
+        mean_y = sum(y for _, y in observations) / n
+        var_x = sum((x - mean_x) ** 2 for x, _ in observations)
+        # if all inputs were the same size, we can only fit a constant
+        self.mem_per_voxel = max(0.0, sum((x - mean_x) * (y - mean_y) for x, y in observations) / var_x
+                                 if var_x > 0 else 0.0)
+        intercept = mean_y - self.mem_per_voxel * mean_x
+        self.base_mem = intercept + max(y - (intercept + self.mem_per_voxel * x) for x, y in observations)
+        # the observed input sizes (ascending) and the largest peak RSS for inputs up to each
+        self._sizes = []  # type: List[int]
+        self._max_mems = []  # type: List[float]
+        for x, y in sorted(observations):
+            self._sizes.append(x)
+            self._max_mems.append(max(y, self._max_mems[-1]) if self._max_mems else y)
+
+    def predict(self, voxels: int) -> float:
+        i = bisect.bisect_right(self._sizes, voxels)
+        return max(self.base_mem + self.mem_per_voxel * voxels, self._max_mems[i - 1] if i > 0 else 0.0)
+
+
+class MemoryEstimator(object):
+    """Estimates the memory a stage needs from the peak RSS of previous runs of the same
+    program recorded in a `StageHistory`, rather than from the fixed per-program configurations
+    (e.g., `default_minctracc_mem_cfg`) used by the memory hooks; when a program has fewer than
+    `min_runs` recorded runs, or the stage's input size is unknown, no estimate is made and the
+    hooks' estimate stands.  Estimates are scaled by a safety margin.
+
+    >>> h = StageHistory(":memory:")
+    >>> for voxels, rss in [(100, 1.0), (200, 2.0), (300, 3.0)]:
+    ...     h.record(program="minctracc", input_voxels=voxels, usage={"peak_rss": rss})
+    >>> e = MemoryEstimator(h, margin=1.5)
+    >>> round(e.estimate("minctracc", 400), 3)
+    6.0
+    >>> e.estimate("minctracc", None) is None, e.estimate("mincblur", 400) is None
+    (True, True)
+    """
+    def __init__(self, history: StageHistory, margin: float = 1.25, min_runs: int = 3) -> None:
+        self.history = history
+        self.margin = margin
+        self.min_runs = min_runs
+        # models are fit once per program per pipeline run (None if too little history):
+        self._models = {}  # type: Dict[str, Optional[LinearMemModel]]
+        # extra factors for programs whose stages failed with learned estimates:
+        self._bumps = {}   # type: Dict[str, float]
+
+    def model(self, program: str) -> Optional[LinearMemModel]:
+        if program not in self._models:
+            observations = [(r["input_voxels"], r["peak_rss"]) for r in self.history.runs(program)
+                            if r["input_voxels"] is not None and r["peak_rss"] is not None]
+            self._models[program] = LinearMemModel(observations) if len(observations) >= self.min_runs else None
+        return self._models[program]
+
+    def estimate(self, program: str, input_voxels: Optional[int]) -> Optional[float]:
+        if input_voxels is None:
+            return None
+        model = self.model(program)
+        if model is None:
+            return None
+        return model.predict(input_voxels) * self.margin * self._bumps.get(program, 1.0)
+
+    def estimate_stage(self, stage) -> Optional[float]:
+        return self.estimate(program_name(stage), stage.input_voxels)
+
+    def bump(self, stage, factor: float) -> None:
+        """A stage whose memory was estimated by us ran out of memory,
+        so scale future estimates for its program by `factor`."""
+        program = program_name(stage)
+        self._bumps[program] = self._bumps.get(program, 1.0) * factor
@@ -0,0 +1,171 @@
+import networkx as nx  # type: ignore
+import numpy as np
+
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set
+
+
+class StageGraph(object):
+    """The dependency graph of a pipeline's stages, whose nodes are the integers
+    0, ..., n - 1 (the stages' indices).  The edges are stored in compressed sparse row form:
+    the successors of node `i` are `_succ[_succ_ptr[i]:_succ_ptr[i+1]]` and similarly
+    for predecessors, so the graph costs a few bytes per edge rather than the several
+    dicts per node (and per edge) of a networkx DiGraph.  Provides the read-only subset of the
+    networkx API we use (`successors`, `predecessors`, `in_degree`, ...);
+    use `to_networkx` to get a networkx graph, e.g., for drawing.
+    New nodes and the edges into them can be added (see `extend`, for stages added while the pipeline
+    is running); these edges are kept in dicts until there are as many as in the arrays, when
+    the arrays are rebuilt, so adding many small batches of stages takes linear time overall.
+
+    >>> G = StageGraph(4, sources=[0, 0, 1, 2, 0], targets=[1, 2, 3, 3, 1])
+    >>> G.order(), G.number_of_edges()
+    (4, 4)
+    >>> G.successors(0), G.predecessors(3), G.in_degree(1)
+    ([1, 2], [1, 2], 1)
+    >>> G.topological_order()
+    [0, 1, 2, 3]
+    >>> sorted(G.descendants(0))
+    [1, 2, 3]
+    >>> G.extend(6, sources=[3, 0, 4, 3], targets=[4, 5, 5, 4]); G.successors(3), G.predecessors(5)
+    ([4], [0, 4])
+    """
+    __slots__ = ("_n", "_succ_ptr", "_succ", "_pred_ptr", "_pred",
+                 "_base_n", "_extra_succ", "_extra_pred", "_extra_edges")
+
+    def __init__(self, n: int, sources: Iterable[int], targets: Iterable[int]) -> None:
+        self._build(n, sources, targets)
+
+    def _build(self, n: int, sources: Iterable[int], targets: Iterable[int]) -> None:
+        self._n = self._base_n = n
+        # edges added (by `extend`) since the arrays were built
+        self._extra_succ = {}  # type: Dict[int, List[int]]
+        self._extra_pred = {}  # type: Dict[int, List[int]]
+        self._extra_edges = 0
+        src = np.asarray(sources, dtype=np.int64)
+        tgt = np.asarray(targets, dtype=np.int64)
+        if len(src) != len(tgt):
+            raise ValueError("sources and targets differ in length")
+        # remove duplicate edges (a stage may use several outputs of another)
+        keys = np.unique(src * n + tgt)
+        src, tgt = keys // n, keys % n
+        self._succ_ptr, self._succ = self._csr(n, src, tgt)
+        self._pred_ptr, self._pred = self._csr(n, tgt, src)
+
+    def extend(self, n: int, sources: Iterable[int], targets: Iterable[int]) -> None:
+        """Add nodes (so that there are `n`) and edges, all of which must lead to the new nodes."""
+        old_n = self._n
+        preds = {}  # type: Dict[int, Set[int]]
+        for i, j in zip(sources, targets):
+            if not old_n <= j < n or not 0 <= i < n:
+                raise ValueError("edge (%d, %d) doesn't lead to a new node" % (i, j))
+            preds.setdefault(j, set()).add(i)
+        self._n = n
+        for j, ps in preds.items():
+            self._extra_pred[j] = sorted(ps)
+            for i in self._extra_pred[j]:
+                self._extra_succ.setdefault(i, []).append(j)
+            self._extra_edges += len(ps)
+        if self._extra_edges > len(self._succ):
+            self._compact()
+
+    def _compact(self) -> None:
+        if self._n == self._base_n and self._extra_edges == 0:
+            return
+        base_sources = np.repeat(np.arange(self._base_n), np.diff(self._succ_ptr))
+        extra_sources = [i for j, ps in self._extra_pred.items() for i in ps]
+        extra_targets = [j for j, ps in self._extra_pred.items() for _ in ps]
+        self._build(self._n, np.concatenate([base_sources, np.asarray(extra_sources, dtype=np.int64)]),
+                    np.concatenate([self._succ.astype(np.int64), np.asarray(extra_targets, dtype=np.int64)]))
+
+    @staticmethod
+    def _csr(n, rows, cols):
+        order = np.argsort(rows, kind="stable")
+        ptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=ptr[1:])
+        # node indices fit in 32 bits for any pipeline we can run
+        return ptr, cols[order].astype(np.int32)
+
+    def order(self) -> int:
+        return self._n
+
+    def __len__(self) -> int:
+        return self._n
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(self._n))
+
+    def __contains__(self, i) -> bool:
+        return isinstance(i, (int, np.integer)) and 0 <= i < self._n
+
+    def nodes(self) -> range:
+        return range(self._n)
+
+    def number_of_edges(self) -> int:
+        return len(self._succ) + self._extra_edges
+
+    def successors(self, i: int) -> List[int]:
+        succ = self._succ[self._succ_ptr[i]:self._succ_ptr[i + 1]].tolist() if i < self._base_n else []
+        return succ + self._extra_succ[i] if i in self._extra_succ else succ
+
+    def predecessors(self, i: int) -> List[int]:
+        if i in self._extra_pred:
+            return list(self._extra_pred[i])
+        return self._pred[self._pred_ptr[i]:self._pred_ptr[i + 1]].tolist() if i < self._base_n else []
+
+    def in_degree(self, i: int) -> int:
+        return len(self.predecessors(i))
+
+    def out_degree(self, i: int) -> int:
+        return len(self.successors(i))
+
+    def in_degrees(self, exclude: Optional[np.ndarray] = None) -> np.ndarray:
+        """The in-degree of every node (as an array), not counting edges from nodes
+        for which the boolean array `exclude` is set."""
+        self._compact()
+        counts = np.diff(self._pred_ptr).astype(np.int32)
+        if exclude is not None and exclude.any():
+            sources = np.repeat(np.arange(self._n), np.diff(self._succ_ptr))
+            counts -= np.bincount(self._succ[exclude[sources]], minlength=self._n).astype(np.int32)
+        return counts
+
+    def in_degrees_of(self, nodes: Iterable[int], exclude: Callable[[int], bool]) -> np.ndarray:
+        """The in-degrees of `nodes` (e.g., just added by `extend`), not counting edges from nodes
+        for which `exclude` is true; unlike `in_degrees`, takes time proportional to their in-degrees."""
+        nodes = list(nodes)
+        return np.fromiter((sum(1 for p in self.predecessors(i) if not exclude(p)) for i in nodes),
+                           dtype=np.int32, count=len(nodes))
+
+    def topological_order(self) -> List[int]:
+        """The nodes in an order in which every node comes after all its predecessors."""
+        remaining = self.in_degrees()
+        order = np.flatnonzero(remaining == 0).tolist()  # type: List[int]
+        ix = 0
+        while ix < len(order):
+            for m in self.successors(order[ix]):
+                remaining[m] -= 1
+                if remaining[m] == 0:
+                    order.append(m)
+            ix += 1
+        if len(order) != self._n:
+            raise ValueError("the stage graph has a cycle")
+        return order
+
+    def descendants(self, i: int) -> Set[int]:
+        seen = set()  # type: Set[int]
+        frontier = [i]
+        while frontier:
+            for m in self.successors(frontier.pop()):
+                if m not in seen:
+                    seen.add(m)
+                    frontier.append(m)
+        return seen
+
+    def to_networkx(self, node_attrs: Optional[Callable[[int], Dict[str, Any]]] = None) -> nx.DiGraph:
+        G = nx.DiGraph()
+        G.add_nodes_from((i, node_attrs(i) if node_attrs else {}) for i in range(self._n))
+        G.add_edges_from((i, j) for i in range(self._n) for j in self.successors(i))
+        return G
+
+
+def topological_order(G) -> List[int]:
+    """A topological order of either a StageGraph or a networkx DiGraph."""
+    return G.topological_order() if isinstance(G, StageGraph) else list(nx.topological_sort(G))
@@ -0,0 +1,88 @@
+import os
+import sqlite3
+import time
+
+from typing import Any, Dict, List, Optional
+
+# columns of the `stage_runs` table, in order
+STAGE_RUN_FIELDS = ["program", "input_voxels", "wall_time", "cpu_time", "peak_rss",
+                    "mem_requested", "procs", "pipeline_name", "recorded_at"]
+
+
+def default_history_file(pipeline_name: str, output_dir: Optional[str] = None) -> str:
+    return os.path.join(output_dir or os.getcwd(), pipeline_name + "_stage_history.db")
+
+
+class StageHistory(object):
+    """A persistent record of the resources used by finished stages, stored in an SQLite database
+    so that it survives (and can be shared between) pipeline runs.  Runs are keyed by
+    program name and the number of input voxels (when known; otherwise NULL), which
+    is what determines the resource usage of most of our programs.
+    Times are in seconds and memory in GB, as elsewhere in the pipeline code.
+
+    >>> h = StageHistory(":memory:")
+    >>> h.record(program="mincblur", input_voxels=1000,
+    ...          usage={"wall_time": 2.0, "cpu_time": 1.5, "peak_rss": 0.25}, mem_requested=1.0)
+    >>> [(r["program"], r["input_voxels"], r["peak_rss"]) for r in h.runs("mincblur")]
+    [('mincblur', 1000, 0.25)]
+    >>> h.summary()["mincblur"]["runs"]
+    1
+    """
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        # connect lazily since the history may be created in one process (e.g., the pipeline
+        # before it's handed to the server process) and used in another, and sqlite
+        # connections can't be shared across a fork:
+        self._conn = None  # type: Optional[sqlite3.Connection]
+        self._pid = None   # type: Optional[int]
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.filename, timeout=30)
+            conn.row_factory = sqlite3.Row
+            # several pipelines may share a history file; WAL allows concurrent readers
+            # and with synchronous=NORMAL a commit doesn't cost an fsync
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS stage_runs "
+                         "(program TEXT NOT NULL, input_voxels INTEGER, wall_time REAL, cpu_time REAL, "
+                         "peak_rss REAL, mem_requested REAL, procs INTEGER, pipeline_name TEXT, recorded_at REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS stage_runs_key ON stage_runs (program, input_voxels)")
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # don't try to pickle the connection (e.g., when the pipeline is sent to another process)
+        return dict(self.__dict__, _conn=None, _pid=None)
+
+    def record(self, *, program: str, input_voxels: Optional[int], usage: Dict[str, float],
+               mem_requested: Optional[float] = None, procs: Optional[int] = None,
+               pipeline_name: Optional[str] = None) -> None:
+        conn = self._connection()
+        conn.execute("INSERT INTO stage_runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     (program, input_voxels, usage.get("wall_time"), usage.get("cpu_time"), usage.get("peak_rss"),
+                      mem_requested, procs, pipeline_name, time.time()))
+        conn.commit()
+
+    def runs(self, program: str, input_voxels: Optional[int] = None) -> List[sqlite3.Row]:
+        """All recorded runs of `program`, optionally restricted to those with the given number of input voxels."""
+        if input_voxels is None:
+            return self._connection().execute("SELECT * FROM stage_runs WHERE program = ?",
+                                              (program,)).fetchall()
+        return self._connection().execute("SELECT * FROM stage_runs WHERE program = ? AND input_voxels = ?",
+                                          (program, input_voxels)).fetchall()
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Per-program totals, e.g., for throughput reports."""
+        rows = self._connection().execute(
+            "SELECT program, COUNT(*), AVG(wall_time), SUM(wall_time), SUM(cpu_time), MAX(peak_rss) "
+            "FROM stage_runs GROUP BY program").fetchall()
+        return { r[0] : { "runs" : r[1], "mean_wall_time" : r[2], "total_wall_time" : r[3],
+                          "total_cpu_time" : r[4], "max_peak_rss" : r[5] }
+                 for r in rows }
+
+    def close(self) -> None:
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
@@ -0,0 +1,210 @@
+import os
+import struct
+import threading
+import time
+import zlib
+
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+# identifies a binary journal (older pipelines wrote `index,hash` text lines, which we can still read)
+MAGIC = b"PYDJRNL1"
+# each record is framed by the length and CRC32 of its payload ...
+_FRAME = struct.Struct("<II")
+# ... which is the stage index followed by the stage's hash (as UTF-8)
+_INDEX = struct.Struct("<Q")
+
+# group commit: write (and fsync) the buffered records once this many have accumulated,
+# or once the oldest has waited this many seconds
+JOURNAL_FLUSH_ENTRIES = 256
+JOURNAL_FLUSH_INTERVAL = 1.0
+# the background thread also compacts the journal once it holds at least this many records
+# and more than twice as many as there are distinct stages (e.g., from stages rerun after being reset)
+JOURNAL_COMPACT_RECORDS = 100000
+
+
+def encode_record(index: int, stage_hash: str) -> bytes:
+    payload = _INDEX.pack(index) + stage_hash.encode("utf-8")
+    return _FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _scan(data: bytes) -> Tuple[list, int]:
+    """Decode the records following the magic number; returns them and the offset just past the
+    last intact record (anything after it is the remains of a write interrupted by a crash)."""
+    records = []
+    offset = len(MAGIC)
+    while offset + _FRAME.size <= len(data):
+        length, crc = _FRAME.unpack_from(data, offset)
+        start, end = offset + _FRAME.size, offset + _FRAME.size + length
+        if end > len(data) or length < _INDEX.size or zlib.crc32(data[start:end]) != crc:
+            break
+        index, = _INDEX.unpack_from(data, start)
+        records.append((index, data[start + _INDEX.size:end].decode("utf-8")))
+        offset = end
+    return records, offset
+
+
+def read_journal(filename: str) -> Iterator[Tuple[int, str]]:
+    """The (index, hash) records of a finished-stages journal (binary or in the old text format),
+    omitting a torn final record.
+
+    >>> import tempfile
+    >>> f = os.path.join(tempfile.mkdtemp(), "finished")
+    >>> with FinishedStagesJournal(f) as j:
+    ...     j.append(3, "abc"); j.append(4, "def")
+    >>> with open(f, 'ab') as fh: _ = fh.write(encode_record(5, "ghi")[:-1])  # a crash mid-write
+    >>> list(read_journal(f))
+    [(3, 'abc'), (4, 'def')]
+    """
+    with open(filename, 'rb') as fh:
+        data = fh.read()
+    if data.startswith(MAGIC):
+        return iter(_scan(data)[0])
+    # old text format; a torn last line has no hash or a partial one, which can't match a stage
+    return ((int(i), h) for i, h in (line.split(",", 1) for line in data.decode("utf-8").split() if "," in line))
+
+
+def _fsync_dir(filename: str) -> None:
+    fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def compact_journal(filename: str, records: Iterable[Tuple[int, str]]) -> None:
+    """Atomically replace the journal by one containing only `records`
+    (e.g., dropping entries for stages which have since changed or no longer exist)."""
+    tmp = filename + ".tmp"
+    with open(tmp, 'wb') as fh:
+        fh.write(MAGIC)
+        fh.write(b"".join(encode_record(i, h) for i, h in records))
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, filename)
+    _fsync_dir(filename)
+
+
+class FinishedStagesJournal(object):
+    """An append-only, checksummed binary record of finished stages, with group commit:
+    records are buffered in memory and written and fsync-ed together once
+    JOURNAL_FLUSH_ENTRIES have accumulated or the oldest is JOURNAL_FLUSH_INTERVAL seconds old
+    (checked by a background thread), so recording a stage costs the server almost nothing.
+    A crash can lose the last second or so of records (those stages are simply rerun
+    on restart) but can't corrupt earlier ones, since a torn record fails its checksum
+    and is dropped (see `read_journal`) and truncated away when the journal is reopened.
+    Once the journal holds at least `compact_records` records, and mostly superseded ones,
+    the background thread also compacts it to the latest record of each stage (by hash)."""
+    def __init__(self, filename: str, flush_entries: int = JOURNAL_FLUSH_ENTRIES,
+                 flush_interval: float = JOURNAL_FLUSH_INTERVAL,
+                 compact_records: int = JOURNAL_COMPACT_RECORDS) -> None:
+        self.filename = filename
+        self.flush_entries = flush_entries
+        self.flush_interval = flush_interval
+        self.compact_records = compact_records
+        # hash -> index of the latest record of each stage in the journal (in order of those records),
+        # and the number of records the journal holds
+        self._latest = {}                # type: Dict[str, int]
+        self._records = 0
+        self._buffer = []                # type: list
+        self._oldest = None              # type: Optional[float]
+        # reentrant, as `flush` may be called from a signal handler which interrupted an `append`
+        self._lock = threading.RLock()
+        self._flushing = False
+        self._pid = None                 # type: Optional[int]
+        self._closed = threading.Event()
+        self._fh = self._open()
+
+    def _open(self):
+        if os.path.exists(self.filename):
+            with open(self.filename, 'rb') as fh:
+                data = fh.read()
+            if not data.startswith(MAGIC):
+                # convert an old text-format file (written by a previous version) in place
+                records = list(read_journal(self.filename))
+                compact_journal(self.filename, records)
+            else:
+                records, end = _scan(data)
+                if end < len(data):
+                    # drop a torn record so that what we append is readable
+                    with open(self.filename, 'r+b') as fh:
+                        fh.truncate(end)
+        else:
+            records = []
+            compact_journal(self.filename, records)
+        for index, stage_hash in records:
+            self._note(index, stage_hash)
+        return open(self.filename, 'ab')
+
+    def _note(self, index: int, stage_hash: str) -> None:
+        self._latest.pop(stage_hash, None)
+        self._latest[stage_hash] = index
+        self._records += 1
+
+    def _compact_if_needed(self) -> None:
+        # (with the lock held)
+        if (self._closed.is_set() or self._records < self.compact_records
+              or self._records <= 2 * len(self._latest)):
+            return
+        self._flush()
+        self._fh.close()
+        compact_journal(self.filename, [(i, h) for h, i in self._latest.items()])
+        self._fh = open(self.filename, 'ab')
+        self._records = len(self._latest)
+
+    def _ensure_flusher(self) -> None:
+        # (re)start the flushing thread in whichever process is using the journal,
+        # since the server runs in a process forked after the journal is opened
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def _flush_periodically(self) -> None:
+        pid = os.getpid()
+        while not self._closed.wait(self.flush_interval / 2) and self._pid == pid:
+            with self._lock:
+                if self._oldest is not None and time.time() - self._oldest >= self.flush_interval:
+                    self._flush()
+                self._compact_if_needed()
+
+    def append(self, index: int, stage_hash: str) -> None:
+        with self._lock:
+            self._ensure_flusher()
+            self._buffer.append(encode_record(index, stage_hash))
+            self._note(index, stage_hash)
+            if self._oldest is None:
+                self._oldest = time.time()
+            if len(self._buffer) >= self.flush_entries:
+                self._flush()
+
+    def _flush(self) -> None:
+        if self._flushing:
+            return
+        self._flushing = True
+        try:
+            if len(self._buffer) > 0:
+                self._fh.write(b"".join(self._buffer))
+                self._fh.flush()
+                os.fsync(self._fh.fileno())
+                self._buffer = []
+            self._oldest = None
+        finally:
+            self._flushing = False
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+            self._fh.close()
+            self._closed.set()
+
+    def __getstate__(self) -> Any:
+        raise TypeError("a journal can't be sent to another process")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
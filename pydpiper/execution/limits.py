@@ -0,0 +1,254 @@
+import bisect
+import glob
+import os
+import resource
+import threading
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# set to the number of processors a stage has been given, since multi-threaded tools
+# (e.g., those based on ITK, like ANTS and antsRegistration) otherwise use all of the node's processors
+THREAD_COUNT_VARIABLES = ("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", "OMP_NUM_THREADS")
+
+# a stage which fails, having been confined by RLIMIT_AS, after its peak RSS reached this fraction
+# of the limit is taken to have run out of memory (its address space -- libraries, stacks, reserved
+# but untouched memory -- being larger than its RSS, an allocation fails before the RSS reaches the limit) ...
+RLIMIT_OOM_FRACTION = 0.8
+# ... as is one whose output ends with one of these (as a large allocation fails before it's touched at all)
+ALLOCATION_FAILURE_MESSAGES = ("std::bad_alloc", "MemoryAllocationError", "MemoryError",
+                               "Cannot allocate memory", "out of memory", "Out of memory")
+# (how much of the end of a stage's output is searched for these)
+ALLOCATION_FAILURE_TAIL = 1 << 16
+
+
+def reports_allocation_failure(log_file: str, offset: int) -> bool:
+    """Whether the output a stage has written to `log_file` (after `offset`) reports
+    a failure to allocate memory.
+
+    >>> import tempfile
+    >>> f = os.path.join(tempfile.mkdtemp(), "stage.log")
+    >>> with open(f, 'w') as fh: _ = fh.write("terminate called after throwing an instance of 'std::bad_alloc'")
+    >>> reports_allocation_failure(f, 0), reports_allocation_failure(f, 60)
+    (True, False)
+    """
+    try:
+        with open(log_file, 'rb') as f:
+            f.seek(max(offset, f.seek(0, os.SEEK_END) - ALLOCATION_FAILURE_TAIL))
+            output = f.read().decode("utf-8", "replace")
+    except OSError:
+        return False
+    return any(m in output for m in ALLOCATION_FAILURE_MESSAGES)
+
+
+def memory_limit(mem: float, factor: float) -> int:
+    """The limit (in bytes) for a stage declaring it needs `mem` GB.
+
+    >>> memory_limit(2, factor=1.25)
+    2684354560
+    """
+    return int(mem * factor * 2**30)
+
+
+def parse_cpulist(cpulist: str) -> List[int]:
+    """
+    >>> parse_cpulist("0-3,8,10-11")
+    [0, 1, 2, 3, 8, 10, 11]
+    """
+    cpus = []  # type: List[int]
+    for r in cpulist.strip().split(","):
+        if r:
+            lo, _, hi = r.partition("-")
+            cpus.extend(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+
+def numa_nodes(cpus: Sequence[int]) -> List[List[int]]:
+    """`cpus` grouped by NUMA node (in a single group if this can't be determined)."""
+    nodes = []
+    for f in sorted(glob.glob("/sys/devices/system/node/node*/cpulist")):
+        try:
+            with open(f) as cpulist:
+                node = sorted(set(parse_cpulist(cpulist.read())) & set(cpus))
+        except (OSError, ValueError):
+            return [sorted(cpus)]
+        if node:
+            nodes.append(node)
+    return nodes if sum(len(n) for n in nodes) == len(cpus) else [sorted(cpus)]
+
+
+def pinnable_cpus(n: int) -> Optional[List[List[int]]]:
+    """`n` of the CPUs we may run on, filling NUMA nodes in turn and grouped by node,
+    or None if there are fewer than `n` (so stages can't be pinned to disjoint sets of them)."""
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < n:
+        return None
+    chosen = []  # type: List[List[int]]
+    for node in numa_nodes(cpus):
+        taken = node[:n - sum(len(c) for c in chosen)]
+        if taken:
+            chosen.append(taken)
+    return chosen
+
+
+class ProcSlots(object):
+    """The executor's processors, `acquire`d by each stage for as many as it declares it uses
+    (or all of them if it declares more), so that the stages together never use more processors
+    than we have, whatever we're sent to run.  The processors are identified by CPU number if `nodes`
+    (lists of `total` CPUs in all, grouped by NUMA node) are given, in which case those of a stage are
+    taken from a single node where possible, so the stage can be pinned to them.
+
+    >>> s = ProcSlots(4)
+    >>> s.acquire(3), s.acquire(8, blocking=False)
+    ((0, 1, 2), False)
+    >>> s.release((0, 1, 2)); s.acquire(8, blocking=False)
+    (0, 1, 2, 3)
+    >>> s = ProcSlots(6, nodes=[[0, 1, 2], [4, 5, 6]])
+    >>> s.acquire(1), s.acquire(3), s.acquire(2)
+    ((0,), (4, 5, 6), (1, 2))
+    """
+    def __init__(self, total: int, nodes: Optional[List[List[int]]] = None) -> None:
+        self.total = total
+        self.free_by_node = [sorted(n) for n in (nodes if nodes is not None else [range(total)])]
+        self.node_of = { cpu : node for node in self.free_by_node for cpu in node }
+        self.cond = threading.Condition()
+
+    @property
+    def free(self) -> int:
+        return sum(len(n) for n in self.free_by_node)
+
+    def _take(self, n: int) -> Tuple[int, ...]:
+        # the node with the fewest free processors which can hold the stage, otherwise the ones with the most
+        fitting = [node for node in self.free_by_node if len(node) >= n]
+        nodes = [min(fitting, key=len)] if fitting else sorted(self.free_by_node, key=len, reverse=True)
+        taken = []  # type: List[int]
+        for node in nodes:
+            k = min(n - len(taken), len(node))
+            taken.extend(node[:k])
+            del node[:k]
+        return tuple(sorted(taken))
+
+    def acquire(self, n: int, blocking: bool = True):
+        """Wait until `n` (capped at the total) processors are free and take them; returns those taken,
+        which must later be released (or False if not `blocking` and they aren't free)."""
+        n = max(1, min(n, self.total))
+        with self.cond:
+            while self.free < n:
+                if not blocking:
+                    return False
+                self.cond.wait()
+            return self._take(n)
+
+    def release(self, procs: Sequence[int]) -> None:
+        with self.cond:
+            for cpu in procs:
+                bisect.insort(self.node_of[cpu], cpu)
+            self.cond.notify_all()
+
+
+def own_cgroup() -> Optional[str]:
+    """The directory of our (cgroup v2) cgroup, or None if there isn't one."""
+    try:
+        with open("/proc/self/cgroup") as f:
+            for line in f:
+                hierarchy, _controllers, path = line.rstrip("\n").split(":", 2)
+                if hierarchy == "0":
+                    return os.path.join(CGROUP_ROOT, path.lstrip("/"))
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _write(path: str, value: str) -> None:
+    with open(path, 'w') as f:
+        f.write(value)
+
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+class StageCgroups(object):
+    """A cgroup (v2) per stage, below `root`, limiting the memory of all of the stage's processes
+    (unlike RLIMIT_AS, which limits the address space, rather than the memory used, of each process)
+    and measuring their peak memory and the number of them OOM-killed."""
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    @classmethod
+    def delegated(cls, name: str) -> 'StageCgroups':
+        """Stage cgroups below our own cgroup, having moved this process into the leaf cgroup `name`
+        (the memory controller can only be enabled for the children of a cgroup without processes).
+        Raises OSError unless our cgroup has been delegated to us (e.g., by `systemd-run --user -p Delegate=yes`)
+        and contains no other processes."""
+        own = own_cgroup()
+        if own is None:
+            raise OSError("no cgroup v2 hierarchy")
+        leaf = os.path.join(own, name)
+        os.makedirs(leaf, exist_ok=True)
+        _write(os.path.join(leaf, "cgroup.procs"), str(os.getpid()))
+        with open(os.path.join(own, "cgroup.subtree_control")) as f:
+            enabled = f.read().split()
+        if "memory" not in enabled:
+            _write(os.path.join(own, "cgroup.subtree_control"), "+memory")
+        return cls(own)
+
+    def create(self, name: str, limit: int) -> str:
+        path = os.path.join(self.root, name)
+        os.mkdir(path)
+        _write(os.path.join(path, "memory.max"), str(limit))
+        return path
+
+    @staticmethod
+    def usage(path: str) -> Dict[str, Any]:
+        """The peak memory (GB; None if not known, e.g., before Linux 5.19) of the processes which have
+        been in the cgroup and the number of them OOM-killed (None if not known)."""
+        peak = _read_int(os.path.join(path, "memory.peak"))
+        oom_kills = None
+        try:
+            with open(os.path.join(path, "memory.events")) as f:
+                for line in f:
+                    key, value = line.split()
+                    if key == "oom_kill":
+                        oom_kills = int(value)
+        except (OSError, ValueError):
+            pass
+        return { "peak_mem" : peak / 2**30 if peak is not None else None, "oom_kills" : oom_kills }
+
+    @staticmethod
+    def remove(path: str) -> None:
+        # fails if any (e.g., backgrounded) processes of the stage are still running
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+
+
+def gated_command(cmd: str) -> str:
+    """A shell command which runs `cmd` only once it has read a line from its standard input (a pipe,
+    closed afterwards, so `cmd` reads nothing from it), exiting with status 125 if there's none
+    (e.g., as the executor couldn't `confine` the shell), so that the executor can confine the shell,
+    and thus everything it runs, before `cmd` starts.  (A `preexec_fn` would do this more directly,
+    but isn't safe in a process with several threads, like an executor.)
+
+    >>> gated_command("mincblur in.mnc out")
+    'read _ || exit 125; mincblur in.mnc out'
+    """
+    return "read _ || exit 125; " + cmd
+
+
+def confine(pid: int, rlimit: Optional[int] = None, cgroup: Optional[str] = None,
+            cpus: Optional[Sequence[int]] = None) -> None:
+    """Set the address-space limit of the process `pid` to `rlimit` bytes, move it into the cgroup `cgroup`
+    and/or pin it to `cpus` (so that the processes it starts later are also confined)."""
+    if cgroup is not None:
+        _write(os.path.join(cgroup, "cgroup.procs"), str(pid))
+    if rlimit is not None:
+        resource.prlimit(pid, resource.RLIMIT_AS, (rlimit, rlimit))
+    if cpus is not None:
+        os.sched_setaffinity(pid, cpus)
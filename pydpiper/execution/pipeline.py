@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 
-import hashlib
+import array
+import asyncio
+import contextlib
+import copy
 import threading
 
-import networkx as nx  # type: ignore
+import numpy as np
 import os
 import sys
 import signal
@@ -19,6 +22,7 @@ from multiprocessing import Process, Event  # type: ignore
 from configargparse import Namespace
 import logging
 import functools
+import itertools
 import math
 from typing import Any
 
@@ -42,11 +46,28 @@ logger.basicConfig(filename="pipeline.log", level=os.getenv("PYDPIPER_LOGLEVEL",
 import Pyro4  # type: ignore
 from . import pipeline_executor as pe
 from pydpiper.execution.queueing import create_uri_filename_from_options
+from pydpiper.execution.scheduling import (BackgroundCalls, RunnableQueue, critical_path_priorities, new_stage_priorities,
+                                           program_name)
+from pydpiper.execution.history import StageHistory, default_history_file
+from pydpiper.execution.estimation import MemoryEstimator
+from pydpiper.execution.transport import AsyncPipelineServer, Notifier
+from pydpiper.execution.graph import StageGraph
+from pydpiper.execution.restart import RestartManifest, command_hash, take_running_stages, write_running_stages
+from pydpiper.execution.journal import FinishedStagesJournal, compact_journal, read_journal
+from pydpiper.execution.cache import ResultCache
+from pydpiper.execution.streaming import ConstructionFailed
+from pydpiper.execution.directories import unique_directories
 
 Pyro4.config.SERVERTYPE = pe.Pyro4.config.SERVERTYPE
 
 LOOP_INTERVAL = 5
 STAGE_RETRY_INTERVAL = 1
+# factor by which to increase the memory request of a stage which ran out of memory
+OOM_RETRY_MEMORY_FACTOR = 2
+# number of threads the server uses to evaluate runnable hooks
+RUNNABLE_HOOK_THREADS = 8
+# the attributes of a stage which runnable hooks set (see `Pipeline.start_runnable_hooks`)
+RUNNABLE_HOOK_FIELDS = ("mem", "procs", "input_voxels")
 
 sys.excepthook = Pyro4.util.excepthook # type: ignore
 
@@ -85,6 +106,10 @@ class ExecClient(object):
         self.maxmemory = maxmemory
         self.running_stages = set([])
         self.timestamp = time.time()
+        # resources the executor had left over after its last check-in (see `Pipeline.executorCheckIn`);
+        # while these are nonzero it's waiting for work, which we push a notification about when some appears
+        self.free_mem = 0
+        self.free_procs = 0
 
 def memoize_hook(hook):  # TODO replace with functools.lru_cache (?!) in python3
     data = Namespace(called=False, result=None)  # because of Python's bizarre assignment rules
@@ -98,6 +123,11 @@ def memoize_hook(hook):  # TODO replace with functools.lru_cache (?!) in python3
     return g
 
 class PipelineStage(object):
+    # pipelines can have millions of stages, so don't give each one a `__dict__`
+    __slots__ = ("mem", "procs", "inputFiles", "outputFiles", "logFile", "status", "name",
+                 "number_retries", "input_voxels", "_runnable_hooks", "finished_hooks")
+    colour = "black" # used when a graph is created of all stages to colour the nodes
+
     def __init__(self):
         self.mem = None # if not set, use pipeline default
         self.procs = 1 # default number of processors per stage
@@ -108,8 +138,10 @@ class PipelineStage(object):
         self.logFile = None
         self.status = None
         self.name = ""
-        self.colour = "black" # used when a graph is created of all stages to colour the nodes
         self.number_retries = 0
+        # size of the stage's (main) input, if known (set by memory estimation hooks);
+        # used to key the resource usage history
+        self.input_voxels = None
         # functions to be called when the stage becomes runnable
         # (these might be called multiple times, so should be benign
         # in some sense)
@@ -120,6 +152,10 @@ class PipelineStage(object):
     def add_runnable_hook(self, h, memoize=True):
         self._runnable_hooks.append((memoize_hook if memoize else lambda x: x)(h))
 
+    def run_runnable_hooks(self):
+        for f in self._runnable_hooks:
+            f(self)
+
     def isFinished(self):
         return self.status == "finished"
     def setRunning(self):
@@ -138,6 +174,8 @@ class PipelineStage(object):
         self.procs = num
     def getProcs(self):
         return self.procs
+    def setInputVoxels(self, voxels):
+        self.input_voxels = int(voxels)
     def getHash(self):
         return(hash("".join(self.outputFiles) + "".join(self.inputFiles)))
     def __eq__(self, other):
@@ -150,11 +188,13 @@ class PipelineStage(object):
         self.number_retries += 1
 
 class CmdStage(PipelineStage):
+    __slots__ = ("cmd", "env_vars")
     pipeline_start_time = datetime.isoformat(datetime.now())
     logfile_id = 0
     def __init__(self, argArray):
         PipelineStage.__init__(self)
         self.cmd = [] # the input array converted to strings
+        self.env_vars = {}
         self.parseArgs(argArray)
         #self.checkLogFile()
     def parseArgs(self, argArray):
@@ -189,7 +229,7 @@ class CmdStage(PipelineStage):
         """Return a small value which can be used to compare objects.
         Use a deterministic hash to allow persistence across restarts (calls to `hash` and `__hash__`
         depend on the value of PYTHONHASHSEED as of Python 3.3)"""
-        return hashlib.md5("".join(self.cmd).encode()).hexdigest()
+        return command_hash(self.cmd)
 
     def __repr__(self):
         return(" ".join(self.cmd))
@@ -198,20 +238,12 @@ class CmdStage(PipelineStage):
     def __hash__(self):
         return tuple(self.cmd).__hash__()
 
-"""A graph with no edge information; see networkx/classes/digraph.py"""
-class ThinGraph(nx.DiGraph):
-    all_edge_dict = {'weight': 1}
-    def single_edge_dict(self):
-        return self.all_edge_dict
-    edge_attr_dict_factory = single_edge_dict
-
-
 class Pipeline(object):
     # TODO the way we initialize a pipeline is currently a bit gross, e.g.,
     # setting a bunch of instance variables after __init__ - the presence of a method
     # called `initialize` should be a hint that all is perhaps not well, but perhaps
     # there is indeed some information legitimately unavailable when we first construct
-    def __init__(self, stages, options):
+    def __init__(self, stages, options, stream=None):
         # the core pipeline is stored in a directed graph. The graph is made
         # up of integer indices
         # main set of options, needed since (a) we don't bother unpacking
@@ -220,17 +252,18 @@ class Pipeline(object):
         self.pipeline_name = options.application.pipeline_name
         self.options = options
         self.exec_options = options.execution
-        self.G = ThinGraph()
-        # a map from indices to the number of unfulfilled prerequisites
+        # (a StageGraph, built once all stages have been added)
+        self.G = None
+        # an array from indices to the number of unfulfilled prerequisites
         # of the corresponding graph node (will be populated later -- __init__ is a misnomer)
-        self.unfinished_pred_counts = []
+        self.unfinished_pred_counts = np.zeros(0, dtype=np.int32)
         # an array of the actual stages (PipelineStage objects)
         self.stages = []
-        self.nameArray = []
-        # indices of the stages ready to be run
-        self.runnable = set()
-        # an array to keep track of stage memory requirements
-        self.mem_req_for_runnable = []
+        # indices of the stages ready to be run, indexed by their memory/processor requirements
+        self.runnable = RunnableQueue()
+        # a map from indices to the priority with which the corresponding stage is dispatched
+        # (will be populated once the graph is constructed)
+        self.priorities = []
         # a hideous hack; the idea is that after constructing the underlying graph,
         # a pipeline running executors locally will measure its own maxRSS (once)
         # and subtract this from the amount of memory claimed available for use on the node.
@@ -238,16 +271,38 @@ class Pipeline(object):
         self.currently_running_stages = set()
         # the current stage counter
         self.counter = 0
-        # hash to keep the output to stage association
+        # hash to keep the output to stage association (only needed to create the edges)
         self.outputhash = {}
+        # (output, index of an earlier stage producing it, index of a later one), for `validation.find_problems`
+        self.duplicate_outputs = []
         # a hash per stage - computed from inputs and outputs or whole command
+        # (only needed to remove duplicates while adding stages)
         self.stage_dict = {}
         self.num_finished_stages = 0
         self.failedStages = []
         # location of backup files for restart if needed
         self.backupFileLocation = self._backup_file_location()
+        # stats of the outputs of finished stages, used to validate them quickly on a smart restart
+        self.restart_manifest = RestartManifest(self.backupFileLocation + "_manifest.db")
+        # hashes of the stages running when the previous server shut down (see `recordRunningStages`)
+        self.running_stages_file = os.path.join(os.path.dirname(self.backupFileLocation),
+                                                self.pipeline_name + "_running_stages")
+        # with --reattach-time, indices of stages which were running when the previous server shut down,
+        # held back (rather than enqueued) to give the executors running them time to reattach
+        # (see `reattachClient`), and when those executors give up waiting for a new server
+        self.orphaned = set()
+        self.orphans_given_up_at = None
+        self.orphan_deadline = None
+        # stage hash -> index, built when first needed by `reattachClient`
+        self.index_by_hash = None
         # table of registered clients (using ExecClient class instances) indexed by URI
         self.clients = {}
+        # used to wake up executors waiting for work when stages become runnable
+        # (otherwise they would only ask again after pe.EXECUTOR_MAIN_LOOP_INTERVAL)
+        self.notifier = Notifier("wakeUp")
+        # a context manager around slow calls not involving the pipeline's state (e.g., submitting executors),
+        # during which an AsyncPipelineServer may handle requests (see `transport.AsyncPipelineServer`)
+        self.blocking = contextlib.nullcontext
         # number of clients (executors) that have been launched by the server
         # we need to keep track of this because even though no (or few) clients
         # are actually registered, a whole bunch of them could be waiting in the
@@ -265,11 +320,32 @@ class Pipeline(object):
         # report back to the user which percentage of the pipeline stages has finished
         # keep track of the last percentage that was printed
         self.percent_finished_reported = 0
-        # Handle to write out processed stages to
-        self.finished_stages_fh = None
+        # journal to record processed stages in (a FinishedStagesJournal)
+        self.finished_stages_journal = None
         
         self.outputDir = self.options.application.output_directory or os.getcwd()
 
+        # record of the resources used by finished stages (persisted across runs):
+        self.history = (StageHistory(self.exec_options.stage_history_file
+                                     or default_history_file(self.pipeline_name, self.outputDir))
+                        if self.exec_options is not None else None)
+        # optionally, replace the memory hooks' estimates by ones learned from this history:
+        self.memory_estimator = (MemoryEstimator(self.history, margin=self.exec_options.memory_estimate_margin)
+                                 if self.exec_options is not None and self.exec_options.learned_memory_estimates
+                                 else None)
+        # indices of stages whose memory requirement is a learned estimate
+        self.learned_mem_stages = set()
+        # once the server is running, stages' runnable hooks (which may read files on slow
+        # shared filesystems) are evaluated in the background rather than when the stages
+        # are enqueued; see `enable_background_hooks`
+        self.background_hooks = False
+        self.hook_calls = BackgroundCalls(RUNNABLE_HOOK_THREADS)
+        self.hook_timeout = self.exec_options.runnable_hook_timeout
+        # stages whose hooks are being evaluated: index -> (time started, whether started early)
+        self.running_hooks = {}
+        # runnable stages waiting for their hooks to be evaluated before being enqueued
+        self.waiting_for_hooks = set()
+
         # TODO this doesn't work with the qbatch-based server submission on Graham:
         if self.options.execution.submit_server and self.options.execution.local:
             # redirect the standard output to a text file
@@ -277,22 +353,23 @@ class Pipeline(object):
             LINE_BUFFERING = 1
             sys.stdout = open(serverLogFile, 'a', LINE_BUFFERING)
 
-        for s in stages:
-            self._add_stage(s)
-
-        self.createEdges()
-        # could also set this on G itself ...
-        # TODO the name "unfinished" here is probably misleading since nothing is marked "finished";
-        # even though the "graph heads" are enqueued here, this will be changed later when completed stages
-        # are skipped :D
-        self.unfinished_pred_counts = [ len([i for i in self.G.predecessors(n)
-                                             if not self.stages[i].isFinished()])
-                                        for n in range(self.G.order()) ]
-        graph_heads = [n for n in self.G.nodes()
-                       if self.unfinished_pred_counts[n] == 0]
-        logger.info("Graph heads: " + str(graph_heads))
-        for n in graph_heads:
-            self.enqueue(n)
+        # when the pipeline is run while it's still being constructed, the StageStream on which
+        # its stages arrive (see `add_streamed_stages`); None once all stages have been added
+        self.stream = stream
+        # the edges of the stage graph, from which it's built
+        self.edge_sources, self.edge_targets = array.array('l'), array.array('l')
+        # inputs of the stages added so far which aren't outputs of any stage -> a stage using them
+        # (only kept while stages are still being added, to detect a stage added after one using its outputs)
+        self.external_inputs = {}
+        # which stages have had their runnable hooks evaluated
+        self.prepared = np.zeros(0, dtype=bool)
+        # (set by `enable_background_hooks`)
+        self.dispatched = None
+        self.undispatched_pred_counts = None
+
+        self.addStages(stages)
+        if self.stream is None:
+            self.finish_construction()
        
     # expose methods to get/set shutdown_ev via Pyro (setter not needed):
     def set_shutdown_ev(self):
@@ -329,7 +406,7 @@ class Pipeline(object):
         return len(self.runnable)
 
     def getMemoryRequirementsRunnable(self):
-        return self.mem_req_for_runnable
+        return self.runnable.memory_requirements()
 
     def getMemoryAvailableInClients(self):
         return [c.maxmemory for _, c in self.clients.items()]
@@ -355,18 +432,23 @@ class Pipeline(object):
             self.stage_dict[h] = self.counter
             #self.statusArray[self.counter] = 'notstarted'
             self.stages.append(stage)
-            self.nameArray.append(stage.name)
             # add all outputs to the output dictionary
             for o in stage.outputFiles:
+                if o in self.outputhash:
+                    self.duplicate_outputs.append((o, self.outputhash[o], self.counter))
                 self.outputhash[o] = self.counter
-            # add the stage's index to the graph
-            self.G.add_node(self.counter, label=stage.name, color=stage.colour)
             self.counter += 1
         # huge hack since default isn't available in CmdStage() constructor
         # (may get overridden later by a hook, hence may really be wrong ... ugh):
         if stage.mem is None and self.exec_options is not None:
             stage.setMem(self.exec_options.default_job_mem)
 
+    def output_directories(self):
+        """The directories to create before running the stages (see `directories.unique_directories`)."""
+        # (not from the output hash, which is emptied once construction has finished)
+        return unique_directories(itertools.chain((f for s in self.stages for f in s.outputFiles),
+                                                  (s.logFile for s in self.stages if s.logFile)))
+
     def _backup_file_location(self, outputDir=None):
         loc = os.path.join(outputDir or os.getcwd(),
                            self.pipeline_name + '_finished_stages')
@@ -378,23 +460,122 @@ class Pipeline(object):
     def printNumberProcessedStages(self):
         print("Number of stages already processed:     ", self.num_finished_stages)
                   
-    def createEdges(self):
-        """computes stage dependencies by examining their inputs/outputs"""
+    def createEdges(self, first=0):
+        """computes the dependencies of the stages from index `first` on by examining their inputs/outputs
+        and builds (or extends) the graph"""
         starttime = time.time()
-        # iterate over all nodes
-        for i in self.G.nodes():
+        n_edges = len(self.edge_sources)
+        # iterate over the new nodes
+        for i in range(first, len(self.stages)):
             for ip in self.stages[i].inputFiles:
                 # if the input to the current stage was the output of another
-                # stage, add a directional dependence to the DiGraph
+                # stage, add a directional dependence to the graph
                 if ip in self.outputhash:
-                    self.G.add_edge(self.outputhash[ip], i)
+                    self.edge_sources.append(self.outputhash[ip])
+                    self.edge_targets.append(i)
+                elif self.stream is not None:
+                    self.external_inputs[ip] = i
+        if self.G is None or first == 0:
+            self.G = StageGraph(len(self.stages), self.edge_sources, self.edge_targets)
+        else:
+            self.G.extend(len(self.stages), self.edge_sources[n_edges:], self.edge_targets[n_edges:])
         endtime = time.time()
         logger.info("Create Edges time: " + str(endtime-starttime))
 
+    def addStages(self, stages):
+        """Add stages (all at once or, when streaming, as they're constructed) to the pipeline,
+        enqueueing those which are runnable.  Returns the number of (new) stages added."""
+        # a stage can't depend on one added later, since the former may already have run:
+        misordered = [(o, self.external_inputs[o]) for s in stages for o in s.outputFiles if o in self.external_inputs]
+        if len(misordered) > 0:
+            o, i = misordered[0]
+            raise ValueError("%s, an input of stage %d (%s), is the output of a stage constructed after it; "
+                             "can't construct this pipeline while running it" % (o, i, self.stages[i]))
+        first = len(self.stages)
+        for s in stages:
+            self._add_stage(s)
+        n_new = len(self.stages) - first
+        if n_new == 0 and self.G is not None:
+            return 0
+        self.createEdges(first)
+        new = np.arange(first, len(self.stages))
+        self.prepared = np.concatenate([self.prepared, np.zeros(n_new, dtype=bool)])
+        # (stages already enqueued keep the priority they had then)
+        if self.stream is None:
+            self.priorities = np.asarray(critical_path_priorities(self.G, self.stages), dtype=np.float64)
+        else:
+            # while stages are still being added, only compute the priorities of the new ones (from the stages
+            # added so far), since recomputing all of them for each batch would take quadratic time;
+            # all of them are recomputed once construction has finished (see `finish_construction`)
+            self.priorities = np.concatenate([self.priorities,
+                                              new_stage_priorities(self.G, self.stages, range(first, len(self.stages)))])
+        # could also set this on G itself ...
+        # TODO the name "unfinished" here is probably misleading since nothing is marked "finished";
+        # even though the "graph heads" are enqueued here, this will be changed later when completed stages
+        # are skipped :D
+        self.unfinished_pred_counts = np.concatenate([self.unfinished_pred_counts,
+                                                      self._pred_counts(first, lambda i: self.stages[i].isFinished())])
+        if self.dispatched is not None:
+            self.dispatched = np.concatenate([self.dispatched, np.zeros(n_new, dtype=bool)])
+            self.undispatched_pred_counts = np.concatenate([self.undispatched_pred_counts,
+                                                            self._pred_counts(first, lambda i: self.dispatched[i])])
+        # new stages depending on failed ones will never run
+        failed = set(self.failedStages)
+        for i in new.tolist():
+            if i not in failed and any(p in failed for p in self.G.predecessors(i)):
+                failed.add(i)
+                self.failedStages.append(i)
+                descendants = self.G.descendants(i) - failed
+                failed.update(descendants)
+                self.failedStages.extend(descendants)
+        graph_heads = [i for i in new[self.unfinished_pred_counts[first:] == 0].tolist() if i not in failed]
+        logger.info("Graph heads: " + str(graph_heads))
+        for n in graph_heads:
+            self.enqueue(n)
+        if self.dispatched is not None:
+            for i in new[self.undispatched_pred_counts[first:] == 0].tolist():
+                if i not in failed:
+                    self.start_runnable_hooks(i, early=True)
+        return n_new
+
+    def _pred_counts(self, first, done):
+        """The number of predecessors of each stage from index `first` on for which `done` (of an index) is false."""
+        if first == 0:
+            return self.G.in_degrees(exclude=np.fromiter((done(i) for i in range(len(self.stages))),
+                                                         dtype=bool, count=len(self.stages)))
+        # (looking only at the new stages' predecessors, rather than at all stages, for each batch)
+        return self.G.in_degrees_of(range(first, len(self.stages)), done)
+
+    def add_streamed_stages(self):
+        """Add the stages constructed since we last checked (see `streaming.StageStream`), noting when
+        construction has finished.  Returns the number of stages added; raises ConstructionFailed
+        if the pipeline can't be constructed."""
+        stages, finished = self.stream.take()
+        try:
+            added = self.addStages(stages) if len(stages) > 0 else 0
+        except ValueError as e:
+            raise ConstructionFailed(str(e)) from e
+        if added > 0:
+            logger.info("Added %d stages (%d in total so far)", added, len(self.stages))
+        if finished:
+            self.finish_construction()
+            logger.info("Pipeline construction finished: %d stages", len(self.stages))
+        return added
+
+    def finish_construction(self):
+        if self.stream is not None:
+            # (see `addStages`)
+            self.priorities = np.asarray(critical_path_priorities(self.G, self.stages), dtype=np.float64)
+        self.stream = None
+        # only needed while adding stages (to remove duplicates and create edges)
+        self.stage_dict = {}
+        self.outputhash = {}
+        self.external_inputs = {}
+
     def get_stage_info(self, i):
         s = self.stages[i]
         return pe.StageInfo(mem=s.mem, procs=s.procs, ix=i, cmd=s.cmd, log_file=s.logFile,
-                            output_files=s.outputFiles, env_vars=s.env_vars)
+                            input_files=s.inputFiles, output_files=s.outputFiles, env_vars=s.env_vars)
 
     def getStage(self, i):
         """given an index, return the actual pipelineStage object"""
@@ -415,41 +596,187 @@ class Pipeline(object):
         # normally over the next few seconds will crash (note they have no jobs, 
         # so this is sort of OK)
 
-    """Given client information, issue commands to the client (along similar
+    """Given client information, issue a batch of commands to the client (along similar
     lines to getRunnableStageIndex) and update server's internal view of client.
-    This is highly stateful, being a resource-tracking wrapper around
-    getRunnableStageIndex and hence a glorified Set.pop."""
-    def getCommand(self, clientURIstr, clientMemFree, clientProcsFree):
+    Rather than popping a single arbitrary stage (and re-enqueueing it if it doesn't fit),
+    we pack as many runnable stages as fit into the client's free memory and processors,
+    so that a large executor fills up in one round-trip.
+    Returns a tuple of a flag ("run_stages", "wait", "shutdown_normally" or "shutdown_abnormally")
+    and a (possibly empty) list of stage indices to run."""
+    def getCommands(self, clientURIstr, clientMemFree, clientProcsFree):
         if self.is_time_to_drain():
-            return ("shutdown_abnormally", None)
+            return ("shutdown_abnormally", [])
 
-        # TODO now that getRunnableStageIndex pops from a set,
-        # intelligently look for something this client can run
-        # (e.g., by passing available resources
-        # into getRunnableStageIndex)?
-        if clientMemFree == 0:
+        if self.allStagesCompleted():
+            return ("shutdown_normally", [])
+
+        if clientMemFree <= 0:
             logger.debug("Executor has no free memory")
-            return ("wait", None)
-        if clientProcsFree == 0:
+            return ("wait", [])
+        if clientProcsFree <= 0:
             logger.debug("Executor has no free processors")
-            return ("wait", None)
-
-        flag, i = self.getRunnableStageIndex()
-        if flag == "run_stage":
-            eps = 0.000001
-            memOK   = self.getStageMem(i) <= clientMemFree + eps
-            procsOK = self.getStageProcs(i) <= clientProcsFree
-            if memOK and procsOK:
-                return (flag, i)
-            else:
-                if not memOK:
-                    logger.debug("The executor does not have enough free memory (free: %.2fG, required: %.2fG) to run stage %d. (Executor: %s)", clientMemFree, self.getStageMem(i), i, clientURIstr)
-                if not procsOK:
-                    logger.debug("The executor does not have enough free processors (free: %.1f, required: %.1f) to run stage %d. (Executor: %s)", clientProcsFree, self.getStageProcs(i), i, clientURIstr)
-                self.enqueue(i)
-                return ("wait", None)
+            return ("wait", [])
+
+        indices = self.getRunnableStageIndices(clientMemFree, clientProcsFree)
+        if len(indices) == 0:
+            if len(self.runnable) > 0:
+                logger.debug("The executor does not have enough free resources (free: %.2fG, %d procs) "
+                             "to run any of the %d runnable stages. (Executor: %s)",
+                             clientMemFree, clientProcsFree, len(self.runnable), clientURIstr)
+            return ("wait", [])
+        logger.debug("Dispatching %d stages to executor %s", len(indices), clientURIstr)
+        return ("run_stages", indices)
+
+    def executorCheckIn(self, clientURI, tick, stage_reports, clientMemFree, clientProcsFree):
+        """The only call an executor makes to the server during its main loop: a heartbeat,
+        the results of the stages which have terminated since its last check-in, and a request
+        for as much work as fits into its free resources (see getCommands), all in one round-trip.
+        Each element of `stage_reports` is a dict with "ix", "returncode", "usage" and "cause" fields.
+        Returns a tuple of a flag (as for getCommands) and a list of StageInfo objects for the
+        stages to run, which are already marked as started on the given executor."""
+        self.updateClientTimestamp(clientURI, tick)
+        self.process_stage_reports(clientURI, stage_reports)
+        newly_runnable = self.collect_runnable_hooks()
+        cmd, indices = self.getCommands(clientURI, clientMemFree, clientProcsFree)
+        for i in indices:
+            self.setStageStarted(i, clientURI)
+        client = self.clients[clientURI]
+        if cmd in ("run_stages", "wait"):
+            client.free_mem   = clientMemFree - sum(self.stages[i].mem for i in indices)
+            client.free_procs = clientProcsFree - sum(self.stages[i].procs for i in indices)
         else:
-            return (flag, i)
+            client.free_mem, client.free_procs = 0, 0
+        # the reported stages (or finished hooks) may have made others runnable; the reporting executor
+        # got the first pick above, but others may be waiting for work:
+        if len(stage_reports) > 0 or newly_runnable > 0:
+            self.wakeWaitingExecutors()
+        return (cmd, [self.get_stage_info(i) for i in indices])
+
+    def process_stage_reports(self, clientURI, stage_reports):
+        for report in stage_reports:
+            ix = report["ix"]
+            # don't let a bad report prevent us from processing the others (or dispatching work)
+            try:
+                if report["returncode"] == 0:
+                    self.setStageFinished(ix, clientURI, usage=report.get("usage"))
+                else:
+                    # a None returncode is also considered a failure
+                    self.setStageFailed(ix, clientURI, cause=report.get("cause"))
+            except Exception:
+                logger.exception("Unable to process the report for stage %d from %s: %s", ix, clientURI, report)
+
+    def reattachClient(self, clientURI, maxmemory, running, stage_reports):
+        """(Re-)register an executor which has lost contact with its server, e.g., a previous server
+        which ran out of walltime (see --reattach-time).  `running` are the hashes (see `CmdStage.getHash`)
+        of the stages it's still running and `stage_reports` (as for `executorCheckIn`, but identified
+        by a "hash" field since indices aren't the same for different servers) describe those which
+        terminated while it was disconnected.  Stages which we haven't finished or started elsewhere
+        in the meantime are taken over (reports of other stages are ignored).  Returns a dict
+        from the hashes of the running stages we've taken over to their indices, by which the executor
+        should report them from now on; it should discard the results of the others."""
+        if self.is_time_to_drain():
+            raise ValueError("the server is shutting down")
+        if clientURI in self.clients:
+            # we've lost contact but not given up on it yet; any stages we think it's running
+            # but it doesn't are requeued (and taken over again below if it is running them)
+            self.unregisterClient(clientURI)
+        # (not via `registerClient`, as this isn't one of the executors we've launched)
+        self.clients[clientURI] = ExecClient(clientURI, maxmemory)
+        if self.index_by_hash is None:
+            self.index_by_hash = { s.getHash() : i for i, s in enumerate(self.stages) }
+        adopted = {}
+        for h in running:
+            i = self.index_by_hash.get(h)
+            if i is not None and self.adopt_stage(i, clientURI):
+                adopted[h] = i
+        reports = []
+        for report in stage_reports:
+            i = self.index_by_hash.get(report["hash"])
+            if i is not None and self.adopt_stage(i, clientURI):
+                reports.append(dict(report, ix=i))
+        logger.info("Executor %s reattached, still running %d stages (%d taken over) and reporting %d "
+                    "(%d taken over)", clientURI, len(running), len(adopted), len(stage_reports), len(reports))
+        self.process_stage_reports(clientURI, reports)
+        if len(reports) > 0:
+            self.wakeWaitingExecutors()
+        return adopted
+
+    def adopt_stage(self, i, clientURI):
+        """Mark stage `i` as started on the given executor if it's still to be run here, i.e., it's runnable
+        (and not already running) or held back for an executor to reattach; returns whether it was."""
+        s = self.stages[i]
+        if s.isFinished() or s.status == 'running' or self.unfinished_pred_counts[i] > 0 or i in self.failedStages:
+            return False
+        if i in self.orphaned:
+            self.orphaned.discard(i)
+        elif not self.runnable.remove(i):
+            if i not in self.waiting_for_hooks:
+                return False
+            # we needn't wait for its hooks (but let them finish in case the stage is rerun)
+            self.waiting_for_hooks.discard(i)
+        self.setStageStarted(i, clientURI)
+        return True
+
+    def release_orphaned_stages(self):
+        """Enqueue the stages held back for executors to reattach once we've waited long enough."""
+        if len(self.orphaned) == 0:
+            return 0
+        now = time.time()
+        if self.orphan_deadline is None:
+            # the executors look for a new server every pe.EXECUTOR_MAIN_LOOP_INTERVAL, and we wait
+            # as long for them as for a missed heartbeat, unless they'll have given up by then
+            self.orphan_deadline = (min(now + self.exec_options.latency_tolerance, self.orphans_given_up_at)
+                                    + pe.EXECUTOR_MAIN_LOOP_INTERVAL)
+        if now < self.orphan_deadline:
+            return 0
+        logger.warning("No executor has reattached with %d stages which were running when the previous server "
+                       "shut down; running them again", len(self.orphaned))
+        orphaned, self.orphaned = self.orphaned, set()
+        for i in orphaned:
+            self.enqueue(i)
+        return len(orphaned)
+
+    def recordRunningStages(self):
+        """Record which stages are still running as we shut down, so that with --reattach-time
+        the next server can wait for the executors running them (see `skip_completed_stages`)."""
+        if not self.exec_options.reattach_time:
+            return
+        try:
+            write_running_stages(self.running_stages_file,
+                                 (self.stages[i].getHash() for i in self.currently_running_stages | self.orphaned))
+        except Exception:
+            logger.exception("Unable to record the running stages in %s", self.running_stages_file)
+
+    def wakeWaitingExecutors(self):
+        """Push a notification to (enough) waiting executors with room for some runnable stage
+        so that they check in right away rather than at their next regular check-in."""
+        to_wake = len(self.runnable)
+        for uri, client in self.clients.items():
+            if to_wake <= 0:
+                break
+            if client.free_procs > 0 and self.runnable.fits(client.free_mem, client.free_procs):
+                logger.debug("Waking up executor %s", uri)
+                # it'll tell us about its free resources when it checks in
+                client.free_mem, client.free_procs = 0, 0
+                self.notifier.notify(uri)
+                to_wake -= 1
+
+    def getRunnableStageIndices(self, memFree, procsFree):
+        """Remove and return the indices of a batch of runnable stages which together fit into
+        the given amount of memory and processors.  This is a greedy bin-packing (with a single bin)
+        over the runnable set: stages are considered in priority order (see `critical_path_priorities`),
+        and among stages of equal priority those with the largest memory requirements come first
+        so that big stages aren't starved by a stream of small ones,
+        while small stages still fill up any remaining space."""
+        batch = []
+        while procsFree > 0:
+            i = self.runnable.pop_fitting(memFree, procsFree)
+            if i is None:
+                break
+            batch.append(i)
+            memFree   -= self.stages[i].mem
+            procsFree -= self.stages[i].procs
+        return batch
 
     """Return a tuple of a command ("shutdown_normally" if all stages are finished,
     "wait" if no stages are currently runnable, or "run_stage" if a stage is
@@ -461,17 +788,10 @@ class Pipeline(object):
         elif len(self.runnable) == 0:
             return ("wait", None)
         else:
-            index = self.runnable.pop()
-            # remove an instance of currently required memory
-            try:
-                self.mem_req_for_runnable.remove(self.stages[index].mem)
-            except:
-                logger.debug("mem_req_for_runnable: %s; mem: %s", self.mem_req_for_runnable, self.stages[index].mem)
-                logger.exception("It wasn't here!")
-            return ("run_stage", index)
+            return ("run_stage", self.runnable.pop())
 
     def allStagesCompleted(self): 
-        return self.num_finished_stages == len(self.stages) 
+        return self.stream is None and self.num_finished_stages == len(self.stages) 
 
     def addRunningStageToClient(self, clientURI, index):
         try:
@@ -507,6 +827,14 @@ class Pipeline(object):
         self.addRunningStageToClient(clientURI, index)
         self.currently_running_stages.add(index)
         self.stages[index].setRunning()
+        if self.background_hooks and not self.dispatched[index]:
+            self.dispatched[index] = True
+            # start evaluating the hooks of stages whose last predecessor this is,
+            # so that they're (usually) ready by the time the stage becomes runnable
+            for i in self.G.successors(index):
+                self.undispatched_pred_counts[i] -= 1
+                if self.undispatched_pred_counts[i] == 0:
+                    self.start_runnable_hooks(i, early=True)
 
     def checkIfRunnable(self, index):
         """stage added to runnable set if all predecessors finished"""
@@ -515,8 +843,10 @@ class Pipeline(object):
         return canRun
 
     def setStageFinished(self, index, clientURI, save_state = True,
-                         checking_pipeline_status = False):
-        """given an index, sets corresponding stage to finished and adds successors to the runnable set"""
+                         checking_pipeline_status = False, usage = None):
+        """given an index, sets corresponding stage to finished and adds successors to the runnable set.
+        `usage`, if given, is the executor's measurement of the stage's resource usage
+        (a dict with "wall_time", "cpu_time" and "peak_rss" fields), which we add to the history"""
 
         s = self.stages[index]
         
@@ -543,6 +873,10 @@ class Pipeline(object):
             # run any potential hooks now that the stage has finished:
             for f in s.finished_hooks:
                 f(s)
+            if usage is not None:
+                self.recordStageUsage(index, usage)
+                if usage.get("outputs"):
+                    self.recordStageOutputs(index, usage["outputs"])
         self.num_finished_stages += 1
 
         # do some reporting in terms of how many stages have been completed:
@@ -556,19 +890,46 @@ class Pipeline(object):
                       + str(self.exec_options.urifile) + "\n")
             self.percent_finished_reported = roughly_processed
 
-        # write out the (index, hash) pairs to disk.  We don't actually need the indices
+        # record the (index, hash) pairs on disk.  We don't actually need the indices
         # for anything (in fact, the restart code in skip_completed_stages is resilient 
-        # against an arbitrary renumbering of stages), but a human-readable log is somewhat useful.
+        # against an arbitrary renumbering of stages), but they're somewhat useful for debugging.
+        # The journal only writes to disk every so often, so we might not record a stage's completion,
+        # but this doesn't affect correctness.
         if not checking_pipeline_status:
-            self.finished_stages_fh.write("%d,%s\n" % (index, self.stages[index].getHash()))
-            self.finished_stages_fh.flush()
-        # FIXME flush could turned off as an optimization (more sensibly, a small buffer size could be set)
-        # ... though we might not record a stage's completion, this doesn't affect correctness.
+            self.finished_stages_journal.append(index, self.stages[index].getHash())
         for i in self.G.successors(index):
             self.unfinished_pred_counts[i] -= 1
             if self.checkIfRunnable(i):
                 self.enqueue(i)
 
+    def recordStageUsage(self, index, usage):
+        s = self.stages[index]
+        logger.debug("Stage %d used: %s", index, usage)
+        # outputs restored from the result cache say nothing about the stage's requirements
+        if self.history is None or usage.get("cached"):
+            return
+        # losing some history isn't worth crashing the server over:
+        try:
+            self.history.record(program=program_name(s), input_voxels=s.input_voxels, usage=usage,
+                                mem_requested=s.mem, procs=s.procs, pipeline_name=self.pipeline_name)
+        except Exception:
+            logger.exception("Unable to record resource usage of stage %d in %s", index, self.history.filename)
+
+    def recordStageOutputs(self, index, outputs):
+        # as for the history, a missing manifest entry just means more checking on restart:
+        try:
+            self.restart_manifest.record(outputs)
+        except Exception:
+            logger.exception("Unable to record outputs of stage %d in %s", index, self.restart_manifest.filename)
+
+    def snapshotRestartManifest(self):
+        """Record the state of the output directories once we've stopped running stages
+        (see RestartManifest.snapshot_dirs)."""
+        try:
+            self.restart_manifest.snapshot_dirs()
+        except Exception:
+            logger.exception("Unable to update the restart manifest %s", self.restart_manifest.filename)
+
     def removeFromRunning(self, index, clientURI, new_status):
         try:
             self.currently_running_stages.discard(index)
@@ -583,12 +944,22 @@ class Pipeline(object):
         self.removeFromRunning(index, clientURI, new_status = None)
         self.enqueue(index)
 
-    def setStageFailed(self, index, clientURI):
+    def setStageFailed(self, index, clientURI, cause=None):
         # given an index, sets stage to failed, adds to failed stages array
         # But... only if this stage has already been retried twice (<- for now static)
         # Once in while retrying a stage makes sense, because of some odd I/O
         # read write issue (NFS race condition?). At least that's what I think is 
         # happening, so trying this to see whether it solves the issue.
+        # `cause` is the executor's diagnosis of the failure (see pe.failure_cause).
+        # If the stage (probably) ran out of memory, retrying with the same request would
+        # just fail the same way, so we retry with more memory instead; as this is bounded
+        # by the memory available to an executor, such retries don't count against the limit above.
+        if cause in pe.MEMORY_FAILURE_CAUSES and self.escalateMemory(index):
+            self.removeFromRunning(index, clientURI, new_status = None)
+            logger.info("RETRYING: Stage %d (%s) failed (%s); retrying with %.2fG of memory. Logfile: %s",
+                        index, self.stages[index], cause, self.stages[index].mem, self.stages[index].logFile)
+            self.enqueue(index)
+            return
         num_retries = self.stages[index].getNumberOfRetries()
         if num_retries < 2:
             # without a sleep statement, the stage will be retried within
@@ -610,32 +981,132 @@ class Pipeline(object):
             print("Logfile for (potentially) more information:\n%s\n" % self.stages[index].logFile)
             sys.stdout.flush()
             self.failedStages.append(index)
-            for i in nx.dfs_successors(self.G, index).keys():
-                self.failedStages.append(i)
+            self.failedStages.extend(self.G.descendants(index))
+
+    def escalateMemory(self, index):
+        """Increase the memory request of a stage which ran out of memory, up to the amount
+        an executor can have; return False if it can't be increased any further.
+        Since dispatch only sends stages to executors with enough free memory, the stage
+        will then only run on an executor which can hold it."""
+        s = self.stages[index]
+        if self.memAvail is not None and s.mem >= self.memAvail:
+            return False
+        if index in self.learned_mem_stages:
+            # our estimate was too low, so be more generous with this program from now on
+            self.memory_estimator.bump(s, OOM_RETRY_MEMORY_FACTOR)
+        new_mem = s.mem * OOM_RETRY_MEMORY_FACTOR
+        s.setMem(min(new_mem, self.memAvail) if self.memAvail is not None else new_mem)
+        return True
 
-    @functools.lru_cache(maxsize=None)  # must cache *all* results!
     def prepare_to_run(self, i):
-        """Some pre-run tasks that must only run once
+        """Some pre-run tasks that must only run once, after the stage's runnable hooks
         (in the current model, `enqueue` may run arbitrarily many times!)"""
-        for f in self.stages[i]._runnable_hooks:
-            f(self.stages[i])
+        self.prepared[i] = True
+        # the hooks may have recorded the size of the stage's input, which lets us
+        # use the memory previous runs of this program actually needed instead
+        # (learned estimates are measurements on this system, so aren't scaled by the memory_factor):
+        learned_mem = (self.memory_estimator.estimate_stage(self.stages[i])
+                       if self.memory_estimator is not None else None)
+        if learned_mem is not None:
+            logger.debug("Stage %d: using learned memory estimate %.3fG instead of %.3fG",
+                         i, learned_mem, self.stages[i].mem)
+            self.stages[i].setMem(learned_mem)
+            self.learned_mem_stages.add(i)
         # the easiest place to ensure that all stages request at least
         # the default job mem is here. The hooks above might estimate
         # memory for the jobs, here we'll override that if they requested
         # less than the minimum
         if self.stages[i].mem < self.exec_options.default_job_mem:
             self.stages[i].setMem(self.exec_options.default_job_mem)
+        # a stage can't use more processors than an executor has (and wouldn't ever be run if it asked for more)
+        if self.stages[i].procs > self.exec_options.proc:
+            self.stages[i].setProcs(self.exec_options.proc)
         # scale everything by the memory_factor
         # FIXME this may run several times ... weird !!
-        self.stages[i].setMem(self.stages[i].mem * self.exec_options.memory_factor)
+        if learned_mem is None:
+            self.stages[i].setMem(self.stages[i].mem * self.exec_options.memory_factor)
 
     def enqueue(self, i):
         """Update pipeline data structures and run relevant hooks when a stage becomes runnable."""
         #logger.debug("Queueing stage %d", i)
-        self.runnable.add(i)
+        if not self.prepared[i]:
+            if self.background_hooks:
+                # the stage is enqueued once its hooks have been evaluated (see collect_runnable_hooks)
+                self.waiting_for_hooks.add(i)
+                self.start_runnable_hooks(i)
+                return
+            self.stages[i].run_runnable_hooks()
+            self.prepare_to_run(i)
+        self.runnable.add(i, mem=self.stages[i].mem, procs=self.stages[i].procs, priority=self.priorities[i])
+
+    def enable_background_hooks(self):
+        """Evaluate runnable hooks in background threads from now on (called once the server
+        starts, as we needn't and can't - since we'll traverse the graph - wait for them before then),
+        so that reading files on a slow filesystem doesn't hold up dispatching other stages."""
+        done = np.fromiter((s.status in ("finished", "running") for s in self.stages),
+                           dtype=bool, count=len(self.stages))
+        self.dispatched = done
+        self.undispatched_pred_counts = self.G.in_degrees(exclude=done)
+        self.background_hooks = True
+
+    def start_runnable_hooks(self, i, early=False):
+        """Start evaluating the runnable hooks of stage `i` in the background, `early` meaning
+        before the stage is runnable.  Since a hook may still be running when we give up on it,
+        the hooks run on a copy of the stage, whose results are copied to the stage itself
+        by `collect_runnable_hooks`."""
+        if self.prepared[i] or i in self.running_hooks:
+            return
+        s = self.stages[i]
+        if len(s._runnable_hooks) == 0:
+            self.runnable_hooks_done(i, s)
+            return
+        self.running_hooks[i] = (time.time(), early)
+        self.hook_calls.submit(i, run_runnable_hooks, copy.copy(s))
+
+    def collect_runnable_hooks(self):
+        """Apply the results of runnable hooks which have finished, enqueueing the corresponding stages
+        if they're runnable, and fall back to the default memory for runnable stages whose hooks have failed
+        or are taking too long.  Returns the number of stages enqueued."""
+        before = len(self.runnable)
+        for i, stage_copy, exc in self.hook_calls.completed():
+            if i not in self.running_hooks:
+                # we've already given up on these hooks
+                continue
+            _, early = self.running_hooks.pop(i)
+            if exc is None:
+                self.runnable_hooks_done(i, stage_copy)
+            elif early:
+                # the hooks of a stage whose predecessors haven't finished may need their outputs;
+                # try again once the stage is runnable
+                logger.debug("Runnable hooks of stage %d failed before it was runnable (%s)", i, exc)
+                if i in self.waiting_for_hooks:
+                    self.start_runnable_hooks(i)
+            else:
+                logger.error("Runnable hooks of stage %d failed (%s: %s); using the default memory (%.2fG)",
+                             i, type(exc).__name__, exc, self.exec_options.default_job_mem)
+                self.runnable_hooks_done(i, None)
+        now = time.time()
+        for i in [i for i, (started, _) in self.running_hooks.items()
+                  if i in self.waiting_for_hooks and now - started > self.hook_timeout]:
+            logger.warning("Runnable hooks of stage %d haven't finished after %.0fs; using the default memory (%.2fG)",
+                           i, now - self.running_hooks[i][0], self.exec_options.default_job_mem)
+            del self.running_hooks[i]
+            self.runnable_hooks_done(i, None)
+        return len(self.runnable) - before
+
+    def runnable_hooks_done(self, i, stage_copy):
+        """Record the results of stage `i`'s runnable hooks (the copy of the stage they ran on,
+        or None if they didn't succeed) and enqueue the stage if it's waiting for them."""
+        s = self.stages[i]
+        if stage_copy is None:
+            s.setMem(self.exec_options.default_job_mem)
+        elif stage_copy is not s:
+            for field in RUNNABLE_HOOK_FIELDS:
+                setattr(s, field, getattr(stage_copy, field))
         self.prepare_to_run(i)
-        # keep track of the memory requirements of the runnable jobs
-        self.mem_req_for_runnable.append(self.stages[i].mem)
+        if i in self.waiting_for_hooks:
+            self.waiting_for_hooks.discard(i)
+            self.enqueue(i)
 
     """
         Returns True unless all stages are finished, then False
@@ -649,6 +1120,19 @@ class Pipeline(object):
     def continueLoop(self):
         if self.verbose:
             print('.', end="", flush=True)
+        # stages may have become runnable (once their hooks finished) since an executor last checked in:
+        if self.collect_runnable_hooks() + self.release_orphaned_stages() > 0:
+            self.wakeWaitingExecutors()
+        # ... or been constructed:
+        if self.stream is not None:
+            try:
+                if self.add_streamed_stages() > 0:
+                    self.wakeWaitingExecutors()
+            except ConstructionFailed as e:
+                logger.error("Pipeline construction failed (%s); shutting down.", e)
+                print("\nERROR: pipeline construction failed (%s); shutting down.\n" % e)
+                sys.stdout.flush()
+                return False
         # We may be have been called one last time just as the parent thread is exiting
         # (if it wakes us with a signal).  In this case, don't do anything:
         if self.shutdown_ev.is_set():
@@ -664,7 +1148,10 @@ class Pipeline(object):
         # (e.g., if some stages have repeatedly failed)
         # TODO this might indicate a bug, so better reporting would be useful
         elif (len(self.runnable) == 0
-            and len(self.currently_running_stages) == 0):
+            and len(self.currently_running_stages) == 0
+            and len(self.waiting_for_hooks) == 0
+            and len(self.orphaned) == 0
+            and self.stream is None):
             logger.info("ERROR: no more runnable stages, however not all stages have finished. Going to shut down.")
             print("\nERROR: no more runnable stages, however not all stages have finished. Going to shut down.\n")
             sys.stdout.flush()
@@ -687,7 +1174,7 @@ class Pipeline(object):
         # TODO combine with above clause?
         else:
           if len(self.runnable) > 0:
-            highest_mem_stage = self.highest_memory_stage(self.runnable)
+            highest_mem_stage = self.highest_memory_stage()
             max_memory_required = highest_mem_stage.mem
           if ((len(self.runnable) > 0) and
           # require no running jobs rather than no clients
@@ -718,15 +1205,12 @@ class Pipeline(object):
             logger.exception("clientURI not found in server client list:")
             raise
 
-    # requires: stages != []
-    # a better interface might be (self, [stage]) -> { MemAmount : (NumStages, [Stage]) }
-    # or maybe the same using a heap (to facilitate getting N stages with most memory)
-    def highest_memory_stage(self, stages):
-        s = max(stages, key=lambda i: self.stages[i].mem)
-        return self.stages[s]
+    # requires: self.runnable is non-empty
+    def highest_memory_stage(self):
+        return self.stages[self.runnable.peek_max()]
 
-    def max_memory_required(self, stages):
-        return self.highest_memory_stage(stages).mem  # TODO don't use below, propagate stage # ....
+    def max_memory_required(self):
+        return self.runnable.max_mem()
 
     # this can't be a loop since we call it via sockets and don't want to block the socket forever
     def manageExecutors(self):
@@ -734,11 +1218,10 @@ class Pipeline(object):
         executors_to_launch = self.numberOfExecutorsToLaunch()
         if executors_to_launch > 0:
             # RAM needed to run a single job:
-            max_memory_stage = self.highest_memory_stage(self.runnable)
-            memNeeded = max_memory_stage.mem  # self.max_memory_required(self.runnable)
+            max_memory_stage = self.highest_memory_stage()
+            memNeeded = max_memory_stage.mem
             # RAM needed to run `proc` most expensive jobs (not the ideal choice):
-            memWanted = sum(sorted([self.stages[i].mem for i in self.runnable],
-                                   key = lambda x: -x)[0:self.exec_options.proc])
+            memWanted = sum(self.runnable.largest_mems(self.exec_options.proc))
             logger.debug("wanted: %s", memWanted)
             logger.debug("needed: %s", memNeeded)
 
@@ -799,7 +1282,7 @@ class Pipeline(object):
             return 0
 
         if (len(self.runnable) > 0 and
-            self.max_memory_required(self.runnable) > self.memAvail):
+            self.max_memory_required() > self.memAvail):
             # we might still want to launch executors for the stages with smaller
             # requirements
             return 0
@@ -820,11 +1303,15 @@ class Pipeline(object):
         
     def launchExecutorsFromServer(self, number_to_launch, memNeeded):
         logger.info("Launching %i executors", number_to_launch)
+        # (counted first, since they may register while we're still launching them)
+        self.number_launched_and_waiting_clients += number_to_launch
         try:
-            launchPipelineExecutors(options=self.options, number=number_to_launch,
-                                    mem_needed=memNeeded, uri_file=self.exec_options.urifile)
-            self.number_launched_and_waiting_clients += number_to_launch
+            with self.blocking():
+                launchPipelineExecutors(options=self.options, number=number_to_launch,
+                                        mem_needed=memNeeded, uri_file=self.exec_options.urifile)
         except:
+            self.number_launched_and_waiting_clients = max(0, self.number_launched_and_waiting_clients
+                                                              - number_to_launch)
             logger.exception("Failed launching executors from the server.")
             raise
         
@@ -855,6 +1342,8 @@ class Pipeline(object):
             for s in self.clients[clientURI].running_stages.copy():
                 self.setStageLost(s, clientURI)
             del self.clients[clientURI]
+            # someone else can run the lost stages
+            self.wakeWaitingExecutors()
         except:
             if self.verbose:
                 print("\nUnable to un-register client: " + clientURI)
@@ -870,14 +1359,24 @@ class Pipeline(object):
     def skip_completed_stages(self):
         logger.debug("Consulting logs to determine skippable stages...")
         try:
-            with open(self.backupFileLocation, 'r') as fh:
-                # a stage's index is just an artifact of the graph construction,
-                # so load only the hashes of finished stages
-                previous_hashes = frozenset((e.split(',')[1] for e in fh.read().split()))
+            # a stage's index is just an artifact of the graph construction,
+            # so load only the hashes of finished stages
+            previous_hashes = frozenset(h for _, h in read_journal(self.backupFileLocation))
         except:
             logger.info("Finished stages log doesn't exist or is corrupt.")
             return
 
+        smart_restart = self.options.application.smart_restart
+        if smart_restart:
+            # stat (in bulk) all the files which we might need to compare below
+            # rather than one at a time as the graph is traversed
+            starttime = time.time()
+            files = set(f for s in self.stages if isinstance(s, CmdStage) and s.getHash() in previous_hashes
+                          for f in itertools.chain(s.inputFiles, s.outputFiles))
+            file_stats = self.restart_manifest.current_stats(
+                           files, trust_dirs=self.options.application.trust_directory_mtimes)
+            logger.info("Checked %d files for smart restart in %.1fs", len(files), time.time() - starttime)
+
         runnable  = []
         finished  = []
         completed = 0
@@ -907,11 +1406,15 @@ class Pipeline(object):
                 runnable.append(i)
                 continue
 
-            if self.options.application.smart_restart:
-                latest_input_mtime = max([os.stat(inputFile).st_mtime for inputFile in s.inputFiles])
-                latest_output_mtime = max([os.stat(outputFile).st_mtime for outputFile in s.outputFiles])
+            if smart_restart:
+                input_stats  = [file_stats[f] for f in s.inputFiles]
+                output_stats = [file_stats[f] for f in s.outputFiles]
+                # some files are missing, so rerun it (and if it's an input which is missing, let it fail)
+                if None in input_stats or None in output_stats:
+                    runnable.append(i)
+                    continue
                 #this command's inputFiles were modified after its outputFiles, so rerun it.
-                if (latest_input_mtime > latest_output_mtime):
+                if max([st[1] for st in input_stats], default=0) > max([st[1] for st in output_stats], default=0):
                     runnable.append(i)
                     continue
 
@@ -920,16 +1423,22 @@ class Pipeline(object):
             finished.append((i, h))  # stupid ... duplicates logic in setStageFinished ...
             completed += 1
 
+        # stages which were still running when the previous server shut down may yet be finished
+        # by executors which reattach (see `reattachClient`) unless they've given up already
+        running_hashes, written = take_running_stages(self.running_stages_file)
+        if len(running_hashes) > 0 and self.exec_options.reattach_time:
+            self.orphans_given_up_at = written + self.exec_options.reattach_time * 60
+            if self.orphans_given_up_at > time.time():
+                self.orphaned = set(i for i in runnable if self.stages[i].getHash() in running_hashes)
+                logger.info("Waiting for executors to reattach with %d stages running when the previous server "
+                            "shut down", len(self.orphaned))
+
         logger.debug("Runnable: %s", runnable)
         for i in runnable:
-            self.enqueue(i)
-        with open(self.backupFileLocation, 'w') as fh:
-            # TODO For further optimization, it might (?) be even faster to write to memory and then
-            # make a single file write when finished.
-            # FIXME should write to tmp file in same dir, then overwrite (?) since a otherwise an interruption
-            # in writing this file will cause progress to be lost
-            for l in finished:
-                fh.write("%d,%s\n" % l)
+            if i not in self.orphaned:
+                self.enqueue(i)
+        # compact the journal, keeping only stages which are still finished (with their new indices)
+        compact_journal(self.backupFileLocation, finished)
         logger.info('Previously completed stages (of %d total): %d', len(self.stages), completed)
 
     def printShutdownMessage(self):
@@ -999,6 +1508,21 @@ def launchServer(pipeline):
     # but uses a hack to attempt to avoid returning localhost (127....)
     network_address = Pyro4.socketutil.getIpAddress(socket.gethostname(),
                                                     workaround127 = True, ipVersion = 4)
+
+    pipeline.setVerbosity(options.application.verbose)
+
+    pipeline.enable_background_hooks()
+
+    shutdown_time = pe.EXECUTOR_MAIN_LOOP_INTERVAL + options.execution.latency_tolerance
+
+    if options.execution.server_transport == "asyncio":
+        launchAsyncServer(pipeline, network_address, shutdown_time)
+        return
+
+    if pipeline.stream is not None:
+        # the Pyro daemon serves a copy of the pipeline in another process, which the stages can't reach
+        raise ValueError("a pipeline can only be run while it's being constructed with --server-transport=asyncio")
+
     daemon = Pyro4.core.Daemon(host=network_address)
     pipelineURI = daemon.register(pipeline)
     
@@ -1012,13 +1536,17 @@ def launchServer(pipeline):
         uf = open(options.execution.urifile, 'w')
         uf.write(pipelineURI.asString())
         uf.close()
-    
-    pipeline.setVerbosity(options.application.verbose)
 
-    shutdown_time = pe.EXECUTOR_MAIN_LOOP_INTERVAL + options.execution.latency_tolerance
-    
+    def requestLoop():
+        # we stop this process with a SIGTERM; make sure any buffered journal entries get written
+        def handler(_sig, _stack):
+            pipeline.finished_stages_journal.flush()
+            sys.exit(0)
+        signal.signal(signal.SIGTERM, handler)
+        daemon.requestLoop()
+
     try:
-        t = Process(target=daemon.requestLoop)
+        t = Process(target=requestLoop)
         # t.daemon = True
         t.start()
 
@@ -1070,17 +1598,7 @@ def launchServer(pipeline):
         h.start()
         #del pipeline   # `top` shows this has no effect on vmem
 
-        try:
-            jid    = os.environ["PBS_JOBID"]
-            output = subprocess.check_output(['qstat', '-f', jid], stderr=subprocess.STDOUT)
-
-            time_left = int(re.search('Walltime.Remaining = (\d*)', output).group(1))
-            logger.debug("Time remaining: %d s" % time_left)
-            time_to_live = time_left - shutdown_time
-        except:
-            logger.info("I couldn't determine your remaining walltime from qstat.")
-            time_to_live = None
-        flag = e.wait(time_to_live)
+        flag = e.wait(remaining_walltime(shutdown_time))
         if not flag:
             logger.info("Time's up!")
         e.set()
@@ -1106,12 +1624,89 @@ def launchServer(pipeline):
         #time.sleep(pe.SHUTDOWN_TIME)
         # trying to access variables from `p` in the `finally` clause (in order
         # to print a shutdown message) hangs for some reason, so do it here instead
+        p.recordRunningStages()
         p.printShutdownMessage()
+        # (the manifest lives on disk, so our copy of the pipeline can do this)
+        pipeline.snapshotRestartManifest()
     finally:
         # brutal, but awkward to do with our system of `Event`s
         # could send a signal to `t` instead:
         t.terminate()
 
+def run_runnable_hooks(stage):
+    stage.run_runnable_hooks()
+    return stage
+
+
+def remaining_walltime(shutdown_time):
+    """Seconds until we should shut down (`shutdown_time` before the end of our walltime),
+    or None if there's no limit or it can't be determined."""
+    try:
+        jid    = os.environ["PBS_JOBID"]
+        output = subprocess.check_output(['qstat', '-f', jid], stderr=subprocess.STDOUT)
+
+        time_left = int(re.search('Walltime.Remaining = (\d*)', output).group(1))
+        logger.debug("Time remaining: %d s" % time_left)
+        return time_left - shutdown_time
+    except:
+        logger.info("I couldn't determine your remaining walltime from qstat.")
+        return None
+
+
+def launchAsyncServer(pipeline, network_address, shutdown_time):
+    """Like the Pyro part of launchServer, but requests from executors and the management of executors
+    are handled by coroutines on a single event loop in this process (see transport.AsyncPipelineServer),
+    so there's no auxiliary process polling the server over a proxy."""
+    options = pipeline.options
+    if options.execution.use_ns:
+        logger.warning("The Pyro NameServer can't be used with --server-transport=asyncio; "
+                       "writing the server's URI to %s instead", options.execution.urifile)
+    server = AsyncPipelineServer(pipeline, loop_interval=LOOP_INTERVAL)
+
+    async def run():
+        uri = await server.start(host=network_address, path=options.execution.server_socket)
+        if pipeline.stream is not None:
+            # have the management loop add newly constructed stages right away
+            loop = asyncio.get_event_loop()
+            def wake():
+                try:
+                    loop.call_soon_threadsafe(server.wakeup)
+                except RuntimeError:
+                    pass  # the loop has already been closed
+            pipeline.stream.on_put = wake
+        with open(options.execution.urifile, 'w') as uf:
+            uf.write(uri)
+        logger.info("The pipeline's uri is: %s", uri)
+        if options.application.verbose:
+            print("The pipeline's uri is: %s" % uri)
+        logger.debug("memory limit: %.3G; available after server overhead: %.3fG"
+                     % (options.execution.mem, pipeline.memAvail))
+
+        # handle SIGTERM as in launchServer
+        def handler():
+            pipeline.shutdown_ev.set()
+            server.stop()
+        asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, handler)
+
+        if not await server.serve(remaining_walltime(shutdown_time)):
+            logger.info("Time's up!")
+        pipeline.shutdown_ev.set()
+
+    try:
+        asyncio.get_event_loop().run_until_complete(run())
+    except KeyboardInterrupt:
+        logger.exception("Caught keyboard interrupt, killing executors and shutting down server.")
+        print("\nKeyboardInterrupt caught: cleaning up, shutting down executors.\n")
+        sys.stdout.flush()
+    except:
+        logger.exception("Exception running the asyncio server. Server shutting down.")
+        raise
+    else:
+        pipeline.recordRunningStages()
+        pipeline.printShutdownMessage()
+        pipeline.snapshotRestartManifest()
+
+
 def flatten_pipeline(p):
     """return a list of tuples for each stage.
        Each item in the list is (id, command, [dependencies]) 
@@ -1127,16 +1722,34 @@ def flatten_pipeline(p):
                 
     return sorted([(i, str(p.stages[i]), p.G.predecessors(i)) for i in p.G.nodes()], key=functools.cmp_to_key(post))
 
+def evict_from_result_cache(exec_options):
+    max_size, max_age = exec_options.result_cache_max_size, exec_options.result_cache_max_age
+    if max_size is None and max_age is None:
+        return
+    try:
+        removed = ResultCache(exec_options.result_cache).evict(
+                    max_bytes=max_size * 2**30 if max_size is not None else None,
+                    max_age=max_age * 24 * 3600 if max_age is not None else None)
+    except OSError:
+        logger.exception("Unable to evict entries from the result cache %s", exec_options.result_cache)
+    else:
+        logger.info("Removed %d entries from the result cache %s", removed, exec_options.result_cache)
+
+
 def pipelineDaemon(pipeline, options, programName=None):
     """Launches Pyro server and (if specified by options) pipeline executors"""
 
     if options.execution.urifile is None:
         options.execution.urifile = create_uri_filename_from_options(options.application.pipeline_name)
 
-    if options.application.restart:
+    # (a pipeline still being constructed isn't restarted; see `application.stream_construction`)
+    if options.application.restart and pipeline.stream is None:
         pipeline.skip_completed_stages()
 
-    if len(pipeline.runnable) == 0:
+    if options.execution.result_cache is not None:
+        evict_from_result_cache(options.execution)
+
+    if len(pipeline.runnable) == 0 and len(pipeline.orphaned) == 0 and pipeline.stream is None:
         print("\nPipeline has no runnable stages. Exiting...")
         sys.exit()
    
@@ -1149,8 +1762,8 @@ def pipelineDaemon(pipeline, options, programName=None):
     try:
         # we are now appending to the stages file since we've already written
         # previously completed stages to it in skip_completed_stages
-        with open(pipeline.backupFileLocation, 'a') as fh:
-            pipeline.finished_stages_fh = fh
+        with FinishedStagesJournal(pipeline.backupFileLocation) as journal:
+            pipeline.finished_stages_journal = journal
             logger.debug("Starting server...")
             launchServer(pipeline)
     except:
@@ -7,10 +7,20 @@ import warnings
 
 from configargparse import ArgParser, Namespace  # type: ignore
 from datetime import datetime
-from multiprocessing import Process, Pool, Lock # type: ignore
+import itertools
+from multiprocessing import Process, Lock # type: ignore
 import subprocess
 import shlex
 import pydpiper.execution.queueing as q
+import pydpiper.execution.transport as transport
+from pydpiper.execution.restart import command_hash, output_record
+from pydpiper.execution.readiness import wait_for_outputs
+from pydpiper.execution.directories import known_directories
+from pydpiper.execution.limits import (ProcSlots, RLIMIT_OOM_FRACTION, StageCgroups, THREAD_COUNT_VARIABLES,
+                                       confine, gated_command, memory_limit, pinnable_cpus,
+                                       reports_allocation_failure)
+from pydpiper.execution.cache import ResultCache
+from pydpiper.execution.scratch import ScratchSpace
 import math as m
 import logging
 import socket
@@ -28,6 +38,10 @@ Pyro4.config.SERVERTYPE = "multiplex"
 
 class SubmitError(ValueError): pass
 
+class ServerLost(Exception):
+    """We've lost contact with the server, or it's shutting down (e.g., having run out of walltime)."""
+    pass
+
 for boring_exception, name in [(mincException, "mincException"), (SubmitError, "SubmitError"), (KeyError, "KeyError")]:
     Pyro4.util.SerializerBase.register_dict_to_class(name, lambda _classname, dict: boring_exception)
     Pyro4.util.SerializerBase.register_class_to_dict(boring_exception, lambda obj: { "__class__" : name })
@@ -51,6 +65,15 @@ def ensure_exec_specified(numExec):
         print(msg)
         sys.exit(1)
 
+def find_server_uri(executor):
+    """The server's URI, from the Pyro NameServer or the uri file (which a new server overwrites)."""
+    if executor.ns:
+        ns = Pyro4.locateNS()
+        #ns.register("executor", executor, safe=True)
+        return ns.lookup("pipeline")
+    with open(executor.uri_file) as uf:
+        return uf.readline().strip()
+
 def launchExecutor(executor):
     # Start executor that will run pipeline stages
 
@@ -62,20 +85,14 @@ def launchExecutor(executor):
     clientURI = daemon.register(executor)
 
     # find the URI of the server:
-    if executor.ns:
-        ns = Pyro4.locateNS()
-        #ns.register("executor", executor, safe=True)
-        serverURI = ns.lookup("pipeline")
-    else:
-        try:
-            uf = open(executor.uri_file)
-            serverURI = Pyro4.URI(uf.readline())
-            uf.close()
-        except:
-            logger.exception("Problem opening the specified uri file:")
-            raise
+    try:
+        serverURI = find_server_uri(executor)
+    except:
+        logger.exception("Problem finding the server's URI (from the NameServer or the uri file):")
+        raise
 
-    p = Pyro4.Proxy(serverURI)
+    # (the server may be a Pyro daemon or one of our asyncio servers; see `transport`)
+    p = transport.connect(serverURI)
     # Register the executor with the pipeline
     # the following command only works if the server is alive. Currently if that's
     # not the case, the executor will die which is okay, but this should be
@@ -84,7 +101,7 @@ def launchExecutor(executor):
 
     executor.registeredWithServer()
     executor.setClientURI(clientURI.asString())
-    executor.setServerURI(serverURI.asString())
+    executor.setServerURI(str(serverURI))
     executor.setProxyForServer(p)
     
     logger.info("Connected to %s",  serverURI)
@@ -93,9 +110,10 @@ def launchExecutor(executor):
     executor.connection_time_with_server = time.time()
     logger.info("Connected to the server at: %s", datetime.isoformat(datetime.now(), " "))
 
-    # you'd think this could be done in __init__, but sometimes that's in the wrong process,
-    # which causes an error when calling `join` ...
-    executor.initializePool()
+    # you'd think this could be done in __init__, but sometimes that's in the wrong process
+    # (and it's this process that's moved into a cgroup) ...
+    executor.initializeStageLimits()
+    executor.initializeScratch()
 
     logger.debug("Executor daemon running at: %s", daemon.locationStr)
     try:
@@ -134,30 +152,108 @@ def launchExecutor(executor):
 
 # like a stage but lighter weight (no methods wasting memory...)
 class StageInfo(object):
-    def __init__(self, *, mem, procs, ix, cmd, log_file, output_files, env_vars):
+    def __init__(self, *, mem, procs, ix, cmd, log_file, output_files, env_vars, input_files=()):
         self.mem = mem
         self.procs = procs
         self.ix = ix
         self.cmd = cmd
         self.log_file = log_file
+        self.input_files = input_files
         self.output_files = output_files
         self.env_vars = env_vars
 
 
 def stageinfo_dict_to_class(classname, d):
     return StageInfo(mem=d['mem'], procs=d['procs'], ix=d['ix'], cmd=d['cmd'], log_file=d['log_file'],
-                     output_files=d['output_files'], env_vars=d['env_vars'])
+                     output_files=d['output_files'], env_vars=d['env_vars'], input_files=d.get('input_files', ()))
 
 
 Pyro4.util.SerializerBase.register_dict_to_class("pydpiper.execution.pipeline_executor.StageInfo",
                                                  stageinfo_dict_to_class)
+transport.register_class("StageInfo", StageInfo)
 
 
 class MissingOutputs(ValueError): pass
 
+
+# failure causes (see `failure_cause`) after which a stage should be retried with more memory
+MEMORY_FAILURE_CAUSES = frozenset(["out_of_memory", "killed"])
+
+
+def cgroup_oom_kill_count():
+    """The number of processes the kernel has killed for exceeding the memory limit of our
+    (cgroup v2) cgroup, or None if this can't be determined (e.g., no cgroup v2 or not on Linux)."""
+    try:
+        with open("/proc/self/cgroup") as f:
+            for line in f:
+                hierarchy, _controllers, path = line.rstrip("\n").split(":", 2)
+                if hierarchy == "0":
+                    with open(os.path.join("/sys/fs/cgroup", path.lstrip("/"), "memory.events")) as events:
+                        for event in events:
+                            key, value = event.split()
+                            if key == "oom_kill":
+                                return int(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def failure_cause(returncode, usage):
+    """Diagnose why a stage failed, given its return code (negative if killed by a signal)
+    and the resource usage measured by runStage:
+    "out_of_memory" if a process was OOM-killed in our cgroup while the stage ran or, if the stage was confined
+    by an address-space limit (`usage["rlimit"]`, in GB), if its peak RSS reached RLIMIT_OOM_FRACTION of the limit
+    or its output reported a failure to allocate memory (`usage["allocation_failed"]`),
+    "killed" if it was killed by SIGKILL (as done by the OOM killer and by queueing systems
+    enforcing memory limits), "signal" if killed by another signal,
+    "exit_code" for other non-zero return codes and None if we know nothing (e.g., an exception)."""
+    if returncode is None:
+        return None
+    if usage is not None and usage.get("oom_kills"):
+        return "out_of_memory"
+    if (returncode != 0 and usage is not None and usage.get("rlimit")
+          and (usage.get("allocation_failed")
+               or (usage.get("peak_rss") or 0) >= RLIMIT_OOM_FRACTION * usage["rlimit"])):
+        return "out_of_memory"
+    # when the command is run via a shell (e.g., with a --cmd-wrapper), the shell reports death by signal N as 128+N
+    if returncode in (-signal.SIGKILL, 128 + signal.SIGKILL):
+        return "killed"
+    if returncode < 0 or 128 < returncode <= 128 + 64:
+        return "signal"
+    return "exit_code"
+
+
+def usage_from_rusage(rusage, wall_time : float):
+    """Summarize the resource usage of a finished child (as returned by `os.wait4`)
+    in the units used by the server (seconds and GB)."""
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    maxrss_per_GB = 2**30 if sys.platform == "darwin" else 2**20
+    return { "wall_time" : wall_time,
+             "cpu_time"  : rusage.ru_utime + rusage.ru_stime,
+             "peak_rss"  : rusage.ru_maxrss / maxrss_per_GB }
+
+
+# distinguishes the cgroups of the stages an executor runs (see `runStage`)
+cgroup_ids = itertools.count()
+
+
 def runStage(*, clientURI    : str, stage,
-                cmd_wrapper  : str, fs_delay : float, check_outputs : bool, mkdirs : bool):
+                cmd_wrapper  : str, fs_delay : float, check_outputs : bool, mkdirs : bool,
+                hash_outputs : bool = False, result_cache : str = None,
+                enforce_mem  : str = "none", mem_limit_factor : float = None, stage_cgroups : StageCgroups = None,
+                threads      : int = None, cpus = None, scratch : ScratchSpace = None,
+                started      : Any = None, exited : Any = None):
+        """Run a stage in a child process (reported to `started`, if given, once started) using `threads`
+        threads (by default, its declared procs) and pinned to `cpus` (if given), optionally
+        confined to `mem_limit_factor` times its declared memory, by limiting its address space
+        (`enforce_mem="rlimit"`) or via a cgroup created in `stage_cgroups` (`enforce_mem="cgroup"`),
+        and writing its outputs to the node-local `scratch` space (if given and possible) to be copied back
+        once the process has `exited` (which is called, if given, to allow another stage to use the processors).
+        Returns the stage's index, its return code (or the exception raised while running it)
+        and its resource usage."""
         ix = stage.ix
+        cgroup = None
+        staged = None
 
         logger.info("Running stage %i (on %s). Memory requested: %.2f", ix, clientURI, stage.mem)
         try:
@@ -165,60 +261,150 @@ def runStage(*, clientURI    : str, stage,
 
             logger.info(command_to_run)
 
-            # TODO this isn't too efficient:
-            #   there is no global cache (yet) of the directories that have been created ...
+            # (the directories this worker has already created or seen aren't created again)
             if mkdirs:
-                os.makedirs(os.path.dirname(stage.log_file), exist_ok=True)
-                for d in set([os.path.dirname(f) for f in stage.output_files]):
-                    os.makedirs(d, exist_ok=True)
+                for d in set([os.path.dirname(f) for f in list(stage.output_files) + [stage.log_file]]):
+                    if d != '':
+                        known_directories.makedirs(d)
+
+            cache = ResultCache(result_cache) if result_cache else None
+            cache_key = (cache.key(stage.cmd, stage.input_files, stage.output_files, stage.env_vars)
+                         if cache is not None else None)
+            if cache_key is not None and cache.materialize(cache_key, stage.output_files):
+                logger.info("Stage %i: restored outputs from result cache entry %s", ix, cache_key)
+                with open(stage.log_file, 'a') as of:
+                    of.write("Stage " + str(ix) + ": outputs of " + command_to_run + " restored from "
+                             + cache.entry(cache_key) + " on " + socket.gethostname()
+                             + " at " + datetime.isoformat(datetime.now(), " ") + "\n")
+                # no resources were used, so there's nothing here for the server's history
+                return ix, 0, { "cached" : True,
+                                "outputs" : { o : output_record(o, with_hash=hash_outputs)
+                                              for o in stage.output_files } }
 
             # log file for the stage
             with open(stage.log_file, 'a') as of:
                 of.write("Stage " + str(ix) + " running on " + socket.gethostname()
                          + " (" + clientURI + ") at " + datetime.isoformat(datetime.now(), " ") + ":\n")
                 of.write(command_to_run + "\n")
-                of.flush()
 
                 #args = shlex.split(command_to_run)
                 args = command_to_run
+                staged = (scratch.stage(stage.cmd, stage.input_files, stage.output_files)
+                          if scratch is not None else None)
+                if staged is not None:
+                    args = ((cmd_wrapper + ' ') if cmd_wrapper else '') + ' '.join(staged.cmd)
+                    of.write("[executor] running in node-local scratch space as: " + args + "\n")
+                of.flush()
+                output_start = of.tell()
                 start_time = time.time()
 
                 environment = os.environ.copy()
+                for key in THREAD_COUNT_VARIABLES:
+                    environment[key] = str(threads or stage.procs)
                 for key in stage.env_vars.keys():
                     environment[key]=stage.env_vars[key]
 
-                process = subprocess.Popen(args, stdout=of, stderr=of, shell=True, env=environment)
-                #client.addPIDtoRunningList(process.pid)
-                process.communicate()
-                #client.removePIDfromRunningList(process.pid)
-                ret = process.returncode
+                oom_kills_before = cgroup_oom_kill_count()
+
+                rlimit = memory_limit(stage.mem, mem_limit_factor) if enforce_mem == "rlimit" else None
+                if enforce_mem == "cgroup":
+                    cgroup = stage_cgroups.create("stage-%d-%d" % (os.getpid(), next(cgroup_ids)),
+                                                  memory_limit(stage.mem, mem_limit_factor))
+                # the shell running the command waits (see `gated_command`) until we've confined it
+                confined = (rlimit, cgroup, cpus) != (None, None, None)
+
+                # (in a new session, so that the executor can kill the stage's whole process group)
+                process = subprocess.Popen(gated_command(args) if confined else args,
+                                           stdin=subprocess.PIPE if confined else None,
+                                           stdout=of, stderr=of, shell=True, env=environment,
+                                           start_new_session=True)
+                if started is not None:
+                    started(process)
+                if confined:
+                    try:
+                        confine(process.pid, rlimit=rlimit, cgroup=cgroup, cpus=cpus)
+                        process.stdin.write(b"\n")
+                    except OSError:
+                        # (so the shell exits without running the command)
+                        process.stdin.close()
+                        process.wait()
+                        raise
+                    process.stdin.close()
+                # reap the child ourselves instead of calling process.communicate()
+                # in order to find out how much time and memory it used:
+                _, status, rusage = os.wait4(process.pid, 0)
+                ret = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+                process.returncode = ret
+                usage = usage_from_rusage(rusage, wall_time=time.time() - start_time)
+                if rlimit is not None:
+                    # (for `failure_cause`, since running out of address space doesn't OOM-kill anything)
+                    usage["rlimit"] = rlimit / 2**30
+                    if ret != 0:
+                        usage["allocation_failed"] = reports_allocation_failure(stage.log_file, output_start)
+                if exited is not None:
+                    exited()
+                # (so only complete outputs ever appear in the pipeline directory)
+                if staged is not None and ret == 0:
+                    scratch.copy_back(staged)
+                cgroup_usage = StageCgroups.usage(cgroup) if cgroup is not None else {}
+                if cgroup_usage.get("oom_kills") is not None:
+                    usage["oom_kills"] = cgroup_usage["oom_kills"]
+                else:
+                    oom_kills_after = cgroup_oom_kill_count()
+                    # other stages run in the same cgroup, so this is only a hint
+                    # (but one that's combined with the return code by `failure_cause`):
+                    usage["oom_kills"] = (oom_kills_after - oom_kills_before
+                                          if None not in (oom_kills_before, oom_kills_after) else None)
+                # the peak of all of the stage's processes together, not just of the largest
+                if cgroup_usage.get("peak_mem") is not None:
+                    usage["peak_rss"] = max(usage["peak_rss"], cgroup_usage["peak_mem"])
                 if ret == 0:
-                    time.sleep(fs_delay)  # TODO: better: async wait with timeout=fs_delay on all output files?
-                    # TODO: better logic here, e.g., allow some tolerance for NFS slowness, etc.
-                    missing_outputs = [o for o in stage.output_files
-                                       if (not os.path.exists(o)) or os.path.getmtime(o) < start_time]
+                    # rather than always sleeping for fs_delay to allow for NFS slowness, wait (at most that long)
+                    # only until the outputs are visible, which those written on this host usually are at once
+                    missing_outputs = wait_for_outputs(stage.output_files, since=start_time, timeout=fs_delay)
+                    # stat each output once more for the server's restart manifest
+                    usage["outputs"] = { o : output_record(o, with_hash=hash_outputs) for o in stage.output_files }
                     if len(missing_outputs) > 0:
                         logger.warning("some outputs not produced by Stage %i: %s", ix, missing_outputs)
                         if check_outputs:
                           of.write("[executor] ERROR: outputs not produced, failing this stage: %s\n" % missing_outputs)
                           raise MissingOutputs(missing_outputs)
+                    elif cache_key is not None:
+                        # a failure to cache results shouldn't fail the stage that produced them
+                        try:
+                            cache.store(cache_key, stage.output_files, cmd=stage.cmd)
+                        except OSError:
+                            logger.exception("Unable to add the outputs of stage %i to the result cache", ix)
         except Exception as e:
             logger.exception("Exception whilst running stage: %i (on %s)", ix, clientURI)
-            return ix, e
+            return ix, e, None
         else:
             # TODO: the big try-catch block above is quite ugly ...
-            logger.info("Stage %i finished, return was: %i (on %s)", ix, ret, clientURI)
+            logger.info("Stage %i finished, return was: %i (on %s); wall time %.1fs, CPU time %.1fs, peak RSS %.3fG",
+                        ix, ret, clientURI, usage["wall_time"], usage["cpu_time"], usage["peak_rss"])
 
-            return ix, ret
+            return ix, ret, usage
+        finally:
+            if cgroup is not None:
+                StageCgroups.remove(cgroup)
+            if staged is not None:
+                scratch.discard(staged)
 
 
 class ChildProcess(object):
     """Used by the executor to store runtime information about the child processes it initiates to run commands."""
     def __init__(self, stage, result, mem, procs):
+        # (the StageInfo, whose index is changed if we reattach to a new server
+        # and set to None if the new server doesn't take the stage over)
         self.stage = stage
+        # (the thread supervising the stage)
         self.result = result
         self.mem = mem
         self.procs = procs
+        # the stage's process, once started
+        self.process = None
+        # identifies the stage to a new server (see `pipelineExecutor.reattach`)
+        self.hash = command_hash(stage.cmd)
 
 class InsufficientResources(Exception):
     pass
@@ -254,6 +440,18 @@ class pipelineExecutor(object):
         self.uri_file = options.urifile
         self.fs_delay = options.fs_delay
         self.check_outputs = options.check_outputs
+        self.hash_outputs = options.hash_outputs
+        self.result_cache = options.result_cache
+        # how (if at all) stages are confined to their declared memory (see `initializeStageLimits`)
+        self.enforce_stage_mem = options.enforce_stage_mem
+        self.stage_mem_limit_factor = options.stage_mem_limit_factor
+        self.stage_cgroups = None  # type: StageCgroups
+        # whether to pin each stage to the processors it's given (see `initializeStageLimits`)
+        self.pin_stages = options.pin_stages
+        # node-local staging of stages' outputs (see `initializeScratch`)
+        self.scratch_dir = options.scratch_dir
+        self.scratch_size = options.scratch_size
+        self.scratch = None  # type: ScratchSpace
         if self.uri_file is None:
             self.uri_file = os.path.abspath(os.path.join(os.curdir, uri_file))
         # the next variable is used to keep track of how long the
@@ -267,14 +465,21 @@ class pipelineExecutor(object):
         self.max_idle_time = options.max_idle_time
         # the time in minutes after which an executor will not accept new jobs
         self.time_to_accept_jobs = options.time_to_accept_jobs
+        # the time in minutes for which we keep running our stages after losing the server,
+        # waiting for a new one to reattach to (see `reattach`)
+        self.reattach_time = options.reattach_time
         # stores the time of connection with the server
         self.connection_time_with_server = None
         #initialize runningMem and Procs
         self.runningMem = 0.0
         self.runningProcs = 0   
         self.runningChildren = {}  # was: # no scissors (i.e. children should not run around with sharp objects...)
+        # keys of runningChildren (not stage indices, which change if we reattach to a new server)
+        self.child_ids = itertools.count()
         self.lock = Lock()
-        self.pool = None  # type: Pool
+        # the processors taken by the running stages; a stage waits for as many as it uses
+        # (which the server should already have accounted for, but e.g. a server we've reattached to may not have)
+        self.slots = ProcSlots(self.procs)
         self.pyro_proxy_for_server = None
         self.clientURI = None
         self.serverURI = None
@@ -285,26 +490,46 @@ class pipelineExecutor(object):
         # than one event (for reclaiming, server messages, ...)
         self.e = threading.Event()
         self.heartbeat_tick = 0
+        # reports of terminated stages not yet sent to the server (see `reportStageTerminated`)
+        self.stage_reports = []
+        self._thread_local = threading.local()
+
+    def proxyForServer(self):
+        """A connection to the server for use by the current thread.
+        We found that connecting to the server via the same proxy using several
+        Process-es can bring down either or both the server and the client
+        (the documentation also states that proxies can't be shared between
+        threads), so rather than one proxy per executor we keep one per thread (and process),
+        which saves setting up a new connection for every call."""
+        proxy = getattr(self._thread_local, "proxy", None)
+        if proxy is None or self._thread_local.pid != os.getpid():
+            proxy = self._thread_local.proxy = transport.connect(self.serverURI)
+            self._thread_local.pid = os.getpid()
+        return proxy
+
+    def dropProxyForServer(self):
+        proxy = getattr(self._thread_local, "proxy", None)
+        self._thread_local.proxy = None
+        if proxy is not None:
+            try:
+                proxy._pyroRelease()
+            except Exception:
+                pass
 
     def wrapPyroCall(self, func, *args, **kwargs):
         try:
-            # a bit expensive perhaps, but it is safer to create
-            # a new proxy for the server whenever it is contacted.
-            # We found that connecting to the server via the same proxy using several
-            # Process-es, can bring down either or both the server and the client
-            # (the documentation also states that proxies can only be shared between
-            # threads).
             # also, note Ben and his bag of tricks! When a function on the server
             # side needs to be called, and wrapPyroCall is invoked, we do this
             # using the lambda functionality. Below the lambda p: p.call_at_the_server
-            # will pass the new proxy to p. At the same time, pycharm is still able
+            # will pass the proxy to p. At the same time, pycharm is still able
             # to type check things.
             logger.debug("wrapPyroCall: %s", func)
-            with Pyro4.Proxy(self.serverURI) as one_time_proxy:
-                return func(one_time_proxy)(*args, **kwargs)
+            return func(self.proxyForServer())(*args, **kwargs)
         except:
+            # the connection may be broken, so don't reuse it
+            self.dropProxyForServer()
             logger.exception("Exception while placing a Pyro call at the server: %s", func)
-            raise Exception("Pyro call with the server failed. Shutting down...")
+            raise ServerLost("Pyro call with the server failed")
 
     def registeredWithServer(self):
         self.registered_with_server = True
@@ -317,9 +542,43 @@ class pipelineExecutor(object):
     #def removePIDfromRunningList(self, pid):
     #    self.current_running_job_pids.remove(pid)
 
-    def initializePool(self):
-        self.pool = Pool(processes = self.procs)
+    def initializeScratch(self):
+        if self.scratch_dir is not None:
+            try:
+                self.scratch = ScratchSpace(self.scratch_dir, max_size=int(self.scratch_size * 2**30))
+            except OSError as e:
+                logger.warning("Unable to use %s as scratch space (%s); not staging stages' outputs",
+                               self.scratch_dir, e)
+            else:
+                logger.info("Staging stages' outputs in %s", self.scratch.dir)
+
+    def closeScratch(self):
+        if self.scratch is not None:
+            self.scratch.close()
+
+    def initializeStageLimits(self):
+        if self.pin_stages:
+            nodes = pinnable_cpus(self.procs)
+            if nodes is None:
+                logger.warning("Fewer than %d CPUs available; not pinning stages to CPUs", self.procs)
+                self.pin_stages = False
+            else:
+                logger.info("Pinning stages to CPUs %s (by NUMA node)", nodes)
+                self.slots = ProcSlots(self.procs, nodes=nodes)
+        if self.enforce_stage_mem == "cgroup":
+            try:
+                self.stage_cgroups = StageCgroups.delegated("executor-%d" % os.getpid())
+            except OSError as e:
+                logger.warning("Unable to create a cgroup per stage (%s); limiting their address space instead", e)
+                self.enforce_stage_mem = "rlimit"
         
+    #@Pyro4.oneway
+    def wakeUp(self):
+        """Called by the server when stages we might be able to run have become runnable,
+        so that we check in without waiting for the end of the main loop interval."""
+        logger.debug("Woken up by the server")
+        self.e.set()
+
     def setClientURI(self, cURI):
         self.clientURI = cURI 
             
@@ -332,18 +591,21 @@ class pipelineExecutor(object):
     # TODO rename completeAndExitChildren,generalShutdownCall to something like
     # normalShutdown, dirtyShutdown
     def generalShutdownCall(self):
-        # FIXME this comment is outdated (but is the problem described still a problem?)
-        # stop the worker processes (children) immediately without completing outstanding work
-        # Initially I wanted to stop the running processes using pool.terminate() and pool.join()
-        # but the keyboard interrupt handling proved tricky. Instead, the executor now keeps
-        # track of the process IDs (pid) of the current running jobs. Those are targeted by
-        # os.kill in order to stop the processes in the Pool
+        # stop the running stages immediately without completing outstanding work:
+        # each stage runs in its own session, so kill its whole process group
         logger.info("Executor shutting down.  Killing running jobs...")
-        #for subprocID in self.current_running_job_pids:
-        #    os.kill(subprocID, signal.SIGTERM)
-        self.pool.terminate()
-        self.pool.join()
-        logger.debug("Finished joining process pool.")
+        with self.lock:
+            children = list(self.runningChildren.values())
+        for child in children:
+            if child.process is not None and child.process.returncode is None:
+                try:
+                    os.killpg(child.process.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        for child in children:
+            child.result.join(EXECUTOR_MAIN_LOOP_INTERVAL)
+        logger.debug("Finished joining the stages' threads.")
+        self.closeScratch()
         # FIXME the death of the child process causes runStage
         # to notify the server of the job's destruction
         # so the job is no longer in the client's set of stages
@@ -352,14 +614,20 @@ class pipelineExecutor(object):
 
     def completeAndExitChildren(self):
         # This function is called under normal circumstances (i.e., not because
-        # of a keyboard interrupt). So we can close the pool of processes 
-        # in the normal way, prevent more jobs from starting, and exit
+        # of a keyboard interrupt). So we can wait for the running stages
+        # in the normal way (no more are started), and exit
+        with self.lock:
+            children = list(self.runningChildren.values())
+        if len(children) > 0:
+            logger.warning("Exiting with some processes still running: %s" % children)
+        for child in children:
+            child.result.join()
+        self.closeScratch()
+        # tell the server about any stages which finished in the meantime
+        # (before unregistering, since the server would otherwise consider them lost)
+        if self.registered_with_server and len(self.stage_reports) > 0:
+            self.checkInWithServer(want_work=False)
         self.unregister_with_server()
-        if len(self.runningChildren) > 0:
-            logger.warning("Exiting with some processes still running: %s" % self.runningChildren)
-        # wait for the worker processes (children) to exit (must be called after terminate() or close())
-        self.pool.close()
-        self.pool.join()
 
     def unregister_with_server(self):
         if self.registered_with_server:
@@ -474,24 +742,46 @@ class pipelineExecutor(object):
     #            self.runningProcs -= child.procs
     #            self.runningChildren.remove(child)
 
-    #@Pyro4.oneway
-    def notifyStageTerminated(self, i, returncode=None):
-        #try:
-            if returncode == 0:
-                logger.debug("Setting stage %d finished on the server side", i)
-                self.wrapPyroCall(lambda p: p.setStageFinished, i, self.clientURI)
-                logger.debug("Done setting stage finished")
-            else:
-                # a None returncode is also considered a failure
-                logger.debug("Setting stage %d failed on the server side. Return code: %s", i, returncode)
-                self.wrapPyroCall(lambda p: p.setStageFailed, i, self.clientURI)
-                logger.debug("Done setting stage failed")
-            # the server may have shutdown or otherwise become unavailable
-            # (currently this is expected when a long-running job completes;
-            # we should add a more elegant check for this state of affairs),
-            # but the executor may have running jobs that shouldn't be killed
-            # TODO add similar error handling around certain other Pyro calls)
-            self.e.set()  # some work finished and server notified, so wake up
+    def reportStageTerminated(self, child, returncode=None, usage=None):
+        """Queue a report of the termination of a child's stage, to be sent to the server
+        with our next check-in (see `checkInWithServer`), and wake up the main loop to send it."""
+        # a None returncode is also considered a failure
+        cause = failure_cause(returncode, usage) if returncode != 0 else None
+        with self.lock:
+            # (read the index with the lock held since `reattach` may change it)
+            i = child.stage.ix
+            if i is not None:
+                self.stage_reports.append({ "ix" : i, "hash" : child.hash, "returncode" : returncode,
+                                            "usage" : usage, "cause" : cause })
+        if i is None:
+            logger.info("Stage %s terminated, but the server we've reattached to didn't take it over, "
+                        "so not reporting it", child.stage.cmd[0])
+        else:
+            logger.debug("Stage %d terminated. Return code: %s (%s)", i, returncode, cause)
+        self.e.set()  # some work finished, so wake up
+
+    def checkInWithServer(self, want_work):
+        """Our single call to the server per main loop iteration: send a heartbeat and the reports
+        of stages which have terminated since the last call, and (if `want_work`) ask for as many stages
+        as fit into our free resources.  Returns the server's command and a list of `StageInfo`s."""
+        with self.lock:
+            reports, self.stage_reports = self.stage_reports, []
+            mem_free = self.mem - self.runningMem if want_work else 0
+            procs_free = self.procs - self.runningProcs if want_work else 0
+        logger.debug("Checking in with the server (heartbeat tick: %d, %d stage reports)",
+                     self.heartbeat_tick, len(reports))
+        try:
+            cmd, stages = self.wrapPyroCall(lambda p: p.executorCheckIn, self.clientURI,
+                                            tick=self.heartbeat_tick, stage_reports=reports,
+                                            clientMemFree=mem_free, clientProcsFree=procs_free)
+        except:
+            # put the reports back so they aren't lost if we get to try again
+            with self.lock:
+                self.stage_reports = reports + self.stage_reports
+            raise
+        self.heartbeat_tick += 1
+        logger.debug("Done checking in: %s %s", cmd, [s.ix for s in stages])
+        return cmd, stages
 
     def idle(self):
         return self.runningMem == 0 and self.runningProcs == 0 and self.prev_time
@@ -499,11 +789,78 @@ class pipelineExecutor(object):
     # use an event set/timeout system to run the executor mainLoop -
     # we might want to pass some extra information in addition to waking the system
     def mainLoop(self):
-        while self.mainFn():
+        while True:
+            try:
+                if not self.mainFn():
+                    break
+            except ServerLost:
+                if not self.reattach():
+                    raise
+                continue
             self.e.wait(EXECUTOR_MAIN_LOOP_INTERVAL)
             self.e.clear()
         logger.info("Main loop finished")
 
+    def reattach(self):
+        """Having lost the server (e.g., because it ran out of walltime and a new one has been submitted),
+        keep running our stages while waiting (for up to --reattach-time minutes) for a server to
+        register with, telling it which stages we're still running and which have terminated meanwhile
+        (see `Pipeline.reattachClient`).  Returns whether we've reattached."""
+        if not self.reattach_time:
+            return False
+        self.registered_with_server = False
+        self.dropProxyForServer()
+        start = time.time()
+        logger.warning("Lost the server; running our %d stages while waiting up to %.1f minutes for a new one",
+                       len(self.runningChildren), self.reattach_time)
+        while True:
+            with self.lock:
+                busy = len(self.runningChildren) > 0 or len(self.stage_reports) > 0
+            # without stages to run or report, wait no longer than we would for work
+            limit = (self.reattach_time if busy or self.max_idle_time is None
+                     else min(self.reattach_time, self.max_idle_time))
+            remaining = start + limit * 60 - time.time()
+            if remaining <= 0:
+                logger.warning("No server to reattach to after %.1f minutes; giving up", (time.time() - start) / 60)
+                return False
+            # (woken early when a stage finishes, which is as good a time as any to try again)
+            self.e.wait(min(EXECUTOR_MAIN_LOOP_INTERVAL, remaining))
+            self.e.clear()
+            try:
+                self.reattach_to(str(find_server_uri(self)))
+            except Exception as e:
+                # as expected while the old server's URI is still in the uri file
+                logger.debug("Unable to reattach (%s: %s)", type(e).__name__, e)
+                continue
+            return True
+
+    def reattach_to(self, serverURI):
+        with self.lock:
+            children = list(self.runningChildren.values())
+            reports = list(self.stage_reports)
+        proxy = transport.connect(serverURI)
+        try:
+            # (reports of the stages the server doesn't take over are dropped by the server)
+            adopted = proxy.reattachClient(self.clientURI, self.mem, running=[c.hash for c in children],
+                                           stage_reports=reports)
+        finally:
+            try:
+                proxy._pyroRelease()
+            except Exception:
+                pass
+        with self.lock:
+            # the reports sent above have been dealt with; renumber the stages the new server has taken over
+            # (including those which terminated while we were reattaching) and disown the rest
+            del self.stage_reports[:len(reports)]
+            for c in children:
+                c.stage.ix = adopted.get(c.hash)
+            self.stage_reports = [dict(r, ix=adopted[r["hash"]]) for r in self.stage_reports if r["hash"] in adopted]
+            self.serverURI = serverURI
+            self.registered_with_server = True
+        self.idle_time = 0
+        logger.info("Reattached to the server at %s, which has taken over %d of our %d running stages",
+                    serverURI, len(adopted), len(children))
+
     def mainFn(self):
         """Try to get a job from the server (if appropriate) and update
         internal state accordingly.  Return True if it should be called
@@ -514,7 +871,7 @@ class pipelineExecutor(object):
         self.current_time = time.time()
 
         # a bit coarse but we can't call `free_resources` directly in a function
-        # such as notifyStageTerminated which is called from _within_ `runStage`
+        # such as reportStageTerminated which is called from _within_ `runStage`
         # since resources won't be freed soon enough, causing a false resource starvation.
         # note we don't do resource accounting after leaving mainLoop, though that
         # doesn't matter too much as there will never be new jobs
@@ -522,104 +879,113 @@ class pipelineExecutor(object):
         # to other servers)
         #self.free_resources()
 
-        logger.debug("Updating timestamp with heartbeat tick: %d", self.heartbeat_tick)
-        self.wrapPyroCall(lambda p: p.updateClientTimestamp, self.clientURI, tick=self.heartbeat_tick)
-        self.heartbeat_tick += 1
-        logger.debug("Done updating timestamp")
-
         if self.idle():
             self.idle_time += self.current_time - self.prev_time
             logger.debug("Current idle time: %d, and total seconds allowed: %d",
                          self.idle_time, self.max_idle_time * 60)
 
-        if self.is_max_idle_time():
+        # It is possible that the executor does not accept any new jobs
+        # anymore. If that is the case, we just wait until current running jobs (children) have finished
+        # (but still send heartbeats and report finished stages)
+        time_to_drain = self.is_time_to_drain()
+        if time_to_drain:
+            logger.debug("Time expired for accepting new jobs")
+
+        # a heartbeat, the reports of any stages which have finished, and a request for work, all in one call:
+        # the server packs as many runnable stages as fit into our free resources,
+        # so we can start all of them without waiting for another event/timeout
+        max_idle = self.is_max_idle_time()
+        cmd, stages = self.checkInWithServer(want_work=not (max_idle or time_to_drain))
+
+        if max_idle:
             logger.warning("Exceeded allowed idle time ... bye!")
             return False
 
-        # It is possible that the executor does not accept any new jobs
-        # anymore. If that is the case, we can leave this main loop
-        # and just wait until current running jobs (children) have finished
-        if self.is_time_to_drain():
-            logger.debug("Time expired for accepting new jobs")  #...leaving main loop.")
-            # was logger.info; made this a debug since we currently don't bail out of the loop ...
-            #return False
-            return True
-
-        # TODO we get only one stage per loop iteration, so we have to wait for
-        # another event/timeout to get another.  In general we might want 
-        # getCommand to order multiple stages to be run on the same server
-        # (just setting the event immediately would be somewhat hackish)
-        # FIXME send/get the whole stageinfo here (it contains an `ix` field, right?)?!
-        logger.debug("Going to get command from server")
-        cmd, i = self.wrapPyroCall(lambda p: p.getCommand, clientURIstr=self.clientURI,
-                                                           clientMemFree=self.mem - self.runningMem,
-                                                           clientProcsFree=self.procs - self.runningProcs)
-        logger.debug("Done getting command from server")
-
         if cmd == "shutdown_normally":
             logger.info('Saw shutdown command from server')
             return False
+        elif cmd == "shutdown_abnormally":
+            # e.g., the server is out of walltime; we may be able to reattach to the next one
+            raise ServerLost("the server is shutting down")
         # TODO this won't work yet since we'll just go to shutdown normally
         # and wait for jobs to finish instead of killing them -
         # maybe throwing an exception is better?
         elif cmd == "wait":
             return True
-        elif cmd == "run_stage":
-            logger.debug("Going to get stage info for stage: %d", i)
-            stage = self.wrapPyroCall(lambda p: p.get_stage_info,i)
-            logger.debug("Done getting stage information for stage: %d", i)
-            # we trust that the server has given us a stage
-            # that we have enough memory and processors to run ...
-            # reset the idle time, we are running a stage!
+        elif cmd == "run_stages":
+            # reset the idle time, we are running stages!
             self.idle_time = 0
-            with self.lock:
-                self.runningMem += stage.mem
-                self.runningProcs += stage.procs
-            # The multiprocessing library must pickle things in order to execute them.
-            # I wanted the following function (runStage) to be a function of the pipelineExecutor
-            # class. That way we can access self.serverURI and self.clientURI from
-            # within the function. However, bound methods are not picklable (a bound method
-            # is a method that has "self" as its first argument, because if I understand 
-            # this correctly, that binds the function to a class instance). There is
-            # a way to make a bound function picklable, but this seems cumbersome. So instead
-            # runStage is now a standalone function.
-
-            # callback for result of runStage, run by executor
-            def process_result(result):
-                ix, res = result
-                if isinstance(res, int):
-                    # it's a return code
-                    # don't do this logging in the callback for politeness
-                    self.notifyStageTerminated(ix, res)
-                elif isinstance(res, Exception):
-                    # runStage raised an exception.  We could use apply_async's error_callback to handle this case
-                    # instead, but we need to know the index of the stage we were attempting to run, so we'd have
-                    # to catch the exception anyway to stuff the index into it ... this seems cleaner (no re-raising).
-                    self.notifyStageTerminated(ix)
-                logger.debug("Freeing up resources for stage %i.", ix)
-                stage = self.runningChildren[ix]
-                with self.lock:
-                    self.runningMem -= stage.mem
-                    self.runningProcs -= stage.procs
-                del self.runningChildren[ix]
-
-            # why does this need a separate call? should be able to infer that this stage will start from getCommand...
-            logger.debug("Telling the server that stage %d has started", i)
-            self.wrapPyroCall(lambda p: p.setStageStarted, i, self.clientURI)
-            logger.debug("Server knows that stage started")
-            result = self.pool.apply_async(runStage, args=(),
-                                           kwds={ "clientURI" : self.clientURI, "stage" : stage,
-                                                  "cmd_wrapper" : self.cmd_wrapper,
-                                                  "fs_delay" : self.fs_delay, "check_outputs" : self.check_outputs,
-                                                  "mkdirs" : self.defer_directory_creation },
-                                           callback=process_result)
-            self.runningChildren[i] = ChildProcess(i, result, stage.mem, stage.procs)
-
-            logger.debug("Added stage %i to the running pool.", i)
+            for stage in stages:
+                self.launchStage(stage)
             return True
         else:
             raise Exception("Got invalid cmd from server: %s" % cmd)
-                
+
+    def launchStage(self, stage):
+        """Start running a stage (given to us by the server, which already considers it started)
+        as a child process supervised by a thread of ours, once enough of our processors are free."""
+        i = stage.ix
+        # we trust that the server has given us a stage
+        # that we have enough memory and processors to run ...
+        with self.lock:
+            self.runningMem += stage.mem
+            self.runningProcs += stage.procs
+        # ... but don't oversubscribe our processors if it hasn't (see `ProcSlots`)
+
+        key = next(self.child_ids)
+        child = ChildProcess(stage, None, stage.mem, stage.procs)
+
+        # callback for result of runStage, run by executor
+        def process_result(result):
+            ix, res, usage = result
+            logger.debug("Freeing up resources for stage %i.", ix)
+            with self.lock:
+                self.runningMem -= child.mem
+                self.runningProcs -= child.procs
+                del self.runningChildren[key]
+            if isinstance(res, int):
+                # it's a return code
+                self.reportStageTerminated(child, res, usage)
+            elif isinstance(res, Exception):
+                # runStage raised an exception.  We could use apply_async's error_callback to handle this case
+                # instead, but we need to know the index of the stage we were attempting to run, so we'd have
+                # to catch the exception anyway to stuff the index into it ... this seems cleaner (no re-raising).
+                self.reportStageTerminated(child)
+
+        def supervise():
+            procs = self.slots.acquire(stage.procs, blocking=False)
+            if not procs:
+                logger.warning("Stage %i waiting for %d processors to become free", i, stage.procs)
+                procs = self.slots.acquire(stage.procs)
+            def release():
+                # (once, when the stage's process exits or, failing that, runStage returns)
+                nonlocal procs
+                if procs:
+                    self.slots.release(procs)
+                    procs = None
+            try:
+                result = runStage(clientURI=self.clientURI, stage=stage, cmd_wrapper=self.cmd_wrapper,
+                                  fs_delay=self.fs_delay, check_outputs=self.check_outputs,
+                                  hash_outputs=self.hash_outputs, result_cache=self.result_cache,
+                                  mkdirs=self.defer_directory_creation,
+                                  enforce_mem=self.enforce_stage_mem, mem_limit_factor=self.stage_mem_limit_factor,
+                                  stage_cgroups=self.stage_cgroups,
+                                  threads=len(procs), cpus=procs if self.pin_stages else None,
+                                  scratch=self.scratch,
+                                  started=lambda process: setattr(child, "process", process), exited=release)
+            finally:
+                release()
+            process_result(result)
+
+        # (added before the stage starts since it may finish before `start` returns)
+        with self.lock:
+            self.runningChildren[key] = child
+
+        child.result = threading.Thread(target=supervise, name="stage-%d" % i, daemon=True)
+        child.result.start()
+
+        logger.debug("Started stage %i.", i)
+
 
 def main():
     # command line option handling
@@ -113,7 +113,7 @@ class runOnQueueingSystem():
                 for i in range(1, self.numexec):
                     self.createAndSubmitExecutorJobFile(i, time=t, after=serverJobId)
             # in principle a server could overlap the previous generation of clients,
-            # but at present the clients just die within seconds
+            # but at present the clients just die within seconds (unless given a --reattach-time)
     def createAndSubmitMainJobFile(self,time, afterany=None):
         return self.constructAndSubmitJobFile("-pipeline-",time, isMainFile=True, afterany=afterany)
     def createAndSubmitExecutorJobFile(self, i, time, after):
@@ -0,0 +1,70 @@
+import os
+import time
+
+from typing import Iterable, List
+
+# the interval between checks of the outputs which aren't visible yet starts at POLL_INITIAL_INTERVAL
+# and doubles after each check, up to POLL_MAX_INTERVAL
+POLL_INITIAL_INTERVAL = 0.05
+POLL_MAX_INTERVAL = 1.0
+
+
+def output_visible(path: str, since_ns: int) -> bool:
+    """Whether `path` exists and was modified at or after `since_ns` (nanoseconds since the epoch).
+    The file is opened (read-only) before checking, since on NFS opening a file makes the client
+    revalidate its cached attributes and directory entries (close-to-open consistency) rather than
+    use ones which may be up to `acregmax` seconds old.
+
+    >>> import tempfile
+    >>> f = os.path.join(tempfile.mkdtemp(), "out.xfm")
+    >>> output_visible(f, 0)
+    False
+    >>> open(f, 'w').close()
+    >>> output_visible(f, 0), output_visible(f, time.time_ns() + 10**10)
+    (True, False)
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        # e.g., not readable by us; we can still stat it
+        try:
+            return os.stat(path).st_mtime_ns >= since_ns
+        except FileNotFoundError:
+            return False
+    try:
+        return os.fstat(fd).st_mtime_ns >= since_ns
+    finally:
+        os.close(fd)
+
+
+def wait_for_outputs(paths: Iterable[str], since: float, timeout: float,
+                     initial_interval: float = POLL_INITIAL_INTERVAL,
+                     max_interval: float = POLL_MAX_INTERVAL) -> List[str]:
+    """Wait until all of `paths` are visible and have been modified since `since` (a time as returned by
+    `time.time()`, e.g., when the stage producing them started; only the whole second is used, as some
+    filesystems record mtimes to the second), polling with exponential backoff for up to `timeout` seconds.
+    Returns the paths which still aren't, so returns at once if the outputs are already visible,
+    as they usually are when written on this host.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> f = os.path.join(d, "out.mnc")
+    >>> open(f, 'w').close()
+    >>> wait_for_outputs([f], since=time.time(), timeout=60)
+    []
+    >>> [os.path.basename(p) for p in wait_for_outputs([f, os.path.join(d, "missing.mnc")], since=0, timeout=0.1)]
+    ['missing.mnc']
+    """
+    since_ns = int(since) * 10**9
+    pending = list(dict.fromkeys(paths))
+    deadline = time.time() + timeout
+    interval = initial_interval
+    while True:
+        pending = [p for p in pending if not output_visible(p, since_ns)]
+        remaining = deadline - time.time()
+        if len(pending) == 0 or remaining <= 0:
+            return pending
+        time.sleep(min(interval, remaining))
+        interval = min(2 * interval, max_interval)
@@ -0,0 +1,230 @@
+import concurrent.futures
+import hashlib
+import os
+import sqlite3
+
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+# how much of the start and end of a file `fast_hash` reads
+FAST_HASH_BLOCK = 1 << 20
+
+# number of threads used to stat files; on network filesystems stats are dominated by latency,
+# so many more threads than cores are useful
+STAT_THREADS = 32
+
+# (size in bytes, mtime in ns)
+FileStat = Tuple[int, int]
+
+
+def fast_hash(path: str) -> str:
+    """A cheap fingerprint of a file's contents: a hash of its size and of its first
+    and last FAST_HASH_BLOCK bytes (so it doesn't read all of large files)."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        h.update(str(size).encode())
+        h.update(f.read(FAST_HASH_BLOCK))
+        if size > 2 * FAST_HASH_BLOCK:
+            f.seek(-FAST_HASH_BLOCK, os.SEEK_END)
+            h.update(f.read(FAST_HASH_BLOCK))
+        elif size > FAST_HASH_BLOCK:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def output_record(path: str, with_hash: bool = False) -> Optional[List[Any]]:
+    """What an executor reports about an output file for the restart manifest:
+    [size, mtime_ns, content hash or None], or None if the file doesn't exist."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns, fast_hash(path) if with_hash else None]
+
+
+def command_hash(cmd: Iterable[str]) -> str:
+    """The hash identifying a stage in the finished-stages journal (see `CmdStage.getHash`);
+    since it depends only on the command, it's the same for the stage in a new server's pipeline
+    and can be computed by an executor from the command it was given.
+
+    >>> command_hash(["mincblur", "-fwhm", "0.5", "in.mnc", "out"])
+    'fb68a43d9a300d1829efcacb63155bcb'
+    """
+    # md5 rather than `hash`, which depends on the value of PYTHONHASHSEED
+    return hashlib.md5("".join(cmd).encode()).hexdigest()
+
+
+def write_running_stages(filename: str, hashes: Iterable[str]) -> None:
+    """Record the hashes of the stages still running when a server shuts down (e.g., at the end of its
+    walltime), so that the next server can wait for the executors running them to reattach
+    instead of running them again; removes any previous record if there are none.
+
+    >>> import tempfile
+    >>> f = os.path.join(tempfile.mkdtemp(), "running")
+    >>> write_running_stages(f, ["abc", "def"])
+    >>> hashes, written = take_running_stages(f)
+    >>> sorted(hashes), take_running_stages(f)
+    (['abc', 'def'], (frozenset(), None))
+    """
+    hashes = sorted(hashes)
+    if len(hashes) == 0:
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+        return
+    tmp = filename + ".tmp"
+    with open(tmp, 'w') as f:
+        f.write("".join(h + "\n" for h in hashes))
+    os.replace(tmp, filename)
+
+
+def take_running_stages(filename: str) -> Tuple[FrozenSet[str], Optional[float]]:
+    """Read (and remove) the record written by `write_running_stages`, if any;
+    returns the hashes and when they were written."""
+    try:
+        with open(filename) as f:
+            written = os.fstat(f.fileno()).st_mtime
+            hashes = frozenset(f.read().split())
+    except FileNotFoundError:
+        return frozenset(), None
+    os.remove(filename)
+    return hashes, written
+
+
+class RestartManifest(object):
+    """An index of the output files of finished stages (size, mtime and optionally a content hash,
+    as recorded when the stage finished) and of the mtimes of their directories, stored in SQLite.
+    On restart, `current_stats` finds the current state of a large number of files quickly,
+    stat-ing them in parallel.  Optionally (`trust_dirs`), since creating, deleting or renaming a file
+    changes its directory's mtime, the recorded stats of files in directories whose mtimes haven't
+    changed since `snapshot_dirs` are used without stat-ing the files themselves; however, modifying a file
+    in place doesn't change its directory's mtime, so such modifications then go unnoticed.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> f = os.path.join(d, "out.mnc")
+    >>> with open(f, 'w') as fh: _ = fh.write("voxels")
+    >>> m = RestartManifest(":memory:")
+    >>> m.record({ f : output_record(f) })
+    >>> m.snapshot_dirs()
+    >>> m.current_stats([f, os.path.join(d, "missing.mnc")])[f][0]
+    6
+    """
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        # as for StageHistory, connect lazily since the manifest may be used in a different process
+        self._conn = None  # type: Optional[sqlite3.Connection]
+        self._pid = None   # type: Optional[int]
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS outputs "
+                         "(path TEXT PRIMARY KEY, dir TEXT NOT NULL, size INTEGER, mtime_ns INTEGER, content_hash TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS outputs_dir ON outputs (dir)")
+            conn.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER)")
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return dict(self.__dict__, _conn=None, _pid=None)
+
+    def record(self, outputs: Dict[str, Optional[List[Any]]]) -> None:
+        """Record the output files of a finished stage (as given by `output_record`)."""
+        conn = self._connection()
+        conn.executemany("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)",
+                         [(path, os.path.dirname(path), r[0], r[1], r[2])
+                          for path, r in outputs.items() if r is not None])
+        conn.commit()
+
+    def recorded(self, paths: Iterable[str]) -> Dict[str, Tuple[int, int, Optional[str]]]:
+        conn = self._connection()
+        paths = list(paths)
+        result = {}  # type: Dict[str, Tuple[int, int, Optional[str]]]
+        # stay well under SQLite's limit on the number of parameters
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i + 500]
+            result.update((row[0], (row[1], row[2], row[3])) for row in conn.execute(
+                "SELECT path, size, mtime_ns, content_hash FROM outputs WHERE path IN (%s)"
+                % ",".join("?" * len(chunk)), chunk))
+        return result
+
+    def _dir_mtimes(self) -> Dict[str, int]:
+        return dict(self._connection().execute("SELECT path, mtime_ns FROM dirs").fetchall())
+
+    def snapshot_dirs(self) -> None:
+        """Record the current mtimes of the directories containing recorded outputs
+        (e.g., when the pipeline shuts down, after which nothing should be writing to them)."""
+        conn = self._connection()
+        dirs = [row[0] for row in conn.execute("SELECT DISTINCT dir FROM outputs")]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=STAT_THREADS) as pool:
+            mtimes = list(pool.map(_mtime_ns, dirs))
+        conn.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?)",
+                         [(d, m) for d, m in zip(dirs, mtimes) if m is not None])
+        conn.commit()
+
+    def current_stats(self, paths: Iterable[str], trust_dirs: bool = False) -> Dict[str, Optional[FileStat]]:
+        """The current (size, mtime_ns) of each of `paths` (None for those which don't exist).
+        A file whose mtime has changed but whose size and content hash match those recorded
+        is reported with its recorded mtime, since its contents haven't changed.
+        If `trust_dirs`, files in directories whose mtimes haven't changed aren't stat-ed (see above)."""
+        paths = set(paths)
+        recorded = self.recorded(paths)
+        dir_mtimes = self._dir_mtimes()
+        by_dir = {}  # type: Dict[str, List[str]]
+        for p in paths:
+            by_dir.setdefault(os.path.dirname(p), []).append(p)
+
+        def check_dir(d_files):
+            d, files = d_files
+            mtime = _mtime_ns(d)
+            if mtime is None:
+                return d, None, { f : None for f in files }
+            if trust_dirs and mtime == dir_mtimes.get(d) and all(f in recorded for f in files):
+                return d, mtime, { f : recorded[f][:2] for f in files }
+            return d, mtime, { f : _stat(f, recorded.get(f)) for f in files }
+
+        result = {}  # type: Dict[str, Optional[FileStat]]
+        new_dir_mtimes = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=STAT_THREADS) as pool:
+            for d, mtime, stats in pool.map(check_dir, by_dir.items()):
+                result.update(stats)
+                if mtime is not None and mtime != dir_mtimes.get(d):
+                    new_dir_mtimes.append((d, mtime))
+        # files we had to stat are now known, so update the manifest to make the next check faster
+        # (we record directory mtimes as observed before stat-ing their files, so any later change is noticed)
+        conn = self._connection()
+        conn.executemany("UPDATE outputs SET size = ?, mtime_ns = ? WHERE path = ?",
+                         [(st[0], st[1], p) for p, st in result.items()
+                          if st is not None and p in recorded and recorded[p][:2] != st])
+        conn.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?)", new_dir_mtimes)
+        conn.commit()
+        return result
+
+    def close(self) -> None:
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+
+def _mtime_ns(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _stat(path: str, recorded: Optional[Tuple[int, int, Optional[str]]]) -> Optional[FileStat]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if (recorded is not None and recorded[2] is not None
+          and st.st_size == recorded[0] and st.st_mtime_ns != recorded[1]
+          and fast_hash(path) == recorded[2]):
+        return recorded[0], recorded[1]
+    return st.st_size, st.st_mtime_ns
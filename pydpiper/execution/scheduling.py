@@ -0,0 +1,287 @@
+import bisect
+import collections
+import heapq
+import itertools
+import math
+import os
+import queue
+import threading
+
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from pydpiper.execution.graph import topological_order
+
+# tolerance used when comparing a stage's memory requirement against free memory
+MEM_EPSILON = 0.000001
+
+# very rough relative runtimes of the programs we commonly run (arbitrary units;
+# anything not listed here is assumed to be quick and gets weight 1).  These are only
+# used to order runnable stages, so they needn't be accurate, just roughly proportionate.
+DEFAULT_RUNTIME_WEIGHTS = {
+    "ANTS"                    : 100,
+    "antsRegistration"        : 100,
+    "dramms"                  : 100,
+    "elastix"                 : 50,
+    "rotational_minctracc.py" : 50,
+    "minctracc"               : 20,
+    "nu_correct"              : 10,
+    "nu_estimate"             : 10,
+    "pmincaverage"            : 10,
+    "mincbigaverage"          : 10,
+    "mincaverage"             : 5,
+    "mincblur"                : 2,
+    "mincresample"            : 2,
+}  # type: Dict[str, float]
+
+# programs producing only quality-control images, which are never needed by other stages
+# and so can safely wait until nothing more important is runnable
+LOW_PRIORITY_PROGRAMS = frozenset(["mincpik", "montage", "convert"])
+
+# priority given to stages running one of the LOW_PRIORITY_PROGRAMS
+LOW_PRIORITY = -1.0
+
+
+def program_name(stage) -> str:
+    return os.path.basename(stage.name)
+
+
+def default_runtime_estimate(stage) -> float:
+    return DEFAULT_RUNTIME_WEIGHTS.get(program_name(stage), 1)
+
+
+def critical_path_priorities(G, stages: List[Any],
+                             runtime_estimate: Callable[[Any], float] = default_runtime_estimate) -> List[float]:
+    """Compute a priority for each node of the stage graph `G` (a StageGraph or networkx DiGraph
+    whose nodes are the indices of `stages`): the length of the longest path from the node to the end of the pipeline,
+    weighted by each stage's estimated runtime.  Running the stages with the longest remaining
+    paths first gets the serialization points of a pipeline (e.g., the averages at the end of
+    each generation of a model-building procedure) going as early as possible.
+    Quality-control stages get a fixed low priority and don't lengthen their ancestors' paths."""
+    priorities = [0.0] * G.order()
+    for n in reversed(topological_order(G)):
+        if program_name(stages[n]) in LOW_PRIORITY_PROGRAMS:
+            priorities[n] = LOW_PRIORITY
+        else:
+            priorities[n] = runtime_estimate(stages[n]) + max([0.0] + [priorities[m] for m in G.successors(n)])
+    return priorities
+
+
+def new_stage_priorities(G, stages: List[Any], new: range,
+                         runtime_estimate: Callable[[Any], float] = default_runtime_estimate) -> List[float]:
+    """The priorities (as computed by `critical_path_priorities`) of the `new` stages of the stage graph
+    `G`, which have no successors among the others (e.g., having just been added to a pipeline still being
+    constructed), in time proportional to their number and edges rather than to the size of `G`.
+    The others' priorities may since have increased, as their paths through the new stages may be longer."""
+    priority = {}  # type: Dict[int, float]
+    remaining = { n : len(G.successors(n)) for n in new }
+    ready = [n for n in new if remaining[n] == 0]
+    while ready:
+        n = ready.pop()
+        if program_name(stages[n]) in LOW_PRIORITY_PROGRAMS:
+            priority[n] = LOW_PRIORITY
+        else:
+            priority[n] = runtime_estimate(stages[n]) + max([0.0] + [priority[m] for m in G.successors(n)])
+        for p in G.predecessors(n):
+            if p in remaining:
+                remaining[p] -= 1
+                if remaining[p] == 0:
+                    ready.append(p)
+    if len(priority) != len(new):
+        raise ValueError("the stage graph has a cycle")
+    return [priority[n] for n in new]
+
+
+class RunnableQueue(object):
+    """The set of runnable stages (represented by their indices in the pipeline),
+    indexed by their resource requirements.  Stages are kept in buckets keyed by
+    (memory, procs); the keys of the non-empty buckets are kept sorted by memory
+    and each bucket is a heap ordered by priority (highest first) and then by insertion.
+    Popping returns the highest-priority stage among those which fit, preferring
+    stages with larger memory requirements among equal priorities.  Since the number of distinct
+    resource requirements in a pipeline is tiny compared to the number of stages,
+    insertion, popping a stage which fits into given resources and looking up
+    the largest memory requirement are all cheap, unlike the previous
+    `set` + list of memory requirements which had to be scanned on every server loop.
+
+    >>> q = RunnableQueue()
+    >>> q.add(0, mem=2, procs=1); q.add(1, mem=8, procs=1); q.add(2, mem=2, procs=4)
+    >>> len(q), 1 in q, q.max_mem()
+    (3, True, 8)
+    >>> q.pop_fitting(mem=4, procs=1)
+    0
+    >>> q.pop_fitting(mem=4, procs=1) is None
+    True
+    >>> q.largest_mems(5)
+    [8, 2]
+    >>> q.add(3, mem=1, procs=1, priority=10); q.pop()
+    3
+    """
+    def __init__(self) -> None:
+        # (mem, procs) -> heap of (negated priority, sequence number, stage index)
+        self._buckets = {}  # type: Dict[Tuple[float, int], List[Tuple[float, int, int]]]
+        # sorted keys of the non-empty buckets
+        self._keys = []     # type: List[Tuple[float, int]]
+        # stage index -> bucket key (also used for membership tests)
+        self._where = {}    # type: Dict[int, Tuple[float, int]]
+        self._counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def __contains__(self, i: int) -> bool:
+        return i in self._where
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(list(self._where))
+
+    def add(self, i: int, mem: float, procs: int, priority: float = 0.0) -> None:
+        """Add stage `i` with the given requirements and priority;
+        adding a stage which is already present does nothing."""
+        if i in self._where:
+            return
+        key = (mem, procs)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = []
+            bisect.insort(self._keys, key)
+        heapq.heappush(bucket, (-priority, next(self._counter), i))
+        self._where[i] = key
+
+    def _pop_from(self, key: Tuple[float, int]) -> int:
+        bucket = self._buckets[key]
+        _, _, i = heapq.heappop(bucket)
+        if len(bucket) == 0:
+            del self._buckets[key]
+            del self._keys[bisect.bisect_left(self._keys, key)]
+        del self._where[i]
+        return i
+
+    def remove(self, i: int) -> bool:
+        """Remove stage `i` if present (e.g., when a reattaching executor turns out to be running it
+        already); returns whether it was.  Linear in the size of the stage's bucket, but rarely needed."""
+        key = self._where.pop(i, None)
+        if key is None:
+            return False
+        bucket = self._buckets[key]
+        bucket[:] = [entry for entry in bucket if entry[2] != i]
+        heapq.heapify(bucket)
+        if len(bucket) == 0:
+            del self._buckets[key]
+            del self._keys[bisect.bisect_left(self._keys, key)]
+        return True
+
+    def _fitting_keys(self, mem: float, procs: int) -> Iterator[Tuple[float, int]]:
+        hi = bisect.bisect_right(self._keys, (mem + MEM_EPSILON, math.inf))
+        return (key for key in self._keys[:hi] if key[1] <= procs)
+
+    def fits(self, mem: float, procs: int) -> bool:
+        """Is there a stage requiring at most `mem` memory and `procs` processors?"""
+        return any(True for _ in self._fitting_keys(mem, procs))
+
+    def pop_fitting(self, mem: float, procs: int) -> Optional[int]:
+        """Remove and return the highest-priority stage requiring at most `mem` memory
+        and `procs` processors (preferring stages with larger memory requirements
+        among those with equal priority), or None if no stage fits."""
+        best, best_key = None, None
+        for key in self._fitting_keys(mem, procs):
+            neg_priority, seq, _ = self._buckets[key][0]
+            rank = (neg_priority, -key[0], seq)
+            if best is None or rank < best:
+                best, best_key = rank, key
+        return self._pop_from(best_key) if best_key is not None else None
+
+    def pop(self) -> Optional[int]:
+        """Remove and return the highest-priority stage, or None if the queue is empty."""
+        return self.pop_fitting(math.inf, math.inf)
+
+    def peek_max(self) -> Optional[int]:
+        """Return (without removing) a stage with the largest memory requirement."""
+        if len(self._keys) == 0:
+            return None
+        return self._buckets[self._keys[-1]][0][2]
+
+    def max_mem(self) -> Optional[float]:
+        return self._keys[-1][0] if len(self._keys) > 0 else None
+
+    def largest_mems(self, n: int) -> List[float]:
+        """The memory requirements of (up to) the `n` stages requiring the most memory."""
+        mems = []  # type: List[float]
+        for key in reversed(self._keys):
+            if len(mems) >= n:
+                break
+            mems.extend([key[0]] * min(n - len(mems), len(self._buckets[key])))
+        return mems
+
+    def memory_requirements(self) -> Dict[float, int]:
+        """A summary of the runnable stages: a map from memory requirement to number of stages."""
+        summary = {}  # type: Dict[float, int]
+        for (mem, _procs), bucket in self._buckets.items():
+            summary[mem] = summary.get(mem, 0) + len(bucket)
+        return summary
+
+
+class BackgroundCalls(object):
+    """A bounded pool of (daemon) threads calling the functions given to `submit`, whose results
+    the owner picks up by calling `completed` -- e.g., so that the server can evaluate stages' runnable
+    hooks, which may read files on slow shared filesystems, without blocking its request loop.
+    Daemon threads are used so that a call stuck on an unresponsive filesystem can't
+    prevent the server from exiting.  The threads are (re)started in whichever process
+    first submits a call, since the server may run in a process forked after this is created.
+
+    >>> calls = BackgroundCalls(threads=2)
+    >>> calls.submit("a", lambda x: x * 2, 21)
+    >>> calls.wait("a", timeout=5)
+    True
+    >>> calls.completed()
+    [('a', 42, None)]
+    """
+    def __init__(self, threads: int) -> None:
+        self.threads = threads
+        self._pid = None      # type: Optional[int]
+        self._queue = None    # type: Any
+        self._done = None     # type: Any
+        self._cond = None     # type: Any
+
+    def _start(self) -> None:
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            self._done = collections.deque()
+            self._cond = threading.Condition()
+            for _ in range(self.threads):
+                threading.Thread(target=self._work, args=(self._queue, self._done, self._cond), daemon=True).start()
+
+    @staticmethod
+    def _work(q, done, cond) -> None:
+        while True:
+            key, f, args = q.get()
+            try:
+                result = (key, f(*args), None)
+            except Exception as e:
+                result = (key, None, e)
+            with cond:
+                done.append(result)
+                cond.notify_all()
+
+    def submit(self, key: Any, f: Callable[..., Any], *args: Any) -> None:
+        self._start()
+        self._queue.put((key, f, args))
+
+    def completed(self) -> List[Tuple[Any, Any, Optional[BaseException]]]:
+        """(key, result, exception) for each call which has finished since the last call to `completed`."""
+        if self._pid != os.getpid():
+            return []
+        results = []
+        while True:
+            try:
+                results.append(self._done.popleft())
+            except IndexError:
+                return results
+
+    def wait(self, key: Any, timeout: float) -> bool:
+        """Wait (up to `timeout` seconds) until the call with the given key has finished
+        (without removing its result); returns whether it has."""
+        if self._pid != os.getpid():
+            return False
+        with self._cond:
+            return self._cond.wait_for(lambda: any(k == key for k, _, _ in self._done), timeout=timeout)
@@ -0,0 +1,162 @@
+import itertools
+import os
+import re
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+class StagedStage(object):
+    """A stage's command rewritten to write its outputs to (and read the inputs we have cached from)
+    a node-local scratch directory, `work_dir`."""
+    def __init__(self, cmd: List[str], outputs: Dict[str, str], work_dir: str) -> None:
+        self.cmd = cmd
+        # shared path -> node-local path
+        self.outputs = outputs
+        self.work_dir = work_dir
+
+
+def _path_pattern(paths: Iterable[str]):
+    # (not followed by anything which could continue the path)
+    return re.compile("(?:%s)(?![\\w./-])" % "|".join(re.escape(p) for p in sorted(paths, key=len, reverse=True)))
+
+
+def rewrite(cmd: Sequence[str], paths: Dict[str, str]) -> List[str]:
+    """`cmd` with (the longest of overlapping) occurrences of the keys of `paths` replaced by their values,
+    except where they're only a prefix of a longer path.
+
+    >>> rewrite(["mincblur", "/o/a.mnc", "/o/a.mnc_blur", "CC[/o/a.mnc,/o/b.mnc,1,4]"],
+    ...         {"/o/a.mnc": "/s/1/a.mnc", "/o/a.mnc_blur": "/s/2/a.mnc_blur"})
+    ['mincblur', '/s/1/a.mnc', '/s/2/a.mnc_blur', 'CC[/s/1/a.mnc,/o/b.mnc,1,4]']
+    >>> rewrite(["cp", "/o/a.mnc.bak", "/o/a.mnc", "/o/a.mnc/x", "/o/a.mnc-1"], {"/o/a.mnc": "/s/1/a.mnc"})
+    ['cp', '/o/a.mnc.bak', '/s/1/a.mnc', '/o/a.mnc/x', '/o/a.mnc-1']
+    """
+    if len(paths) == 0:
+        return list(cmd)
+    pattern = _path_pattern(paths)
+    return [pattern.sub(lambda m: paths[m.group(0)], arg) for arg in cmd]
+
+
+class ScratchSpace(object):
+    """Node-local staging of stages' files in a directory (e.g., in /tmp or /dev/shm) below `root`:
+    stages write their outputs there, and these are copied back to the (shared) pipeline directory
+    when the stage has finished, before the stage is reported as finished (so the server and
+    its restart records only ever see complete outputs in the pipeline directory).
+    The outputs copied back are kept in a cache of up to `max_size` bytes, from which later stages
+    using them as inputs read them, as long as the copies in the pipeline directory haven't changed.
+    Each output is cached along with any other files the stage wrote next to it (e.g., the displacement
+    grid of a nonlinear transform), since a tool reading the output may look for them there."""
+    def __init__(self, root: str, max_size: int) -> None:
+        self.dir = tempfile.mkdtemp(prefix="pydpiper-scratch-", dir=root)
+        self.max_size = max_size
+        # shared path -> (node-local directory holding copies of it and of the files written next to it,
+        #                 { file name : (size, mtime_ns) of the shared copy when cached }, size); least recently used first
+        self.cached = OrderedDict()  # type: OrderedDict
+        self.size = 0
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def _new_dir(self, kind: str) -> str:
+        d = os.path.join(self.dir, "%s-%d" % (kind, next(self.ids)))
+        os.mkdir(d)
+        return d
+
+    def link_cached(self, path: str, dest_dir: str) -> bool:
+        """Hard-link the cached node-local copies of `path` and of the files written next to it (if cached,
+        and if none of them has changed since) into `dest_dir`, which keeps the copies available
+        even if they're evicted from the cache meanwhile."""
+        with self.lock:
+            entry = self.cached.get(path)
+        if entry is None:
+            return False
+        shared_dir = os.path.dirname(path)
+        current = {}  # type: Dict[str, Optional[Tuple[int, int]]]
+        for f in entry[1]:
+            try:
+                st = os.stat(os.path.join(shared_dir, f))
+                current[f] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                current[f] = None
+        with self.lock:
+            if self.cached.get(path) is not entry:
+                return False
+            if current != entry[1]:
+                self._evict(path)
+                return False
+            for f in entry[1]:
+                os.link(os.path.join(entry[0], f), os.path.join(dest_dir, f))
+            self.cached.move_to_end(path)
+        return True
+
+    def stage(self, cmd: Sequence[str], inputs: Iterable[str], outputs: Sequence[str]) -> Optional[StagedStage]:
+        """`cmd` rewritten to write `outputs` to (and read cached `inputs` from) a new scratch directory,
+        or None if it can't be (as some of the outputs don't appear in the command, e.g., because they're
+        given as a prefix, so the command may write files we don't know about next to them)."""
+        if len(outputs) == 0 or not all(any(_path_pattern([o]).search(arg) for arg in cmd) for o in outputs):
+            return None
+        work_dir = self._new_dir("stage")
+        paths = {}  # type: Dict[str, str]
+        for i, o in enumerate(outputs):
+            # (a directory per output keeps its name, from which tools may infer its format)
+            d = os.path.join(work_dir, str(i))
+            os.mkdir(d)
+            paths[o] = os.path.join(d, os.path.basename(o))
+        for i, p in enumerate(inputs):
+            if p in paths or p not in self.cached:
+                continue
+            d = os.path.join(work_dir, "in-%d" % i)
+            os.mkdir(d)
+            if self.link_cached(p, d):
+                paths[p] = os.path.join(d, os.path.basename(p))
+        return StagedStage(cmd=rewrite(cmd, paths), outputs={ o : paths[o] for o in outputs }, work_dir=work_dir)
+
+    def copy_back(self, staged: StagedStage) -> None:
+        """Copy the outputs of a finished stage (and any other files it wrote next to them) to the
+        pipeline directory, each appearing there atomically, then cache the outputs."""
+        for shared, local in staged.outputs.items():
+            local_dir, shared_dir = os.path.dirname(local), os.path.dirname(shared)
+            for f in os.listdir(local_dir):
+                dest = os.path.join(shared_dir, f)
+                tmp = "%s.tmp-%d" % (dest, os.getpid())
+                shutil.copyfile(os.path.join(local_dir, f), tmp)
+                os.replace(tmp, dest)
+            if os.path.isfile(local):
+                self._cache(shared, local_dir)
+
+    def _cache(self, shared: str, local_dir: str) -> None:
+        files = os.listdir(local_dir)
+        if not all(os.path.isfile(os.path.join(local_dir, f)) for f in files):
+            return
+        size = sum(os.path.getsize(os.path.join(local_dir, f)) for f in files)
+        if size > self.max_size:
+            return
+        shared_dir = os.path.dirname(shared)
+        stats = {}  # type: Dict[str, Tuple[int, int]]
+        for f in files:
+            st = os.stat(os.path.join(shared_dir, f))
+            stats[f] = (st.st_size, st.st_mtime_ns)
+        cache_dir = os.path.join(self.dir, "cached-%d" % next(self.ids))
+        os.rename(local_dir, cache_dir)
+        with self.lock:
+            if shared in self.cached:
+                self._evict(shared)
+            while self.size + size > self.max_size and len(self.cached) > 0:
+                self._evict(next(iter(self.cached)))
+            self.cached[shared] = (cache_dir, stats, size)
+            self.size += size
+
+    def _evict(self, shared: str) -> None:
+        # (with the lock held)
+        cache_dir, _stats, size = self.cached.pop(shared)
+        self.size -= size
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def discard(self, staged: StagedStage) -> None:
+        """Remove what's left of a stage's scratch directory (its outputs, unless copied back and cached)."""
+        shutil.rmtree(staged.work_dir, ignore_errors=True)
+
+    def close(self) -> None:
+        shutil.rmtree(self.dir, ignore_errors=True)
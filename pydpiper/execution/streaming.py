@@ -0,0 +1,77 @@
+import logging
+import threading
+
+from typing import Any, Callable, List, Optional, Tuple
+
+logger = logging  # type: Any
+
+
+class ConstructionFailed(Exception):
+    """Constructing a pipeline (whose first stages may already be running) failed."""
+
+
+class StageStream(object):
+    """Stages passed from the thread constructing a pipeline to the server running it
+    (see `Pipeline.add_streamed_stages`), so that the first stages can run while
+    the rest of the pipeline is still being constructed.
+
+    >>> stream = StageStream()
+    >>> stream.put(["lsq6 stage 1", "lsq6 stage 2"])
+    >>> stream.take()
+    (['lsq6 stage 1', 'lsq6 stage 2'], False)
+    >>> stream.put(["nlin stage"]); stream.finish()
+    >>> stream.take()
+    (['nlin stage'], True)
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stages = []               # type: List[Any]
+        self._finished = False
+        self._error = None              # type: Optional[BaseException]
+        # called (in the constructing thread) when stages arrive while none are waiting
+        # and when construction finishes, e.g., to wake up the server
+        self.on_put = None              # type: Optional[Callable[[], Any]]
+
+    def put(self, stages: List[Any]) -> None:
+        with self._lock:
+            if self._finished:
+                raise ValueError("can't add stages to a finished stream")
+            wake = len(self._stages) == 0
+            self._stages.extend(stages)
+        if wake and self.on_put is not None:
+            self.on_put()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """Record that construction is complete (or has failed with `error`)."""
+        with self._lock:
+            self._finished = True
+            self._error = error
+        if self.on_put is not None:
+            self.on_put()
+
+    def take(self) -> Tuple[List[Any], bool]:
+        """The stages put since the last call and whether construction has finished
+        (so that these are the last); raises ConstructionFailed if construction failed."""
+        with self._lock:
+            stages, self._stages = self._stages, []
+            finished, error = self._finished, self._error
+        if error is not None:
+            raise ConstructionFailed("%s: %s" % (type(error).__name__, error)) from error
+        return stages, finished
+
+
+def construct_in_background(construct: Callable[[], Any], stream: StageStream) -> threading.Thread:
+    """Call `construct` (which puts stages on `stream` as it goes) in a new thread,
+    finishing the stream when it returns or raises."""
+    def run():
+        try:
+            construct()
+        except BaseException as e:
+            logger.exception("Constructing the pipeline failed")
+            stream.finish(error=e)
+        else:
+            stream.finish()
+    # a daemon, since the server may give up (e.g., on reaching its walltime) before construction is done
+    t = threading.Thread(target=run, name="pipeline-construction", daemon=True)
+    t.start()
+    return t
@@ -0,0 +1,364 @@
+"""Communication between the pipeline server and its executors.
+
+By default the server is a Pyro daemon and executors talk to it through Pyro proxies.
+Alternately (`--server-transport=asyncio`) the server is an asyncio event loop
+accepting length-prefixed JSON requests over TCP or a Unix socket, with executor
+management running as a coroutine alongside request handling on the same in-memory
+pipeline.  `connect` returns a proxy for either kind of server given its URI,
+so clients needn't care which one they're talking to.
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+
+import Pyro4  # type: ignore
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+logger = logging  # type: Any
+
+TCP_URI_PREFIX  = "pydpiper+tcp://"
+UNIX_URI_PREFIX = "pydpiper+unix://"
+
+# frames are a 4-byte big-endian length followed by that many bytes of UTF-8 JSON
+_LENGTH = struct.Struct(">I")
+
+# name -> (class, to_dict, from_dict) for classes which can be sent over the wire
+_classes = {}  # type: Dict[str, Tuple[type, Callable[[Any], Dict[str, Any]], Callable[[Dict[str, Any]], Any]]]
+
+
+class RemoteError(Exception):
+    """An exception raised on the server while handling a request."""
+    pass
+
+
+def register_class(name: str, cls: type,
+                   to_dict: Callable[[Any], Dict[str, Any]] = vars,
+                   from_dict: Optional[Callable[[Dict[str, Any]], Any]] = None) -> None:
+    """Allow instances of `cls` to be sent over the wire (much like Pyro's
+    `SerializerBase.register_class_to_dict`/`register_dict_to_class`)."""
+    _classes[name] = (cls, to_dict, from_dict or (lambda d: cls(**d)))
+
+
+def _default(obj):
+    for name, (cls, to_dict, _) in _classes.items():
+        if type(obj) is cls:
+            return dict(to_dict(obj), __class__=name)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError("Can't serialize object of type %s" % type(obj).__name__)
+
+
+def _object_hook(d):
+    name = d.get("__class__")
+    if name in _classes:
+        return _classes[name][2]({ k : v for k, v in d.items() if k != "__class__" })
+    return d
+
+
+def encode_frame(obj) -> bytes:
+    """
+    >>> decode_payload(encode_frame({"a" : {1, 2}})[4:])
+    {'a': [1, 2]}
+    """
+    payload = json.dumps(obj, default=_default).encode("utf-8")
+    return _LENGTH.pack(len(payload)) + payload
+
+
+def decode_payload(payload: bytes):
+    return json.loads(payload.decode("utf-8"), object_hook=_object_hook)
+
+
+def _recv_exactly(sock: socket.socket, n: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("connection closed by the server")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def is_async_uri(uri: str) -> bool:
+    return uri.startswith(TCP_URI_PREFIX) or uri.startswith(UNIX_URI_PREFIX)
+
+
+def connect(uri):
+    """A proxy for the server at `uri` (either a Pyro URI or one of our own)."""
+    uri = str(uri).strip()
+    return AsyncServerProxy(uri) if is_async_uri(uri) else Pyro4.Proxy(uri)
+
+
+class AsyncServerProxy(object):
+    """A blocking client for an `AsyncPipelineServer`, mimicking (the parts we use of)
+    a Pyro proxy: remote methods are called as attributes of the proxy, the connection
+    is made on first use and kept open, and a proxy shouldn't be shared between threads."""
+    def __init__(self, uri: str) -> None:
+        self.uri = uri
+        self._sock = None  # type: Optional[socket.socket]
+
+    def _connect(self) -> socket.socket:
+        if self.uri.startswith(UNIX_URI_PREFIX):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.uri[len(UNIX_URI_PREFIX):])
+        else:
+            host, port = self.uri[len(TCP_URI_PREFIX):].rsplit(":", 1)
+            sock = socket.create_connection((host, int(port)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _call(self, method: str, *args, **kwargs):
+        if self._sock is None:
+            self._sock = self._connect()
+        try:
+            self._sock.sendall(encode_frame({ "method" : method, "args" : args, "kwargs" : kwargs }))
+            length, = _LENGTH.unpack(_recv_exactly(self._sock, _LENGTH.size))
+            response = decode_payload(_recv_exactly(self._sock, length))
+        except:
+            # the connection is in an unknown state, so don't reuse it
+            self._pyroRelease()
+            raise
+        if "error" in response:
+            raise RemoteError("%s (in %s on the server)" % (response["error"], method))
+        return response["result"]
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._call(name, *args, **kwargs)
+
+    def _pyroRelease(self) -> None:
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            finally:
+                self._sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self._pyroRelease()
+
+
+class Notifier(object):
+    """Pushes notifications to clients (e.g., from the server to executors waiting for work)
+    by calling `method` on the object at each notified URI from a background thread,
+    so the server isn't held up by slow or dead clients.  Notifications to a client
+    which hasn't yet been notified of a previous one are coalesced; failures are merely logged
+    since the clients also poll.
+
+    >>> calls = []
+    >>> class Client(object):
+    ...     def __init__(self, uri): self.uri = uri
+    ...     def wakeUp(self): calls.append(self.uri)
+    >>> n = Notifier("wakeUp", connect=Client)
+    >>> n.notify("a"); n.notify("b"); n.flush()
+    >>> sorted(calls)
+    ['a', 'b']
+    """
+    def __init__(self, method: str, connect: Callable[[str], Any] = connect, timeout: float = 5.0) -> None:
+        self.method = method
+        self.connect = connect
+        self.timeout = timeout
+        self._queue = None    # type: Optional[queue.Queue]
+        self._pending = set()  # type: Set[str]
+        self._lock = threading.Lock()
+        self._pid = None      # type: Optional[int]
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # the thread and its queue belong to the process which started them
+        return dict(self.__dict__, _queue=None, _pending=set(), _lock=None, _pid=None)
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state, _lock=threading.Lock())
+
+    def _ensure_started(self) -> "queue.Queue":
+        # start lazily since the server typically runs in a process forked after the pipeline is created
+        if self._queue is None or self._pid != os.getpid():
+            self._queue, self._pending, self._pid = queue.Queue(), set(), os.getpid()
+            threading.Thread(target=self._run, args=(self._queue,), daemon=True).start()
+        return self._queue
+
+    def notify(self, uri: str) -> None:
+        with self._lock:
+            q = self._ensure_started()
+            if uri in self._pending:
+                return
+            self._pending.add(uri)
+        q.put(uri)
+
+    def flush(self) -> None:
+        """Wait until all notifications so far have been sent (or have failed)."""
+        with self._lock:
+            q = self._ensure_started()
+        q.join()
+
+    def _run(self, q: "queue.Queue") -> None:
+        while True:
+            uri = q.get()
+            with self._lock:
+                self._pending.discard(uri)
+            try:
+                proxy = self.connect(uri)
+                proxy._pyroTimeout = self.timeout
+                try:
+                    getattr(proxy, self.method)()
+                finally:
+                    release = getattr(proxy, "_pyroRelease", None)
+                    if release is not None:
+                        release()
+            except Exception:
+                logger.warning("Unable to notify %s (%s)", uri, self.method, exc_info=True)
+            finally:
+                q.task_done()
+
+
+class AsyncPipelineServer(object):
+    """Serves requests for the public methods of `pipeline` (as a Pyro daemon would)
+    and runs the executor-management loop (`continueLoop`/`manageExecutors`)
+    from a single event loop.  Since requests and the management loop
+    are handled in the same process, there's no need to proxy management calls
+    to the process serving requests, and the management loop is woken as soon as a request
+    has (possibly) changed what needs doing rather than only every `loop_interval` seconds.
+    Each management step runs in a worker thread, holding `lock` (as do requests) except while
+    the pipeline does something slow which doesn't involve its state (e.g., submitting executors
+    to the queue) inside `pipeline.blocking()`, so that executors' check-ins aren't held up meanwhile.
+    """
+    # requests after which the management loop should run again right away
+    # (e.g., to notice that the pipeline has finished, or that executors need to be launched):
+    WAKEUP_METHODS = frozenset(["executorCheckIn", "registerClient", "reattachClient", "unregisterClient",
+                                "setStageFinished", "setStageFailed", "set_shutdown_ev"])
+
+    def __init__(self, pipeline, loop_interval: float) -> None:
+        self.pipeline = pipeline
+        self.loop_interval = loop_interval
+        self._wakeup = None   # type: Optional[asyncio.Event]
+        self._stopped = None  # type: Optional[asyncio.Event]
+        self._server = None
+        self._connections = set()  # type: Set[asyncio.Task]
+        self.lock = threading.Lock()
+        pipeline.blocking = self.unlocked
+
+    def dispatch(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        method = request.get("method", "")
+        try:
+            if method.startswith("_"):
+                raise AttributeError("no such method: %s" % method)
+            with self.lock:
+                result = getattr(self.pipeline, method)(*request.get("args", ()), **request.get("kwargs", {}))
+        except Exception as e:
+            logger.exception("Error handling request for %s", method)
+            return { "error" : "%s: %s" % (type(e).__name__, e) }
+        finally:
+            if method in self.WAKEUP_METHODS:
+                self.wakeup()
+        return { "result" : result }
+
+    def wakeup(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def stop(self) -> None:
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(_LENGTH.size)
+                except asyncio.IncompleteReadError:
+                    break  # the client hung up
+                length, = _LENGTH.unpack(header)
+                response = self.dispatch(decode_payload(await reader.readexactly(length)))
+                try:
+                    frame = encode_frame(response)
+                except TypeError as e:
+                    frame = encode_frame({ "error" : "unable to serialize result: %s" % e })
+                writer.write(frame)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            logger.debug("Lost connection to a client")
+        finally:
+            writer.close()
+            self._connections.discard(task)
+
+    async def start(self, host: Optional[str] = None, port: int = 0, path: Optional[str] = None) -> str:
+        """Start listening (on a Unix socket if `path` is given, otherwise on `host`:`port`);
+        returns the URI clients should use."""
+        self._wakeup, self._stopped = asyncio.Event(), asyncio.Event()
+        if path is not None:
+            if os.path.exists(path):
+                os.remove(path)
+            self._server = await asyncio.start_unix_server(self._handle_connection, path=path)
+            return UNIX_URI_PREFIX + os.path.abspath(path)
+        self._server = await asyncio.start_server(self._handle_connection, host=host, port=port)
+        bound_port = self._server.sockets[0].getsockname()[1]
+        return "%s%s:%d" % (TCP_URI_PREFIX, host, bound_port)
+
+    @contextlib.contextmanager
+    def unlocked(self):
+        """Release the lock (held by a management step) for the duration of a slow call."""
+        self.lock.release()
+        try:
+            yield
+        finally:
+            self.lock.acquire()
+
+    def _manage_step(self) -> bool:
+        with self.lock:
+            if not self.pipeline.continueLoop():
+                return False
+            self.pipeline.manageExecutors()
+            return True
+
+    async def manage(self) -> None:
+        """The executor-management loop: runs until the pipeline says there's nothing more to do."""
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                # (cleared first, so that requests made during the step wake the loop again)
+                self._wakeup.clear()
+                if not await loop.run_in_executor(None, self._manage_step):
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.loop_interval)
+                except asyncio.TimeoutError:
+                    pass
+        except Exception:
+            logger.exception("Server loop encountered a problem.  Shutting down.")
+        finally:
+            logger.info("Server loop going to shut down ...")
+            self.pipeline.set_shutdown_ev()
+            self.stop()
+
+    async def serve(self, time_to_live: Optional[float] = None) -> bool:
+        """Run the management loop and serve requests until the loop finishes, `stop` is called,
+        or `time_to_live` seconds have elapsed.  Returns False in the last case."""
+        manager = asyncio.ensure_future(self.manage())
+        try:
+            await asyncio.wait_for(self._stopped.wait(), time_to_live)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            manager.cancel()
+            try:
+                await manager
+            except asyncio.CancelledError:
+                pass
+            self._server.close()
+            await self._server.wait_closed()
+            # hang up on any remaining clients
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
@@ -0,0 +1,118 @@
+import functools
+import os
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# magic no. for EXT3, EXT4, NFS (?), Linux NAME_MAX, etc.
+# N.B. - at some point we had 245 instead of 255 -- a typo, a program-specific buffer size,
+# or something to do with one of the file systems (NFS, SciNet's IBM GPFS, etc. ...)?
+MAX_FILENAME_LENGTH = 255
+
+# looking up a command may stat a file in each directory on the PATH, some of which may be on slow
+# network filesystems, so look up the (typically few dozen) distinct commands concurrently
+WHICH_THREADS = 16
+
+
+@functools.lru_cache(maxsize=None)
+def which(cmd: str) -> Optional[str]:
+    """`shutil.which`, memoized."""
+    return shutil.which(cmd)
+
+
+def missing_executables(cmds: Iterable[str], threads: int = WHICH_THREADS) -> List[str]:
+    """The distinct commands in `cmds` which can't be found on the PATH (in sorted order).
+
+    >>> missing_executables(["sh", "no-such-command-4711", "sh"])
+    ['no-such-command-4711']
+    """
+    cmds = sorted(set(cmds))
+    if len(cmds) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=min(threads, len(cmds))) as pool:
+        paths = list(pool.map(which, cmds))
+    return [c for c, p in zip(cmds, paths) if p is None]
+
+
+def record_outputs(producers: Dict[str, Any], stages: Iterable[Any]) -> List[Tuple[str, Any, Any]]:
+    """Add the outputs of `stages` to `producers` (a map from outputs to the stage producing them),
+    returning (output, earlier producer, stage) for each output already produced by another stage.
+
+    >>> from types import SimpleNamespace as S
+    >>> a, b = S(outputFiles=["/o/x.mnc"], cmd=["a"]), S(outputFiles=["/o/y.mnc", "/o/x.mnc"], cmd=["b"])
+    >>> producers = {}
+    >>> record_outputs(producers, [a, a]) + record_outputs(producers, [b]) == [("/o/x.mnc", a, b)]
+    True
+    """
+    duplicates = []
+    for s in stages:
+        for o in s.outputFiles:
+            t = producers.setdefault(o, s)
+            if t is not s:
+                duplicates.append((o, t, s))
+    return duplicates
+
+
+def _inside(path: str, root: str, cwd: str) -> bool:
+    # `root` and `cwd` are absolute, normalized and end with a separator.  Doesn't resolve symlinks
+    # (like the `os.path.relpath` this replaces), but avoids normalizing paths without '.' or '..' components.
+    if not os.path.isabs(path):
+        path = cwd + path
+    if path.startswith(root) and os.sep + "." not in path:
+        return True
+    return (os.path.normpath(path) + os.sep).startswith(root)
+
+
+def find_problems(stages: Sequence[Any],
+                  output_dir: Optional[str],
+                  duplicate_outputs: Iterable[Tuple[str, Any, Any]] = (),
+                  max_len: int = MAX_FILENAME_LENGTH,
+                  check_commands: bool = True) -> List[str]:
+    """Descriptions of all the problems with the given (pipeline) stages found in a single pass over them:
+    output and log filenames longer than `max_len`, outputs outside `output_dir` (by default the current
+    directory), outputs produced by several stages (as found by `record_outputs` or when adding the
+    stages to a `Pipeline`) and commands which aren't on the PATH.
+
+    >>> from types import SimpleNamespace as S
+    >>> stages = [S(name="sh", cmd=["sh", "/o/x.mnc"], outputFiles=["/o/x.mnc"], logFile="/o/log/x.log"),
+    ...           S(name="sh", cmd=["sh", "/y.mnc"], outputFiles=["/o/../y.mnc"], logFile="/o/log/y.log")]
+    >>> find_problems(stages, "/o")
+    ["output /o/../y.mnc of stage 'sh /y.mnc' not contained inside pipeline directory /o"]
+    """
+    # TODO also check the logfiles are in the directory ... should these be counted as stage outputs?
+    # TODO check the other parts of the path aren't too long either (much less likely)?
+    root = os.path.join(os.path.abspath(output_dir or os.curdir), "")
+    cwd = os.path.join(os.getcwd(), "")
+    problems = []  # type: List[str]
+    cmds = set()
+    for s in stages:
+        cmds.add(s.name)
+        for o in s.outputFiles:
+            if len(os.path.splitext(os.path.basename(o))[0]) > max_len:
+                problems.append("output filename '%s' of command '%s' too long (more than %s chars)"
+                                % (o, " ".join(s.cmd), max_len))
+            if not _inside(o, root, cwd):
+                problems.append("output %s of stage '%s' not contained inside pipeline directory %s"
+                                % (o, " ".join(s.cmd), output_dir or os.curdir))
+        if s.logFile and len(os.path.basename(s.logFile)) > max_len:
+            problems.append("log file '%s' of command '%s' too long (more than %s chars)"
+                            % (s.logFile, " ".join(s.cmd), max_len))
+    producers = OrderedDict()  # type: Dict[str, Dict[str, None]]
+    for o, s, t in duplicate_outputs:
+        ss = producers.setdefault(o, OrderedDict())
+        ss[" ".join(s.cmd)] = ss[" ".join(t.cmd)] = None
+    problems.extend("output %s produced by %d stages: %s" % (o, len(ss), "; ".join("'%s'" % c for c in ss))
+                    for o, ss in producers.items())
+    if check_commands:
+        problems.extend("missing executable: %s" % c for c in missing_executables(cmds))
+    return problems
+
+
+def validate_stages(stages: Sequence[Any], output_dir: Optional[str],
+                    duplicate_outputs: Iterable[Tuple[str, Any, Any]] = (), **kwargs) -> None:
+    """Raise a ValueError describing all problems found by `find_problems` (rather than just the first)."""
+    problems = find_problems(stages, output_dir, duplicate_outputs, **kwargs)
+    if len(problems) > 0:
+        raise ValueError("problems with the pipeline's stages (%d):\n  %s" % (len(problems), "\n  ".join(problems)))
@@ -4,16 +4,12 @@
 import csv
 import os
 import warnings
-from functools import reduce
-from operator import mul
 from typing import cast, List, Optional
 
-from pyminc.volumes.factory import volumeFromFile
-
 from pydpiper.core.stages import Result, CmdStage, Stages, identity_result
 from pydpiper.core.util import NamedTuple
 from pydpiper.minc.containers import XfmHandler
-from pydpiper.minc.files import XfmAtom, MincAtom, IdMinc
+from pydpiper.minc.files import XfmAtom, MincAtom, IdMinc, minc_voxels
 from pydpiper.minc.nlin import NLIN
 # TODO in order to remove circularity from the module import (which gives an exception at import time)
 # TODO we need to move some stuff around ...
@@ -63,12 +59,14 @@ class MultilevelANTSConf(object):
 
 def set_memory(st, source: MincAtom, conf: ANTSConf, mem_cfg):
     # see comments re: mincblur memory configuration
-    voxels = reduce(mul, volumeFromFile(source.path).getSizes())
+    voxels = minc_voxels(source.path)
+    st.setInputVoxels(voxels)
     mem_per_voxel = (mem_cfg.mem_per_voxel_coarse
                      if int(conf.iterations.split('x')[-1]) == 0
                      # yikes ... this parsing should be done earlier
                      else mem_cfg.mem_per_voxel_fine)
     st.setMem(mem_cfg.base_mem + voxels * mem_per_voxel)
+    st.setProcs(procs_for_voxels(voxels))
 
 
 # doesn't seem to be used anywhere
@@ -96,6 +94,20 @@ ANTSMemCfg = NamedTuple("ANTSMemCfg",
 
 default_ANTS_mem_cfg = ANTSMemCfg(base_mem=0.177, mem_per_voxel_coarse=1.385e-7, mem_per_voxel_fine=2.1e-7)
 
+# ANTS and antsRegistration use as many threads as they're given (see `limits.THREAD_COUNT_VARIABLES`),
+# but small images don't benefit from many, so request a processor per this many voxels
+# (up to a maximum, and up to the executors' --proc)
+ANTS_VOXELS_PER_PROC = 4 * 10**6
+ANTS_MAX_PROCS = 8
+
+
+def procs_for_voxels(voxels: int, voxels_per_proc: int = ANTS_VOXELS_PER_PROC, max_procs: int = ANTS_MAX_PROCS) -> int:
+    """
+    >>> procs_for_voxels(10**6), procs_for_voxels(13 * 10**6), procs_for_voxels(10**9)
+    (1, 3, 8)
+    """
+    return max(1, min(max_procs, voxels // voxels_per_proc))
+
 
 class ANTS(NLIN):
 
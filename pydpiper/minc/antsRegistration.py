@@ -1,19 +1,15 @@
 
 import os
 import warnings
-from functools import reduce
-from operator import mul
 from typing import Optional, Tuple, Sequence
 
-from pyminc.volumes.factory import volumeFromFile
-
-from pydpiper.minc.ANTS import ANTSMemCfg
+from pydpiper.minc.ANTS import ANTSMemCfg, procs_for_voxels
 from pydpiper.core.util import AutoEnum, NamedTuple, flatten
 from pydpiper.minc.nlin import NLIN
 from pydpiper.minc.containers import XfmHandler
 from pydpiper.minc.registration import mincresample, Interpolation, mincblur, MincAlgorithms
 from pydpiper.core.stages import Stages, CmdStage, Result, identity_result
-from pydpiper.minc.files import MincAtom, XfmAtom, IdMinc
+from pydpiper.minc.files import MincAtom, XfmAtom, IdMinc, minc_voxels
 
 ConvergenceCriteria = NamedTuple("ConvergenceCriteria",
                                  [("convergence_threshold", float),
@@ -327,12 +323,14 @@ def antsRegistration(source: MincAtom,
     # see comments re: mincblur memory configuration
     def set_memory(st, mem_cfg):
         # see comments re: mincblur memory configuration
-        voxels = reduce(mul, volumeFromFile(source.path).getSizes())
+        voxels = minc_voxels(source.path)
+        st.setInputVoxels(voxels)
         mem_per_voxel = (mem_cfg.mem_per_voxel_coarse
                          if 0 in conf.convergence.iterations[-1:]  #-2?
                          # yikes ... this parsing should be done earlier
                          else mem_cfg.mem_per_voxel_fine)
         st.setMem(mem_cfg.base_mem + voxels * mem_per_voxel)
+        st.setProcs(procs_for_voxels(voxels))
 
     cmd.when_runnable_hooks.append(lambda st: set_memory(st, mem_cfg=default_ANTSRegistration_mem_cfg))
 
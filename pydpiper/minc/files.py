@@ -1,9 +1,17 @@
+import concurrent.futures
 import copy
+import json
+import os
+import sqlite3
+import struct
+import threading
 
 # from pydpiper.core.util  import NotProvided
 from abc import abstractstaticmethod, ABCMeta
+from functools import reduce
+from operator import mul
 
-from typing import Generic, TypeVar
+from typing import Any, Callable, Dict, Generic, Iterable, List, NamedTuple, Optional, Tuple, TypeVar, Union
 
 from pydpiper.core.stages import identity_result
 from pydpiper.core.files import NotProvided, FileAtom, ImgAtom
@@ -71,4 +79,321 @@ class IdMinc(ToMinc):
   @staticmethod
   def to_mni_xfm(x): return identity_result(x)
   @staticmethod
-  def from_mni_xfm(x): return identity_result(x)
\ No newline at end of file
+  def from_mni_xfm(x): return identity_result(x)
+
+# the header information we use (e.g., to set memory requirements and to check inputs)
+MincHeader = NamedTuple("MincHeader", [("sizes", Tuple[int, ...]),
+                                       ("separations", Tuple[float, ...]),
+                                       ("starts", Tuple[float, ...]),
+                                       ("dtype", str)])
+
+
+# libminc (and the HDF5 library beneath it) isn't thread-safe, but headers are read from several threads
+# (e.g., by runnable hooks, which the server evaluates in background threads), so each process reads
+# with libminc one file at a time; `MincHeaderCache.get_many` reads many in parallel in other processes
+libminc_lock = threading.Lock()
+
+
+def read_header_with_pyminc(path: str) -> MincHeader:
+    # imported here so that this module can be used without libminc
+    from pyminc.volumes.factory import volumeFromFile  # type: ignore
+    with libminc_lock:
+        vol = volumeFromFile(path)
+        try:
+            return MincHeader(sizes=tuple(int(s) for s in vol.getSizes()),
+                              separations=tuple(float(s) for s in vol.separations),
+                              starts=tuple(float(s) for s in vol.starts),
+                              dtype=str(vol.volumeType))
+        finally:
+            vol.closeVolume()
+
+
+# netCDF (i.e., MINC1) type codes -> (size in bytes, struct format)
+_NC_TYPES = { 1 : (1, "b"), 2 : (1, "c"), 3 : (2, "h"), 4 : (4, "i"), 5 : (4, "f"), 6 : (8, "d") }
+# (netCDF type, signed) -> the MINC name of the type
+_NC_TYPE_NAMES = { (1, True) : "byte", (1, False) : "ubyte", (3, True) : "short", (3, False) : "ushort",
+                   (4, True) : "int", (4, False) : "uint", (5, True) : "float", (6, True) : "double" }
+
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+
+# below this many unread headers, reading them in other processes isn't worth starting the processes
+MIN_FILES_PER_PROCESS = 16
+
+
+class _NetCDFHeader(object):
+    """Just enough of a netCDF classic/64-bit offset header parser to find a MINC1 file's geometry."""
+    def __init__(self, data: bytes) -> None:
+        self.data, self.pos = data, 0
+        magic = self._bytes(4)
+        if magic[:3] != b"CDF" or magic[3] not in (1, 2):
+            raise ValueError("not a netCDF file")
+        self.offset_size = 4 if magic[3] == 1 else 8
+        self._int()  # number of records
+        self.dims = [(self._name(), self._int()) for _ in self._list(0x0A)]
+        self._attrs()
+        self.vars = {}  # type: Dict[str, Tuple[List[int], Dict[str, Any], int, int, int]]
+        for _ in self._list(0x0B):
+            name = self._name()
+            dimids = [self._int() for _ in range(self._int())]
+            attrs = self._attrs()
+            nc_type, vsize = self._int(), self._int()
+            begin = self._int() if self.offset_size == 4 else self._int64()
+            self.vars[name] = (dimids, attrs, nc_type, vsize, begin)
+
+    def _bytes(self, n: int) -> bytes:
+        if self.pos + n > len(self.data):
+            raise ValueError("truncated netCDF header")
+        b = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return b
+
+    def _int(self) -> int:
+        return struct.unpack(">i", self._bytes(4))[0]
+
+    def _int64(self) -> int:
+        return struct.unpack(">q", self._bytes(8))[0]
+
+    def _name(self) -> str:
+        n = self._int()
+        name = self._bytes(n).decode("utf-8", "replace")
+        self._bytes(-n % 4)
+        return name
+
+    def _list(self, tag: int) -> range:
+        t, n = self._int(), self._int()
+        if t not in (0, tag):
+            raise ValueError("malformed netCDF header")
+        return range(n)
+
+    def _attrs(self) -> Dict[str, Any]:
+        attrs = {}
+        for _ in self._list(0x0C):
+            name = self._name()
+            nc_type, n = self._int(), self._int()
+            if nc_type not in _NC_TYPES:
+                raise ValueError("unknown netCDF type %d" % nc_type)
+            size, fmt = _NC_TYPES[nc_type]
+            raw = self._bytes(n * size)
+            self._bytes(-(n * size) % 4)
+            attrs[name] = (raw.decode("utf-8", "replace").rstrip("\x00") if nc_type == 2
+                           else struct.unpack(">%d%s" % (n, fmt), raw))
+        return attrs
+
+
+def read_minc1_header(path: str) -> MincHeader:
+    """The header of a MINC1 (netCDF) file, read without libminc."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        data = f.read(1 << 16)
+    while True:
+        try:
+            h = _NetCDFHeader(data)
+            break
+        except ValueError as e:
+            # the header is (very rarely) larger than what we've read so far
+            if str(e) != "truncated netCDF header" or len(data) >= size:
+                raise
+            with open(path, 'rb') as f:
+                data = f.read(4 * len(data))
+    if "image" not in h.vars:
+        raise ValueError("no image variable")
+    dimids, attrs, nc_type, vsize, begin = h.vars["image"]
+    dims = [h.dims[d] for d in dimids]
+
+    def attr(var, name, default):
+        value = h.vars[var][1].get(name, (default,)) if var in h.vars else (default,)
+        return float(value[0])
+    signed = attrs.get("signtype", "signed__" if nc_type != 1 else "unsigned") == "signed__"
+    header = MincHeader(sizes=tuple(n for _, n in dims),
+                        separations=tuple(attr(name, "step", 1.0) for name, _ in dims),
+                        starts=tuple(attr(name, "start", 0.0) for name, _ in dims),
+                        dtype=_NC_TYPE_NAMES.get((nc_type, signed or nc_type in (5, 6)), "unknown"))
+    voxel_bytes = reduce(mul, header.sizes, 1) * _NC_TYPES[nc_type][0]
+    if begin + voxel_bytes > size:
+        raise ValueError("file is truncated (%d of %d bytes)" % (size, begin + voxel_bytes))
+    return header
+
+
+def read_header(path: str) -> MincHeader:
+    """The header of a MINC1 or MINC2 file; MINC1 headers are parsed directly,
+    MINC2 (HDF5) ones are read with pyminc (i.e., libminc) -- but without starting `mincinfo`."""
+    with open(path, 'rb') as f:
+        magic = f.read(8)
+    if magic[:3] == b"CDF":
+        return read_minc1_header(path)
+    elif magic == HDF5_SIGNATURE:
+        return read_header_with_pyminc(path)
+    else:
+        raise ValueError("not a MINC file")
+
+
+def _read_header_or_error(read: Callable[[str], MincHeader], path: str) -> Tuple[str, Any]:
+    # (exceptions raised by libminc, etc., might not survive the trip back from a worker process)
+    try:
+        return path, read(path)
+    except Exception as e:
+        return path, "%s: %s" % (type(e).__name__, e) if str(e) else type(e).__name__
+
+
+class MincHeaderCache(object):
+    """Header information of MINC files, keyed by path and the file's size and mtime
+    (so a file which is rewritten is read again).  Many stages (and input checks) need the header
+    of the same few files (atlases, targets, ...), so this saves opening each file repeatedly;
+    the headers can also be persisted in an SQLite database (see `persist_to`) to save reading them
+    again in later runs.
+
+    >>> import tempfile
+    >>> f = os.path.join(tempfile.mkdtemp(), "img.mnc")
+    >>> with open(f, 'w') as fh: _ = fh.write("not really MINC")
+    >>> reads = []
+    >>> def fake_reader(path):
+    ...     reads.append(path)
+    ...     return MincHeader(sizes=(10, 20, 30), separations=(0.1, 0.1, 0.1), starts=(0., 0., 0.), dtype="float")
+    >>> headers = MincHeaderCache(read_header=fake_reader)
+    >>> headers.voxels(f), headers.get(f).dtype, len(reads)
+    (6000, 'float', 1)
+    """
+    def __init__(self, filename: Optional[str] = None,
+                 read_header: Callable[[str], MincHeader] = read_header) -> None:
+        self.read_header = read_header
+        self._headers = {}  # type: Dict[str, Tuple[int, int, MincHeader]]
+        # headers may be requested from several threads at once (e.g., by input checks)
+        self._lock = threading.Lock()
+        self.filename = None  # type: Optional[str]
+        self._conn = None     # type: Optional[sqlite3.Connection]
+        self._pid = None      # type: Optional[int]
+        if filename is not None:
+            self.persist_to(filename)
+
+    def persist_to(self, filename: str) -> None:
+        self.filename = filename
+        self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # as for StageHistory, connect lazily (and again after a fork)
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+            conn.execute("CREATE TABLE IF NOT EXISTS headers "
+                         "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, header TEXT)")
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def __getstate__(self):
+        return dict(self.__dict__, _lock=None, _conn=None, _pid=None)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, _lock=threading.Lock())
+
+    def get(self, path: str) -> MincHeader:
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        header = self._cached(path, st)
+        if header is None:
+            # read outside the lock so that other files can be read concurrently
+            # (except that reads with libminc are serialized by `libminc_lock`)
+            header = self.read_header(path)
+            self._add(path, st, header)
+        return header
+
+    def _cached(self, path: str, st: os.stat_result) -> Optional[MincHeader]:
+        with self._lock:
+            cached = self._headers.get(path)
+            if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+                return cached[2]
+            header = self._get_persisted(path, st)
+            if header is not None:
+                self._headers[path] = (st.st_size, st.st_mtime_ns, header)
+            return header
+
+    def _add(self, path: str, st: os.stat_result, header: MincHeader) -> None:
+        with self._lock:
+            self._persist(path, st, header)
+            self._headers[path] = (st.st_size, st.st_mtime_ns, header)
+
+    def get_many(self, paths: Iterable[str], processes: Optional[int] = None) -> Dict[str, Union[MincHeader, str]]:
+        """The headers of many files, read in parallel (in a pool of `processes` processes, since libminc isn't
+        thread-safe) where they aren't already known; the result for a file which can't be read
+        is a description of the problem instead.  Results are keyed by the paths as given."""
+        paths = list(paths)
+        result = {}  # type: Dict[str, Union[MincHeader, str]]
+        to_read = {}  # type: Dict[str, Tuple[str, os.stat_result]]
+        for p in paths:
+            try:
+                st = os.stat(p)
+            except OSError as e:
+                result[p] = e.strerror or type(e).__name__
+                continue
+            header = self._cached(os.path.abspath(p), st)
+            if header is not None:
+                result[p] = header
+            else:
+                to_read[p] = (os.path.abspath(p), st)
+        processes = min(processes or os.cpu_count() or 1, len(to_read))
+        if processes <= 1 or len(to_read) < MIN_FILES_PER_PROCESS:
+            read = [_read_header_or_error(self.read_header, p) for p in to_read]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+                read = list(pool.map(_read_header_or_error, [self.read_header] * len(to_read), list(to_read),
+                                     chunksize=max(1, len(to_read) // (4 * processes))))
+        for p, header in read:
+            if isinstance(header, str):
+                result[p] = header
+            else:
+                self._add(to_read[p][0], to_read[p][1], header)
+                result[p] = header
+        return result
+
+    def _get_persisted(self, path: str, st: os.stat_result) -> Optional[MincHeader]:
+        if self.filename is None:
+            return None
+        row = self._connection().execute("SELECT header FROM headers WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                         (path, st.st_size, st.st_mtime_ns)).fetchone()
+        if row is None:
+            return None
+        d = json.loads(row[0])
+        return MincHeader(sizes=tuple(d["sizes"]), separations=tuple(d["separations"]),
+                          starts=tuple(d["starts"]), dtype=d["dtype"])
+
+    def _persist(self, path: str, st: os.stat_result, header: MincHeader) -> None:
+        if self.filename is None:
+            return
+        conn = self._connection()
+        conn.execute("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)",
+                     (path, st.st_size, st.st_mtime_ns, json.dumps(header._asdict())))
+        conn.commit()
+
+    def voxels(self, path: str) -> int:
+        return reduce(mul, self.get(path).sizes, 1)
+
+
+# shared by everything which reads MINC headers (memory hooks, input checks, ...) in this process
+minc_headers = MincHeaderCache()
+
+
+def read_minc_header(path: str) -> MincHeader:
+    return minc_headers.get(path)
+
+
+def minc_voxels(path: str) -> int:
+    """The number of voxels in a MINC file."""
+    return minc_headers.voxels(path)
+
+
+def validate_minc_files(paths: Iterable[str], same_geometry: bool = False,
+                        processes: Optional[int] = None) -> Dict[str, MincHeader]:
+    """Check in a single (parallel) pass that the given files are readable MINC files
+    and, optionally, that they all have the same dimensions, step sizes and starts, raising
+    a ValueError describing all problems found (rather than just the first); returns the headers."""
+    paths = list(paths)
+    headers = minc_headers.get_many(paths, processes=processes)
+    problems = ["%s: %s" % (p, headers[p]) for p in paths if isinstance(headers[p], str)]
+    good = [p for p in paths if not isinstance(headers[p], str)]
+    if same_geometry and len(good) > 0:
+        first = headers[good[0]]
+        problems.extend("%s: dimensions/starts/step sizes differ from those of %s" % (p, good[0])
+                        for p in good[1:]
+                        if headers[p][:3] != first[:3])
+    if len(problems) > 0:
+        raise ValueError("problems with %d input file(s):\n  %s" % (len(problems), "\n  ".join(problems)))
+    return { p : headers[p] for p in paths }  # type: ignore
@@ -1,6 +1,6 @@
 # Stubs for pydpiper.minc.files (Python 3.5)
 
-from typing import Callable
+from typing import Callable, Dict, Iterable, NamedTuple, Optional, Tuple, Union
 from pydpiper.core.files import FileAtom
 
 class MincAtom(FileAtom):
@@ -22,3 +22,29 @@ class XfmAtom(FileAtom):
     def newname_with_fn(self, fn : Callable[[str], str], ext : str = ..., subdir : str = ...) -> XfmAtom: ...
 
 def xfmToMinc(xfm : XfmAtom) -> MincAtom: ...
+
+
+MincHeader = NamedTuple("MincHeader", [("sizes", Tuple[int, ...]),
+                                       ("separations", Tuple[float, ...]),
+                                       ("starts", Tuple[float, ...]),
+                                       ("dtype", str)])
+
+def read_header_with_pyminc(path : str) -> MincHeader: ...
+def read_minc1_header(path : str) -> MincHeader: ...
+def read_header(path : str) -> MincHeader: ...
+
+class MincHeaderCache(object):
+    filename = ... # type: Optional[str]
+    def __init__(self, filename : str = None,
+                 read_header : Callable[[str], MincHeader] = ...) -> None: ...
+    def persist_to(self, filename : str) -> None: ...
+    def get(self, path : str) -> MincHeader: ...
+    def get_many(self, paths : Iterable[str], processes : int = None) -> Dict[str, Union[MincHeader, str]]: ...
+    def voxels(self, path : str) -> int: ...
+
+minc_headers = ... # type: MincHeaderCache
+
+def read_minc_header(path : str) -> MincHeader: ...
+def minc_voxels(path : str) -> int: ...
+def validate_minc_files(paths : Iterable[str], same_geometry : bool = False,
+                        processes : int = None) -> Dict[str, MincHeader]: ...
@@ -3,22 +3,19 @@ import csv
 import os
 import random
 import shlex
-import subprocess
 import sys
 import time
 import warnings
-from functools import reduce
-from operator import mul
 from typing import Any, cast, Dict, Generic, List, Optional, Tuple, TypeVar, Union, Callable
 
 from configargparse import Namespace
-from pyminc.volumes.factory import volumeFromFile  # type: ignore
 
 from pydpiper.core.files import FileAtom
 from pydpiper.core.stages import CmdStage, Result, Stages, identity_result
 from pydpiper.core.util import pairs, AutoEnum, NamedTuple, raise_, flatten
 from pydpiper.minc.containers import XfmHandler
-from pydpiper.minc.files import MincAtom, XfmAtom, xfmToMinc, IdMinc, mincToXfm
+from pydpiper.minc.files import (MincAtom, XfmAtom, xfmToMinc, IdMinc, mincToXfm, minc_voxels, read_minc_header,
+                                 validate_minc_files)
 from pydpiper.minc.nlin import NLIN, NLIN_BUILD_MODEL, Algorithms
 
 
@@ -267,7 +264,8 @@ def minctracc(source: MincAtom,
 
     if nlin_conf is not None:  # TODO at the moment basically ignore resource requirements for linear stages ...
         def set_memory(st, cfg):
-            voxels = reduce(mul, volumeFromFile(source.path).getSizes())
+            voxels = minc_voxels(source.path)
+            st.setInputVoxels(voxels)
             st.setMem(voxels * cfg.mem_per_voxel + cfg.base_mem)
             # TODO make a wrapper to generate these set_memory functions?
 
@@ -380,7 +378,8 @@ def mincblur(img: MincAtom,
         # we pass the stage itself as an argument since the stage will be converted to an old-style CmdStage,
         # so `stage` will have no effect.  In order to receive this argument, hooks must now take a self-argument
         # (instead of no arguments as previously).
-        voxels = reduce(mul, volumeFromFile(img.path).getSizes())
+        voxels = minc_voxels(img.path)
+        stage.setInputVoxels(voxels)
         #default_mem = self.mem #hack; see pipeline.addStage method
         stage.setMem((mem_cfg.base_mem + voxels * mem_cfg.mem_per_voxel)
                      * (mem_cfg.tmpdir_factor if mem_cfg.include_tmpdir else 1))
@@ -582,7 +581,8 @@ def pmincaverage(imgs: List[MincAtom],
         avg.mask = combined_mask
 
     def set_memory(st, cfg):
-        voxels_per_file = reduce(mul, volumeFromFile(imgs[0].path).getSizes())
+        voxels_per_file = minc_voxels(imgs[0].path)
+        st.setInputVoxels(voxels_per_file * len(imgs))
         st.setMem(cfg.base_mem + voxels_per_file * cfg.mem_per_voxel * len(imgs))
 
     avg_cmd.when_runnable_hooks.append(lambda st: set_memory(st, default_pmincaverage_mem_cfg))
@@ -2067,10 +2067,13 @@ def lsq12_nlin_build_model(imgs       : List[MincAtom],
 
 
 def can_read_MINC_file(filename: str) -> bool:
-    """Can the MINC file `filename` with be read with `mincinfo`?"""
-    # FIXME is DEVNULL open/closed separately here (could be very slow)?!  investigate...
-    # if s(l)o(w), better to change to `can_read_MINC_files`?
-    return subprocess.call(["mincinfo", filename], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+    """Can the header of the MINC file `filename` be read?  (In-process, rather than by running `mincinfo`;
+    to check many files, use `validate_minc_files`.)"""
+    try:
+        read_minc_header(filename)
+    except Exception:
+        return False
+    return True
 
 
 def check_MINC_input_files(args: List[str]) -> None:
@@ -2085,16 +2088,8 @@ def check_MINC_input_files(args: List[str]) -> None:
     """
     if len(args) < 1:
         raise ValueError("\nNo input files are provided.\n")
-    # this part is disabled for now since `check_inputs` in `application.py` automatically checks _input_ minc files:
-    #else:
-    #    # here we should also check that the input files can be read
-    #    issuesWithInputs = False
-    #    for inputF in args:
-    #        if not can_read_MINC_file(inputF):  # FIXME this will be quite slow on SciNet, etc.
-    #            print("\nError: can not read input file: " + str(inputF) + "\n", file=sys.stderr)
-    #            issuesWithInputs = True
-    #    if issuesWithInputs:
-    #        raise ValueError("\nIssues reading input files.\n")
+    # we don't check that the files can be read here since `check_inputs` in `application.py`
+    # checks all _input_ minc files in one pass (see `validate_minc_files`)
 
     # lastly we should check that the actual filenames are distinct, because
     # directories are made based on the basename
@@ -2121,21 +2116,15 @@ def check_MINC_files_have_equal_dimensions_and_resolution(args: List[str],
     if len(args) < 2:
         return True
 
-    first_file = volumeFromFile(args[0])
-    img_dimensions_first = ([int(element) for element in first_file.getSizes()])
-    img_separations_first = first_file.separations
-    img_starts_first = first_file.starts
-    for other_img in args[1:]:
-        other_volume = volumeFromFile(other_img)
-        if not img_dimensions_first   == ([int(element) for element in other_volume.getSizes()]) or \
-            not img_separations_first == other_volume.separations or \
-            not img_starts_first      == other_volume.starts :
-            print("\nThe input files do not all have the same "
-                  "dimensions/starts/step sizes. The first input "
-                  "file:\n", str(args[0]), " differs from:\n",
-                  str(other_img), "\n")
-            raise ValueError("Not all input images have similar bounding boxes. "
-                             + additional_msg)
+    # reads the headers in parallel and reports all the files that differ, not just the first
+    try:
+        validate_minc_files(args, same_geometry=True)
+    except ValueError as e:
+        print("\nThe input files do not all have the same "
+              "dimensions/starts/step sizes:\n", str(e), "\n")
+        raise ValueError("Not all input images have similar bounding boxes. "
+                         + additional_msg) from e
+    return True
 
 
 # data structures to hold setting for the parameter settings we know about:
@@ -2805,10 +2794,10 @@ def get_resolution_from_file(input_file: str) -> float:
     input_file -- string pointing to an existing MINC file
     """
     # quite important is that this file actually exists...
-    if not can_read_MINC_file(input_file):
-        raise IOError("\nError: can not read input file: %s\n" % input_file)
-
-    image_resolution = volumeFromFile(input_file).separations
+    try:
+        image_resolution = read_minc_header(input_file).separations
+    except Exception as e:
+        raise IOError("\nError: can not read input file: %s\n" % input_file) from e
 
     return min([abs(x) for x in image_resolution])
 
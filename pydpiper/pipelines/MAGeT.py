@@ -319,10 +319,10 @@ def fixup_maget_options(lsq12_options, nlin_options, maget_options):
 
 
 # TODO support LSQ6 registrations??
-def maget(imgs : List[MincAtom], options, prefix, output_dir, build_model_xfms=None):
+def maget(imgs : List[MincAtom], options, prefix, output_dir, build_model_xfms=None, stages : Stages = None):
     # FIXME prefix, output_dir aren't used !!
 
-    s = Stages()
+    s = stages if stages is not None else Stages()
 
     maget_options = options.maget.maget
 
@@ -498,7 +498,7 @@ def maget(imgs : List[MincAtom], options, prefix, output_dir, build_model_xfms=N
         return Result(stages=s, output=segmented_imgs)
 
 
-def maget_pipeline(options):
+def maget_pipeline(options, stages : Stages = None):
 
     imgs = get_imgs(options.application)
     check_MINC_input_files([img.path for img in imgs])
@@ -523,7 +523,8 @@ def maget_pipeline(options):
     result = maget(imgs=imgs, options=options,
                    prefix=options.application.pipeline_name,
                    output_dir=options.application.output_directory,
-                   build_model_xfms=build_model_xfms)
+                   build_model_xfms=build_model_xfms,
+                   stages=stages)
 
     # TODO this should also be created by MBM and other pipelines that run MAGeT
     (pd.DataFrame({ 'img_file'   : result.output.apply(lambda row: row.path),
@@ -35,8 +35,9 @@ MBMConf = NamedTuple('MBMConf', [('lsq6',  LSQ6Conf),
                                  ('stats', StatsConf)])
 
 
-def mbm_pipeline(options : MBMConf):
-    s = Stages()
+def mbm_pipeline(options : MBMConf, stages : Stages = None):
+    # (stages are added to `stages`, if given, as they're constructed; see `application.execute_streaming`)
+    s = stages if stages is not None else Stages()
 
     imgs = get_imgs(options.application)
 
@@ -46,7 +47,8 @@ def mbm_pipeline(options : MBMConf):
 
     mbm_result = s.defer(mbm(imgs=imgs, options=options,
                              prefix=options.application.pipeline_name,
-                             output_dir=output_dir))
+                             output_dir=output_dir,
+                             stages=s))
 
     if options.mbm.common_space.do_common_space_registration:
         s.defer(common_space(mbm_result, options))
@@ -208,7 +210,8 @@ def mbm(imgs : List[MincAtom],
         options : MBMConf,
         prefix : str,
         output_dir : str = "",
-        with_maget : bool = True):
+        with_maget : bool = True,
+        stages : Stages = None):
 
     # TODO could also allow pluggable pipeline parts e.g. LSQ6 could be substituted out for the modified LSQ6
     # for the kidney tips, etc...
@@ -218,7 +221,7 @@ def mbm(imgs : List[MincAtom],
     lsq12_dir = os.path.join(output_dir, prefix + "_lsq12")
     nlin_dir  = os.path.join(output_dir, prefix + "_nlin")
 
-    s = Stages()
+    s = stages if stages is not None else Stages()
 
     if len(imgs) == 0:
         raise ValueError("Please, some files!")
@@ -412,7 +415,8 @@ def mbm(imgs : List[MincAtom],
                                #[xfm.resampled for _ix, xfm in mbm_result.xfms.rigid_xfm.iteritems()],
                                options=maget_options,
                                prefix="%s_MAGeT" % prefix,
-                               output_dir=os.path.join(output_dir, prefix + "_processed")))
+                               output_dir=os.path.join(output_dir, prefix + "_processed"),
+                               stages=s))
         # FIXME add pipeline dir to path and uncomment!
         #maget.to_csv(path_or_buf="segmentations.csv", columns=['img', 'voted_labels'])
 
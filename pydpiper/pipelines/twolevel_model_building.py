@@ -16,7 +16,7 @@ from pydpiper.minc.registration import (concat_xfmhandlers, invert_xfmhandler, m
                                         TargetType, get_pride_of_models_mapping, get_resolution_from_file,
                                         registration_targets)
 from pydpiper.pipelines.MBM import mbm, MBMConf, mk_mbm_parser
-from pydpiper.execution.application import execute
+from pydpiper.execution.application import construct_and_execute
 from pydpiper.core.util import NamedTuple, maybe_deref_path
 from pydpiper.core.stages import Stages, Result
 from pydpiper.core.arguments import (AnnotatedParser, CompoundParser, application_parser,
@@ -30,7 +30,7 @@ TwoLevelConf = NamedTuple("TwoLevelConf", [("first_level_conf",  MBMConf),
 
 
 
-def two_level_pipeline(options : TwoLevelConf):
+def two_level_pipeline(options : TwoLevelConf, stages : Stages = None):
 
     def relativize_path(fp):
         #this annoying function takes care of the csv_paths_relative_to_wd flag.
@@ -64,7 +64,7 @@ def two_level_pipeline(options : TwoLevelConf):
         check_MINC_input_files(g.file.map(lambda x: x.path))
     #check_MINC_input_files(files_df.file.map(lambda x: x.path))
 
-    pipeline = two_level(grouped_files_df=files_df, options=options)
+    pipeline = two_level(grouped_files_df=files_df, options=options, stages=stages)
 
     # TODO write these into the appropriate subdirectory ...
     overall = (pipeline.output.overall_determinants
@@ -95,11 +95,12 @@ def two_level_pipeline(options : TwoLevelConf):
     return pipeline
 
 
-def two_level(grouped_files_df, options : TwoLevelConf):
+def two_level(grouped_files_df, options : TwoLevelConf, stages : Stages = None):
     """
     grouped_files_df - must contain 'group':<any comparable, sortable type> and 'file':MincAtom columns
+    stages - if given, the stages are added to this as they're constructed
     """  # TODO weird naming since the grouped_files_df isn't a GroupBy object?  just files_df?
-    s = Stages()
+    s = stages if stages is not None else Stages()
 
     if grouped_files_df.isnull().values.any():
         raise ValueError("NaN values in input dataframe; can't go")
@@ -155,7 +156,8 @@ def two_level(grouped_files_df, options : TwoLevelConf):
                                                           output_dir=os.path.join(
                                                               options.application.output_directory,
                                                               options.application.pipeline_name + "_first_level",
-                                                              "%s_processed" % row.group)))))
+                                                              "%s_processed" % row.group),
+                                                          stages=s))))
         )
 
     # TODO replace .assign(...apply(...)...) with just an apply, producing a series right away?
@@ -183,7 +185,8 @@ def two_level(grouped_files_df, options : TwoLevelConf):
     second_level_results = s.defer(mbm(imgs=first_level_results.build_model.map(lambda m: m.avg_img),
                                        options=second_level_options,
                                        prefix=os.path.join(options.application.output_directory,
-                                                           options.application.pipeline_name + "_second_level")))
+                                                           options.application.pipeline_name + "_second_level"),
+                                       stages=s))
 
     # FIXME sadly, `mbm` doesn't return a pd.Series of xfms, so we don't have convenient indexing ...
     overall_xfms = [s.defer(concat_xfmhandlers([xfm_1, xfm_2]))
@@ -301,7 +304,7 @@ def main(args):
 
     options = parse(p, args[1:])
 
-    execute(two_level_pipeline(options).stages, options)
+    construct_and_execute(two_level_pipeline, options)
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -0,0 +1,124 @@
+import os
+import shutil
+import subprocess
+import time
+
+import pytest
+
+from pydpiper.execution.cache import ResultCache
+
+
+def fake_stage(tmpdir, run_dir, fwhm="0.5"):
+    """A stand-in for a mincblur stage (input, output and command) in the given pipeline directory."""
+    d = tmpdir.join(run_dir)
+    d.ensure(dir=True)
+    inp = str(d.join("atlas.mnc"))
+    if not os.path.exists(inp):
+        with open(inp, 'w') as f:
+            f.write("atlas voxels\n")
+    out = str(d.join("blurred", "atlas_fwhm%s_blur.mnc" % fwhm))
+    cmd = ["sh", "-c", "'(cat %s; echo fwhm=%s) > %s'" % (inp, fwhm, out)]
+    return cmd, [inp], [out]
+
+
+def run(cache, cmd, inputs, outputs):
+    """Run a stage as an executor would; returns whether its results came from the cache."""
+    key = cache.key(cmd, inputs, outputs)
+    if key is not None and cache.materialize(key, outputs):
+        return True
+    for o in outputs:
+        os.makedirs(os.path.dirname(o), exist_ok=True)
+    subprocess.check_call(" ".join(cmd), shell=True)
+    cache.store(key, outputs, cmd=cmd)
+    return False
+
+
+@pytest.fixture()
+def cache(tmpdir):
+    return ResultCache(str(tmpdir.join("cache")))
+
+
+class TestResultCache():
+    def test_reused_across_pipelines(self, cache, tmpdir):
+        assert not run(cache, *fake_stage(tmpdir, "run1"))
+        cmd, inputs, outputs = fake_stage(tmpdir, "run2")
+        assert run(cache, cmd, inputs, outputs)
+        assert open(outputs[0]).read() == "atlas voxels\nfwhm=0.5\n"
+
+    def test_different_parameters_miss(self, cache, tmpdir):
+        run(cache, *fake_stage(tmpdir, "run1", fwhm="0.5"))
+        assert not run(cache, *fake_stage(tmpdir, "run2", fwhm="1.0"))
+
+    def test_changed_input_misses(self, cache, tmpdir):
+        run(cache, *fake_stage(tmpdir, "run1"))
+        cmd, inputs, outputs = fake_stage(tmpdir, "run2")
+        with open(inputs[0], 'w') as f:
+            f.write("another atlas\n")
+        assert not run(cache, cmd, inputs, outputs)
+        assert open(outputs[0]).read().startswith("another atlas")
+
+    def test_modified_entry_discarded(self, cache, tmpdir):
+        cmd, inputs, outputs = fake_stage(tmpdir, "run1")
+        run(cache, cmd, inputs, outputs)
+        key = cache.key(cmd, inputs, outputs)
+        with open(os.path.join(cache.entry(key), "0"), 'a') as f:
+            f.write("corruption")
+        assert not cache.materialize(key, [str(tmpdir.join("elsewhere.mnc"))])
+        assert not os.path.exists(cache.entry(key))
+
+    def test_clobbering_rerun_doesnt_change_other_copies(self, cache, tmpdir):
+        run(cache, *fake_stage(tmpdir, "run1"))
+        _, _, restored = fake_stage(tmpdir, "run2")
+        cmd, inputs, outputs = fake_stage(tmpdir, "run3")
+        assert run(cache, *fake_stage(tmpdir, "run2")) and run(cache, cmd, inputs, outputs)
+        # rerunning the stage in one pipeline rewrites its output in place (as with -clobber)
+        with open(outputs[0], 'r+') as f:
+            f.write("ATLAS")
+        assert open(restored[0]).read() == "atlas voxels\nfwhm=0.5\n"
+        assert run(cache, *fake_stage(tmpdir, "run4"))
+
+    def test_transforms_uncacheable(self, cache, tmpdir):
+        cmd, inputs, outputs = fake_stage(tmpdir, "run1")
+        xfm = str(tmpdir.join("run1", "nlin.xfm"))
+        assert cache.key(cmd, inputs, outputs) is not None
+        assert cache.key(cmd + [xfm], inputs, outputs + [xfm]) is None
+        with open(xfm, 'w') as f:
+            f.write("Transform_Type = Grid_Transform;\nDisplacement_Volume = nlin_grid_0.mnc;\n")
+        assert cache.key(cmd + [xfm], inputs + [xfm], outputs) is None
+
+    def test_restored_outputs_newer_than_inputs(self, cache, tmpdir):
+        run(cache, *fake_stage(tmpdir, "run1"))
+        # (the new pipeline's input is written after the cache entry was made)
+        cmd, inputs, outputs = fake_stage(tmpdir, "run2")
+        assert run(cache, cmd, inputs, outputs)
+        assert os.stat(outputs[0]).st_mtime_ns >= os.stat(inputs[0]).st_mtime_ns
+
+    def test_missing_input_uncacheable(self, cache, tmpdir):
+        assert cache.key(["cat", "nonexistent"], [str(tmpdir.join("nonexistent"))], ["out"]) is None
+
+    def test_evict_by_age(self, cache, tmpdir):
+        cmd, inputs, outputs = fake_stage(tmpdir, "run1")
+        run(cache, cmd, inputs, outputs)
+        key = cache.key(cmd, inputs, outputs)
+        old = time.time() - 10 * 24 * 3600
+        os.utime(os.path.join(cache.entry(key), "meta.json"), (old, old))
+        assert cache.evict(max_age=24 * 3600) == 1
+        assert cache.entries() == []
+
+    def test_evict_least_recently_used(self, cache, tmpdir):
+        for fwhm in ["0.25", "0.5", "1.0"]:
+            run(cache, *fake_stage(tmpdir, "run1", fwhm=fwhm))
+            time.sleep(0.01)
+        # use the oldest again
+        assert run(cache, *fake_stage(tmpdir, "run2", fwhm="0.25"))
+        size = sum(s for _, _, s in cache.entries())
+        assert cache.evict(max_bytes=size - 1) == 1
+        cmd, inputs, outputs = fake_stage(tmpdir, "run3", fwhm="0.5")
+        assert cache.key(cmd, inputs, outputs) not in [k for k, _, _ in cache.entries()]
+
+    def test_store_doesnt_replace_entry(self, cache, tmpdir):
+        cmd, inputs, outputs = fake_stage(tmpdir, "run1")
+        run(cache, cmd, inputs, outputs)
+        assert not cache.store(cache.key(cmd, inputs, outputs), outputs)
+        shutil.rmtree(str(tmpdir.join("run1")))
+        assert run(cache, *fake_stage(tmpdir, "run1"))
@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+from pydpiper.execution import directories
+from pydpiper.execution.directories import DirectoryCache, unique_directories
+
+
+@pytest.fixture()
+def out_dir(tmpdir):
+    return str(tmpdir.mkdir("pipeline"))
+
+
+class TestUniqueDirectories():
+    def test_nested_and_unnormalized(self):
+        assert unique_directories(["/o/a/./x.mnc", "/o/a/b/y.mnc", "/o/ab/z.mnc", "/o/x.log", "x.log"]) \
+            == ["/o/a/b", "/o/ab"]
+
+    def test_relative(self):
+        assert unique_directories(["a/b/x.mnc", "a/y.mnc", "c/z.mnc"]) == ["a/b", "c"]
+
+
+class TestDirectoryCache():
+    def test_prepare(self, out_dir, monkeypatch):
+        calls = []
+        makedirs = os.makedirs
+        monkeypatch.setattr(directories.os, "makedirs", lambda d, **kw: calls.append(d) or makedirs(d, **kw))
+        c = DirectoryCache()
+        dirs = [os.path.join(out_dir, s, str(i)) for s in ("a", "b") for i in range(20)]
+        c.prepare(dirs + [os.path.join(out_dir, "a")], threads=4)
+        assert all(os.path.isdir(d) for d in dirs)
+        # (`os.makedirs` also calls itself to create the parents)
+        assert set(dirs) <= set(calls)
+        n = len(calls)
+        # neither the directories nor their parents are created again
+        c.prepare([os.path.join(out_dir, "a")] + dirs[:5])
+        c.makedirs(os.path.join(dirs[0], "."))
+        assert len(calls) == n
+        c.makedirs(os.path.join(out_dir, "c"))
+        assert os.path.isdir(os.path.join(out_dir, "c")) and calls[n:] == [os.path.join(out_dir, "c")]
+
+    def test_errors_raised(self, out_dir):
+        f = os.path.join(out_dir, "file")
+        open(f, 'w').close()
+        with pytest.raises(OSError):
+            DirectoryCache().prepare([os.path.join(out_dir, "ok"), os.path.join(f, "sub")])
@@ -0,0 +1,89 @@
+import random
+
+import networkx as nx
+import numpy as np
+import pytest
+
+from pydpiper.execution.graph import StageGraph
+from pydpiper.execution.scheduling import critical_path_priorities, new_stage_priorities
+
+
+@pytest.fixture()
+def edges():
+    # a random DAG (edges always go from lower to higher indices), with some duplicate edges
+    rng = random.Random(1)
+    es = [(i, j) for j in range(200) for i in rng.sample(range(j), min(j, 3))]
+    return es + es[:20]
+
+
+@pytest.fixture()
+def graphs(edges):
+    G = nx.DiGraph()
+    G.add_nodes_from(range(200))
+    G.add_edges_from(edges)
+    return G, StageGraph(200, [i for i, _ in edges], [j for _, j in edges])
+
+
+class Stage(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class TestStageGraph():
+    def test_same_as_networkx(self, graphs):
+        G, S = graphs
+        assert S.order() == G.order() and S.number_of_edges() == G.number_of_edges()
+        for n in G:
+            assert sorted(S.successors(n)) == sorted(G.successors(n))
+            assert sorted(S.predecessors(n)) == sorted(G.predecessors(n))
+            assert S.in_degree(n) == G.in_degree(n) and S.out_degree(n) == G.out_degree(n)
+        assert S.descendants(5) == nx.descendants(G, 5)
+
+    def test_topological_order(self, graphs):
+        _, S = graphs
+        position = { n : ix for ix, n in enumerate(S.topological_order()) }
+        assert len(position) == S.order()
+        assert all(position[i] < position[j] for i in S for j in S.successors(i))
+
+    def test_cycle(self):
+        with pytest.raises(ValueError):
+            StageGraph(2, [0, 1], [1, 0]).topological_order()
+
+    def test_in_degrees_excluding(self, graphs):
+        G, S = graphs
+        exclude = np.zeros(200, dtype=bool)
+        exclude[:50] = True
+        assert S.in_degrees(exclude).tolist() == [len([m for m in G.predecessors(n) if m >= 50]) for n in G]
+
+    def test_priorities_same_as_networkx(self, graphs):
+        G, S = graphs
+        stages = [Stage(random.Random(n).choice(["minctracc", "mincblur", "mincpik"])) for n in G]
+        assert critical_path_priorities(S, stages) == critical_path_priorities(G, stages)
+
+    def test_extended_in_small_batches(self, graphs, edges):
+        G, S = graphs
+        stages = [Stage(random.Random(n).choice(["minctracc", "mincblur", "mincpik"])) for n in G]
+        # (edges go from lower to higher indices, so each batch's edges lead to its own nodes)
+        E = StageGraph(0, [], [])
+        for first in range(0, 200, 7):
+            last = min(first + 7, 200)
+            batch = [(i, j) for i, j in edges if first <= j < last]
+            E.extend(last, [i for i, _ in batch], [j for _, j in batch])
+            new = range(first, last)
+            assert new_stage_priorities(E, stages, new) == critical_path_priorities(E, stages)[first:last]
+            assert E.in_degrees_of(new, lambda p: p < 50).tolist() \
+                == [len([m for m in G.predecessors(n) if m >= 50]) for n in new]
+        assert E.order() == S.order() and E.number_of_edges() == S.number_of_edges()
+        assert all(sorted(E.successors(n)) == sorted(S.successors(n)) and E.predecessors(n) == S.predecessors(n)
+                   for n in G)
+        assert E.in_degrees().tolist() == S.in_degrees().tolist()
+
+    def test_extend_only_into_new_nodes(self, graphs):
+        _, S = graphs
+        with pytest.raises(ValueError):
+            S.extend(201, [200], [3])
+
+    def test_to_networkx(self, graphs):
+        G, S = graphs
+        H = S.to_networkx(lambda i: { "label" : str(i) })
+        assert sorted(H.edges()) == sorted(G.edges()) and H.nodes[3]["label"] == "3"
@@ -0,0 +1,76 @@
+import pytest
+
+from pydpiper.execution.history import StageHistory
+from pydpiper.execution.estimation import MemoryEstimator
+
+
+@pytest.fixture()
+def history(tmpdir):
+    return StageHistory(str(tmpdir.join("history.db")))
+
+
+class TestStageHistory():
+    def test_record_and_query(self, history):
+        history.record(program="minctracc", input_voxels=100, pipeline_name="p",
+                       usage={"wall_time": 10.0, "cpu_time": 9.0, "peak_rss": 1.5}, mem_requested=2.0, procs=1)
+        history.record(program="minctracc", input_voxels=200,
+                       usage={"wall_time": 30.0, "cpu_time": 29.0, "peak_rss": 3.0})
+        history.record(program="mincblur", input_voxels=None,
+                       usage={"wall_time": 1.0, "cpu_time": 1.0, "peak_rss": 0.1})
+        assert len(history.runs("minctracc")) == 2
+        assert [r["peak_rss"] for r in history.runs("minctracc", input_voxels=200)] == [3.0]
+        assert history.runs("ANTS") == []
+
+    def test_persists_across_connections(self, history):
+        history.record(program="mincblur", input_voxels=5,
+                       usage={"wall_time": 1.0, "cpu_time": 0.5, "peak_rss": 0.1})
+        history.close()
+        assert len(StageHistory(history.filename).runs("mincblur", input_voxels=5)) == 1
+
+    def test_summary(self, history):
+        for t in [1.0, 3.0]:
+            history.record(program="mincblur", input_voxels=5,
+                           usage={"wall_time": t, "cpu_time": t, "peak_rss": t / 10})
+        summary = history.summary()["mincblur"]
+        assert summary["runs"] == 2
+        assert summary["mean_wall_time"] == 2.0
+        assert summary["total_cpu_time"] == 4.0
+        assert summary["max_peak_rss"] == 0.3
+
+
+class Stage(object):
+    def __init__(self, name, input_voxels, mem=1.0):
+        self.name, self.input_voxels, self.mem = name, input_voxels, mem
+    def setMem(self, mem):
+        self.mem = mem
+
+
+class TestMemoryEstimator():
+    def test_needs_enough_history(self, history):
+        e = MemoryEstimator(history, min_runs=2)
+        history.record(program="ANTS", input_voxels=10, usage={"peak_rss": 1.0})
+        assert e.estimate_stage(Stage("ANTS", 10)) is None
+
+    def test_upper_envelope(self, history):
+        for voxels, rss in [(10, 1.0), (10, 1.5), (20, 2.0), (20, 2.2)]:
+            history.record(program="ANTS", input_voxels=voxels, usage={"peak_rss": rss})
+        e = MemoryEstimator(history, margin=1.0)
+        for voxels, rss in [(10, 1.5), (20, 2.2)]:
+            assert e.estimate("ANTS", voxels) >= rss - 1e-9
+
+    def test_never_less_for_larger_inputs(self, history):
+        # (e.g., a few large inputs happened to need little memory)
+        for voxels, rss in [(10, 4.0), (20, 4.0), (30, 1.0), (40, 1.2)]:
+            history.record(program="ANTS", input_voxels=voxels, usage={"peak_rss": rss})
+        e = MemoryEstimator(history, margin=1.0)
+        assert e.model("ANTS").mem_per_voxel >= 0
+        assert all(e.estimate("ANTS", v) >= 4.0 for v in [20, 40, 100, 10**6])
+
+    def test_bump(self, history):
+        for voxels in [10, 20, 30]:
+            history.record(program="ANTS", input_voxels=voxels, usage={"peak_rss": 1.0})
+        e = MemoryEstimator(history, margin=1.0)
+        s = Stage("/opt/bin/ANTS", 10, mem=e.estimate("ANTS", 10))
+        e.bump(s, 2)
+        assert e.estimate_stage(s) == pytest.approx(2.0)
+        assert e.estimate("mincblur", 10) is None
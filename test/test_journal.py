@@ -0,0 +1,87 @@
+import os
+import time
+
+import pytest
+
+from pydpiper.execution.journal import (FinishedStagesJournal, MAGIC, compact_journal,
+                                        encode_record, read_journal)
+
+
+@pytest.fixture()
+def filename(tmpdir):
+    return str(tmpdir.join("pipeline_finished_stages"))
+
+
+class TestFinishedStagesJournal():
+    def test_round_trip(self, filename):
+        with FinishedStagesJournal(filename) as j:
+            for i in range(1000):
+                j.append(i, "%032x" % i)
+        assert list(read_journal(filename)) == [(i, "%032x" % i) for i in range(1000)]
+
+    def test_group_commit(self, filename):
+        j = FinishedStagesJournal(filename, flush_entries=3, flush_interval=60)
+        j.append(0, "a"); j.append(1, "b")
+        assert list(read_journal(filename)) == []
+        j.append(2, "c")
+        assert len(list(read_journal(filename))) == 3
+        j.close()
+
+    def test_flushed_after_interval(self, filename):
+        j = FinishedStagesJournal(filename, flush_entries=100, flush_interval=0.1)
+        j.append(0, "a")
+        for _ in range(50):
+            if list(read_journal(filename)):
+                break
+            time.sleep(0.02)
+        assert list(read_journal(filename)) == [(0, "a")]
+        j.close()
+
+    def test_torn_record_truncated_on_reopen(self, filename):
+        with FinishedStagesJournal(filename) as j:
+            j.append(0, "a")
+        with open(filename, 'ab') as fh:
+            fh.write(encode_record(1, "b")[:-2])
+        with FinishedStagesJournal(filename) as j:
+            j.append(2, "c")
+        assert list(read_journal(filename)) == [(0, "a"), (2, "c")]
+
+    def test_corrupt_record(self, filename):
+        with FinishedStagesJournal(filename) as j:
+            j.append(0, "a"); j.append(1, "b")
+        with open(filename, 'r+b') as fh:
+            fh.seek(-1, os.SEEK_END)
+            fh.write(b"z")
+        assert list(read_journal(filename)) == [(0, "a")]
+
+    def test_old_text_format(self, filename):
+        with open(filename, 'w') as fh:
+            fh.write("0,abc\n1,def\n2,gh")
+        assert list(read_journal(filename))[:2] == [(0, "abc"), (1, "def")]
+        with FinishedStagesJournal(filename) as j:
+            j.append(3, "ijk")
+        with open(filename, 'rb') as fh:
+            assert fh.read().startswith(MAGIC)
+        assert [h for _, h in read_journal(filename)] == ["abc", "def", "gh", "ijk"]
+
+    def test_compacted_in_background(self, filename):
+        j = FinishedStagesJournal(filename, flush_entries=100, flush_interval=0.05, compact_records=20)
+        for n in range(5):
+            for i in range(5):
+                j.append(5 * n + i, "%d" % i)
+        for _ in range(100):
+            if len(list(read_journal(filename))) == 5:
+                break
+            time.sleep(0.02)
+        assert list(read_journal(filename)) == [(20 + i, "%d" % i) for i in range(5)]
+        j.append(25, "5")
+        j.close()
+        assert list(read_journal(filename))[-2:] == [(24, "4"), (25, "5")]
+
+    def test_compact(self, filename):
+        with FinishedStagesJournal(filename) as j:
+            for i in range(10):
+                j.append(i, str(i))
+        compact_journal(filename, [(0, "3"), (1, "7")])
+        assert list(read_journal(filename)) == [(0, "3"), (1, "7")]
+        assert not os.path.exists(filename + ".tmp")
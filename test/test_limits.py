@@ -0,0 +1,118 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from pydpiper.execution.limits import (ProcSlots, StageCgroups, confine, gated_command, memory_limit, pinnable_cpus,
+                                      reports_allocation_failure)
+
+
+class TestProcSlots():
+    @pytest.mark.parametrize("nodes", [None, [[0, 2, 4], [1, 3, 5, 7, 9]]])
+    def test_never_oversubscribed(self, nodes):
+        total = 8 if nodes is not None else 4
+        slots, lock = ProcSlots(total, nodes=nodes), threading.Lock()
+        in_use, peak = set(), [0]
+
+        def stage(procs):
+            taken = slots.acquire(procs)
+            with lock:
+                assert len(taken) == min(procs, total) and not in_use & set(taken)
+                in_use.update(taken)
+                peak[0] = max(peak[0], len(in_use))
+            time.sleep(0.02)
+            with lock:
+                in_use.difference_update(taken)
+            slots.release(taken)
+
+        threads = [threading.Thread(target=stage, args=(p,)) for p in [4, 1, 2, 3, 8, 1, 1, 2] * 3]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert peak[0] <= total and slots.free == total
+
+    def test_numa_placement(self):
+        slots = ProcSlots(8, nodes=[[0, 1, 2, 3], [4, 5, 6, 7]])
+        a, b = slots.acquire(3), slots.acquire(2)
+        assert (a, b) == ((0, 1, 2), (4, 5))
+        # fits on neither node, so spread over both
+        assert slots.acquire(3) == (3, 6, 7)
+        slots.release(a)
+        assert slots.acquire(2) == (0, 1)
+
+
+class TestPinnableCpus():
+    def test_within_affinity(self):
+        cpus = sorted(os.sched_getaffinity(0))
+        nodes = pinnable_cpus(len(cpus))
+        assert sorted(c for n in nodes for c in n) == cpus
+        assert sum(len(n) for n in pinnable_cpus(1)) == 1
+        assert pinnable_cpus(len(cpus) + 1) is None
+
+
+@pytest.fixture()
+def cgroup_root(tmpdir):
+    return str(tmpdir.mkdir("cgroup"))
+
+
+class TestStageCgroups():
+    def test_lifecycle(self, cgroup_root):
+        # (the interface files of a real cgroup are created by the kernel)
+        cgroups = StageCgroups(cgroup_root)
+        path = cgroups.create("stage-1", memory_limit(0.5, factor=2))
+        with open(os.path.join(path, "memory.max")) as f:
+            assert f.read() == str(2**30)
+        assert StageCgroups.usage(path) == { "peak_mem" : None, "oom_kills" : None }
+        with open(os.path.join(path, "memory.peak"), 'w') as f:
+            f.write("%d\n" % 2**29)
+        with open(os.path.join(path, "memory.events"), 'w') as f:
+            f.write("low 0\nhigh 0\nmax 3\noom 1\noom_kill 1\n")
+        assert StageCgroups.usage(path) == { "peak_mem" : 0.5, "oom_kills" : 1 }
+        StageCgroups.remove(path)  # (not empty, so it isn't removed, but that's not an error)
+        assert os.path.isdir(path)
+
+
+def run_confined(cmd, **limits):
+    """Run a shell command confined (once started, as an executor does) with the given limits."""
+    p = subprocess.Popen(gated_command(cmd), shell=True,
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    confine(p.pid, **limits)
+    out, err = p.communicate(b"\n")
+    return p.returncode, out, err
+
+
+class TestConfine():
+    @pytest.mark.skipif(not sys.platform.startswith("linux"), reason="RLIMIT_AS is only reliable on Linux")
+    def test_rlimit(self):
+        cmd = "%s -c 'x = bytearray(2**30)'" % sys.executable
+        returncode, _, err = run_confined(cmd, rlimit=memory_limit(0.5, factor=1))
+        assert returncode != 0 and b"MemoryError" in err
+        assert run_confined(cmd)[0] == 0
+
+    @pytest.mark.skipif(not sys.platform.startswith("linux"), reason="RLIMIT_AS is only reliable on Linux")
+    def test_allocation_failure_reported(self, tmpdir):
+        log = str(tmpdir.join("stage.log"))
+        with open(log, 'w') as of:
+            of.write("Stage 1 running ...\n")
+            of.flush()
+            start = of.tell()
+            p = subprocess.Popen(gated_command("%s -c 'x = bytearray(2**30)'" % sys.executable), shell=True,
+                                 stdin=subprocess.PIPE, stdout=of, stderr=of)
+            confine(p.pid, rlimit=memory_limit(0.5, factor=1))
+            p.communicate(b"\n")
+        assert p.returncode != 0 and reports_allocation_failure(log, start)
+
+    @pytest.mark.skipif(not hasattr(os, "sched_setaffinity"), reason="no CPU affinity")
+    def test_pinning(self):
+        cpu = min(os.sched_getaffinity(0))
+        _, out, _ = run_confined("%s -c 'import os; print(sorted(os.sched_getaffinity(0)))'" % sys.executable,
+                                 cpus=[cpu])
+        assert out.decode().strip() == "[%d]" % cpu
+
+    def test_not_run_unless_confined(self):
+        p = subprocess.Popen(gated_command("echo ran"), shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        assert p.communicate(b"")[0] == b"" and p.returncode == 125
@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+from pydpiper.execution.scheduling import BackgroundCalls
+from pydpiper.minc.files import MincHeader, MincHeaderCache
+
+
+@pytest.fixture()
+def minc2_files(tmpdir):
+    try:
+        from pyminc.volumes import factory
+    except Exception as e:  # (pyminc fails in various ways if it can't load libminc)
+        pytest.skip("libminc isn't available: %s" % e)
+    files = []
+    for i in range(8):
+        f = str(tmpdir.join("img%d.mnc" % i))
+        vol = factory.volumeFromDescription(f, dimnames=("zspace", "yspace", "xspace"), sizes=(10, 20, 30 + i),
+                                            starts=(0., 0., 0.), steps=(1., 1., 1.), volumeType="ushort")
+        vol.writeFile()
+        vol.closeVolume()
+        files.append(f)
+    return files
+
+
+@pytest.fixture()
+def img(tmpdir):
+    f = str(tmpdir.join("img.mnc"))
+    with open(f, 'w') as fh:
+        fh.write("not really MINC")
+    return f
+
+
+class FakeReader(object):
+    def __init__(self):
+        self.reads = []
+
+    def __call__(self, path):
+        self.reads.append(path)
+        return MincHeader(sizes=(10, 20, 30), separations=(0.05, 0.05, 0.05), starts=(-1., -2., -3.), dtype="short")
+
+
+class TestMincHeaderCache():
+    def test_read_once(self, img):
+        reader = FakeReader()
+        headers = MincHeaderCache(read_header=reader)
+        for _ in range(5):
+            assert headers.voxels(img) == 6000
+        assert len(reader.reads) == 1
+
+    def test_reread_when_changed(self, img):
+        reader = FakeReader()
+        headers = MincHeaderCache(read_header=reader)
+        headers.get(img)
+        with open(img, 'a') as fh:
+            fh.write("more voxels")
+        headers.get(img)
+        assert len(reader.reads) == 2
+
+    def test_persisted(self, img, tmpdir):
+        db = str(tmpdir.join("headers.db"))
+        first = MincHeaderCache(db, read_header=FakeReader())
+        header = first.get(img)
+        reader = FakeReader()
+        assert MincHeaderCache(db, read_header=reader).get(img) == header
+        assert reader.reads == []
+
+    def test_missing_file(self, tmpdir):
+        with pytest.raises(FileNotFoundError):
+            MincHeaderCache(read_header=FakeReader()).get(str(tmpdir.join("missing.mnc")))
+
+    def test_many_hooks_at_once(self, minc2_files):
+        # as when the server evaluates many stages' memory hooks in its background threads;
+        # (a new cache for each call, so that every call reads its file with libminc)
+        calls = BackgroundCalls(threads=8)
+        keys = [(n, f) for n in range(8) for f in minc2_files]
+        for key in keys:
+            calls.submit(key, lambda f: MincHeaderCache().voxels(f), key[1])
+        assert all(calls.wait(key, timeout=60) for key in keys)
+        results = calls.completed()
+        assert all(exc is None for _, _, exc in results)
+        assert sorted(results) == sorted(((n, f), 10 * 20 * (30 + minc2_files.index(f)), None) for n, f in keys)
@@ -0,0 +1,89 @@
+import struct
+
+import pytest
+
+from pydpiper.minc.files import MincHeaderCache, read_header, read_minc1_header, validate_minc_files
+
+
+def _name(s):
+    b = s.encode()
+    return struct.pack(">i", len(b)) + b + b"\0" * (-len(b) % 4)
+
+
+def _attrs(attrs):
+    if not attrs:
+        return struct.pack(">ii", 0, 0)
+    out = struct.pack(">ii", 0x0C, len(attrs))
+    for name, value in attrs.items():
+        if isinstance(value, str):
+            raw = value.encode()
+            out += _name(name) + struct.pack(">ii", 2, len(raw)) + raw + b"\0" * (-len(raw) % 4)
+        else:
+            out += _name(name) + struct.pack(">ii", 6, 1) + struct.pack(">d", value)
+    return out
+
+
+def write_minc1(path, sizes=(3, 4, 5), steps=(0.1, 0.1, 0.2), starts=(-1.0, -2.0, -3.0), truncate=0):
+    """A minimal MINC1 (netCDF classic) file with a short image of the given geometry."""
+    dims = ["zspace", "yspace", "xspace"]
+    header = b"CDF\x01" + struct.pack(">i", 0)
+    header += struct.pack(">ii", 0x0A, 3) + b"".join(_name(d) + struct.pack(">i", n) for d, n in zip(dims, sizes))
+    header += _attrs({})
+    voxels = sizes[0] * sizes[1] * sizes[2]
+    variables = [(d, [], { "step" : step, "start" : start }, 6, 0) for d, step, start in zip(dims, steps, starts)]
+    variables.append(("image", [0, 1, 2], { "signtype" : "signed__" }, 3, 2 * voxels))
+
+    def var_list(begin):
+        out = struct.pack(">ii", 0x0B, len(variables))
+        for name, dimids, attrs, nc_type, vsize in variables:
+            out += (_name(name) + struct.pack(">i", len(dimids)) + b"".join(struct.pack(">i", d) for d in dimids)
+                    + _attrs(attrs) + struct.pack(">iii", nc_type, vsize, begin))
+        return out
+    begin = len(header) + len(var_list(0))
+    data = header + var_list(begin) + b"\0" * (2 * voxels - truncate)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+class TestMinc1Header():
+    def test_geometry(self, tmpdir):
+        h = read_minc1_header(write_minc1(str(tmpdir.join("a.mnc"))))
+        assert h.sizes == (3, 4, 5)
+        assert h.separations == (0.1, 0.1, 0.2)
+        assert h.starts == (-1.0, -2.0, -3.0)
+        assert h.dtype == "short"
+
+    def test_truncated(self, tmpdir):
+        with pytest.raises(ValueError):
+            read_minc1_header(write_minc1(str(tmpdir.join("a.mnc")), truncate=10))
+
+    def test_not_minc(self, tmpdir):
+        f = tmpdir.join("a.mnc")
+        f.write("hello")
+        with pytest.raises(ValueError):
+            read_header(str(f))
+
+
+class TestValidateMincFiles():
+    @pytest.fixture(autouse=True)
+    def fresh_cache(self, monkeypatch):
+        import pydpiper.minc.files
+        monkeypatch.setattr(pydpiper.minc.files, "minc_headers", MincHeaderCache())
+
+    def test_all_problems_reported(self, tmpdir):
+        good = [write_minc1(str(tmpdir.join("img_%d.mnc" % i))) for i in range(20)]
+        bad = write_minc1(str(tmpdir.join("bad.mnc")), truncate=1)
+        different = write_minc1(str(tmpdir.join("different.mnc")), sizes=(3, 4, 6))
+        missing = str(tmpdir.join("missing.mnc"))
+        with pytest.raises(ValueError) as e:
+            validate_minc_files(good + [bad, different, missing], same_geometry=True, processes=2)
+        message = str(e.value)
+        assert "3 input file(s)" in message
+        assert all(f in message for f in [bad, different, missing])
+        assert not any(f in message for f in good[1:])
+
+    def test_headers_returned(self, tmpdir):
+        files = [write_minc1(str(tmpdir.join("img_%d.mnc" % i))) for i in range(3)]
+        headers = validate_minc_files(files, same_geometry=True)
+        assert [headers[f].sizes for f in files] == [(3, 4, 5)] * 3
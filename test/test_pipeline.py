@@ -0,0 +1,27 @@
+import os
+
+import pytest
+
+from pydpiper.core.arguments import CompoundParser, application_parser, execution_parser, parse
+from pydpiper.execution.pipeline import CmdStage, InputFile, OutputFile, Pipeline
+
+
+@pytest.fixture()
+def options(tmpdir):
+    return parse(CompoundParser([application_parser, execution_parser]),
+                 ["--pipeline-name=test", "--output-dir=%s" % tmpdir, "--no-execute"])
+
+
+@pytest.fixture()
+def out_dir(tmpdir):
+    return str(tmpdir.join("pipeline"))
+
+
+class TestOutputDirectories():
+    def test_not_streamed(self, options, out_dir, tmpdir, monkeypatch):
+        monkeypatch.chdir(str(tmpdir))
+        blurred = os.path.join(out_dir, "blurred", "img_blur.mnc")
+        resampled = os.path.join(out_dir, "resampled", "img.mnc")
+        p = Pipeline([CmdStage(["mincblur", InputFile("/in/img.mnc"), OutputFile(blurred)]),
+                      CmdStage(["mincresample", InputFile(blurred), OutputFile(resampled)])], options)
+        assert {os.path.dirname(blurred), os.path.dirname(resampled)} <= set(p.output_directories())
@@ -0,0 +1,49 @@
+import os
+import threading
+import time
+
+import pytest
+
+from pydpiper.execution.readiness import output_visible, wait_for_outputs
+
+
+@pytest.fixture()
+def out_dir(tmpdir):
+    return str(tmpdir.mkdir("pipeline"))
+
+
+def touch(path, mtime=None):
+    open(path, 'w').close()
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+class TestOutputVisible():
+    def test_stale_output(self, out_dir):
+        f = os.path.join(out_dir, "a.mnc")
+        touch(f, mtime=time.time() - 3600)
+        assert not output_visible(f, since_ns=int(time.time() - 60) * 10**9)
+        assert output_visible(f, since_ns=0)
+
+
+class TestWaitForOutputs():
+    def test_returns_once_visible(self, out_dir):
+        f, g = os.path.join(out_dir, "a.mnc"), os.path.join(out_dir, "b.xfm")
+        touch(f)
+        start = time.time()
+        t = threading.Timer(0.2, touch, args=(g,))
+        t.start()
+        assert wait_for_outputs([f, g], since=start, timeout=30) == []
+        t.join()
+        assert time.time() - start < 5
+
+    def test_stale_outputs_time_out(self, out_dir):
+        f, g = os.path.join(out_dir, "a.mnc"), os.path.join(out_dir, "b.mnc")
+        touch(f, mtime=time.time() - 3600)
+        touch(g)
+        start = time.time()
+        assert wait_for_outputs([f, g, f], since=start - 1, timeout=0.3) == [f]
+        assert 0.3 <= time.time() - start < 5
+
+    def test_no_outputs(self):
+        assert wait_for_outputs([], since=time.time(), timeout=60) == []
@@ -0,0 +1,93 @@
+import os
+import time
+
+import pytest
+
+from pydpiper.execution.restart import (RestartManifest, command_hash, output_record, take_running_stages,
+                                       write_running_stages)
+
+
+@pytest.fixture()
+def outputs(tmpdir):
+    d = tmpdir.mkdir("outputs")
+    files = [str(d.join("out%d.mnc" % i)) for i in range(5)]
+    for f in files:
+        with open(f, 'w') as fh:
+            fh.write("voxels" * 10)
+    return str(d), files
+
+
+@pytest.fixture()
+def manifest(tmpdir, outputs):
+    _, files = outputs
+    m = RestartManifest(str(tmpdir.join("manifest.db")))
+    m.record({ f : output_record(f, with_hash=True) for f in files })
+    m.snapshot_dirs()
+    return m
+
+
+class TestRestartManifest():
+    def test_unchanged(self, manifest, outputs):
+        _, files = outputs
+        stats = manifest.current_stats(files)
+        assert all(stats[f] == (os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in files)
+
+    def test_unchanged_directory_is_trusted(self, manifest, outputs):
+        d, files = outputs
+        dir_mtime = os.stat(d).st_mtime_ns
+        os.utime(files[0], ns=(0, 0))
+        os.utime(d, ns=(dir_mtime, dir_mtime))
+        # the file itself isn't stat-ed, so we see the recorded mtime
+        assert manifest.current_stats(files[:1], trust_dirs=True)[files[0]][1] != 0
+
+    def test_modified_in_place(self, manifest, outputs):
+        d, files = outputs
+        dir_mtime = os.stat(d).st_mtime_ns
+        with open(files[0], 'a') as fh:
+            fh.write("more voxels")
+        os.utime(d, ns=(dir_mtime, dir_mtime))
+        assert manifest.current_stats(files[:1])[files[0]] == (os.stat(files[0]).st_size,
+                                                              os.stat(files[0]).st_mtime_ns)
+
+    def test_deleted_file(self, manifest, outputs):
+        _, files = outputs
+        os.remove(files[1])
+        stats = manifest.current_stats(files)
+        assert stats[files[1]] is None and stats[files[0]] is not None
+
+    def test_missing_directory(self, manifest, tmpdir):
+        f = str(tmpdir.join("nonexistent", "x.mnc"))
+        assert manifest.current_stats([f]) == { f : None }
+
+    def test_touched_but_same_content(self, manifest, outputs):
+        d, files = outputs
+        recorded = manifest.current_stats(files)
+        os.utime(files[2], ns=(10**18, 10**18))
+        with open(os.path.join(d, "new.mnc"), 'w') as fh:  # changes the directory's mtime
+            fh.write("")
+        assert manifest.current_stats(files)[files[2]] == recorded[files[2]]
+
+    def test_modified(self, manifest, outputs):
+        d, files = outputs
+        with open(files[3], 'a') as fh:
+            fh.write("more voxels")
+        with open(os.path.join(d, "new.mnc"), 'w') as fh:
+            fh.write("")
+        assert manifest.current_stats(files)[files[3]][0] == os.stat(files[3]).st_size
+
+
+class TestRunningStages():
+    def test_round_trip(self, tmpdir):
+        f = str(tmpdir.join("running"))
+        hashes = [command_hash(["mincblur", "-fwhm", str(i), "a.mnc", "b"]) for i in range(3)]
+        write_running_stages(f, hashes)
+        taken, written = take_running_stages(f)
+        assert taken == frozenset(hashes) and written <= time.time()
+        assert not os.path.exists(f)
+
+    def test_none_running(self, tmpdir):
+        f = str(tmpdir.join("running"))
+        write_running_stages(f, ["abc"])
+        # a server which shuts down with nothing running removes an earlier record
+        write_running_stages(f, [])
+        assert take_running_stages(f) == (frozenset(), None)
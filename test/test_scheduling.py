@@ -0,0 +1,114 @@
+import threading
+
+import networkx as nx
+import pytest
+
+from pydpiper.execution.scheduling import BackgroundCalls, RunnableQueue, critical_path_priorities
+
+
+@pytest.fixture()
+def q():
+    q = RunnableQueue()
+    for i, (mem, procs) in enumerate([(1.0, 1), (4.0, 1), (1.0, 1), (2.0, 4), (8.0, 1)]):
+        q.add(i, mem=mem, procs=procs)
+    return q
+
+
+class TestRunnableQueue():
+    def test_len_and_membership(self, q):
+        assert len(q) == 5
+        assert 3 in q and 7 not in q
+        assert sorted(q) == [0, 1, 2, 3, 4]
+
+    def test_duplicate_add_ignored(self, q):
+        q.add(0, mem=1.0, procs=1)
+        assert len(q) == 5
+
+    def test_max_mem(self, q):
+        assert q.max_mem() == 8.0
+        assert q.peek_max() == 4
+        assert len(q) == 5
+
+    def test_pop_fitting_respects_memory(self, q):
+        assert q.pop_fitting(mem=3.0, procs=1) in (0, 2)
+        assert 4 in q and 1 in q
+
+    def test_pop_fitting_respects_procs(self, q):
+        assert q.pop_fitting(mem=2.0, procs=4) == 3
+        assert q.pop_fitting(mem=2.0, procs=1) in (0, 2)
+
+    def test_pop_fitting_nothing_fits(self, q):
+        assert q.pop_fitting(mem=0.5, procs=8) is None
+        assert len(q) == 5
+
+    def test_fits(self, q):
+        assert q.fits(mem=1.0, procs=1) and q.fits(mem=2.0, procs=4)
+        assert not q.fits(mem=0.5, procs=8)
+        assert len(q) == 5
+
+    def test_fifo_within_bucket(self, q):
+        assert q.pop_fitting(mem=1.0, procs=1) == 0
+        assert q.pop_fitting(mem=1.0, procs=1) == 2
+
+    def test_pop_drains(self, q):
+        assert sorted(q.pop() for _ in range(5)) == [0, 1, 2, 3, 4]
+        assert q.pop() is None
+        assert q.max_mem() is None and q.peek_max() is None
+
+    def test_remove(self, q):
+        assert q.remove(4) and not q.remove(4)
+        assert 4 not in q and q.max_mem() == 4.0
+        assert q.remove(0)
+        assert q.pop_fitting(mem=1.0, procs=1) == 2
+
+    def test_largest_mems(self, q):
+        assert q.largest_mems(3) == [8.0, 4.0, 2.0]
+        assert q.largest_mems(10) == [8.0, 4.0, 2.0, 1.0, 1.0]
+
+    def test_memory_requirements(self, q):
+        assert q.memory_requirements() == {1.0: 2, 2.0: 1, 4.0: 1, 8.0: 1}
+
+    def test_priority_before_memory(self, q):
+        q.add(5, mem=1.0, procs=1, priority=3.0)
+        q.add(6, mem=0.5, procs=1, priority=7.0)
+        assert q.pop_fitting(mem=10.0, procs=1) == 6
+        assert q.pop_fitting(mem=10.0, procs=1) == 5
+        assert q.pop_fitting(mem=10.0, procs=1) == 4
+
+
+class Stage(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class TestCriticalPathPriorities():
+    def test_long_chain_before_leaves(self):
+        # 0 -> 1 -> 2 is a chain of registrations, 3 and 4 are cheap leaves of 0, 5 is QC
+        G = nx.DiGraph()
+        G.add_nodes_from(range(6))
+        G.add_edges_from([(0, 1), (1, 2), (0, 3), (0, 4), (2, 5)])
+        stages = [Stage(n) for n in ["mincblur", "minctracc", "/usr/bin/minctracc",
+                                     "mincblur", "xfminvert", "mincpik"]]
+        p = critical_path_priorities(G, stages)
+        assert p[2] == 20 and p[1] == 40 and p[0] == 42
+        assert p[1] > p[3] and p[1] > p[4]
+        assert p[5] < min(p[:5])
+
+
+class TestBackgroundCalls():
+    def test_exception_returned(self):
+        calls = BackgroundCalls(threads=1)
+        calls.submit(1, lambda: 1 / 0)
+        assert calls.wait(1, timeout=5)
+        [(key, result, exc)] = calls.completed()
+        assert key == 1 and result is None and isinstance(exc, ZeroDivisionError)
+        assert calls.completed() == []
+
+    def test_slow_call_doesnt_block_others(self):
+        calls = BackgroundCalls(threads=2)
+        stuck = threading.Event()
+        calls.submit("slow", stuck.wait)
+        calls.submit("fast", lambda: "done")
+        assert calls.wait("fast", timeout=5)
+        assert calls.completed() == [("fast", "done", None)]
+        stuck.set()
@@ -0,0 +1,105 @@
+import os
+import subprocess
+
+import pytest
+
+from pydpiper.execution.scratch import ScratchSpace
+
+
+@pytest.fixture()
+def dirs(tmpdir):
+    return str(tmpdir.mkdir("pipeline")), str(tmpdir.mkdir("scratch"))
+
+
+def run(staged):
+    subprocess.check_call(" ".join(staged.cmd), shell=True)
+
+
+def write(path, contents):
+    with open(path, 'w') as f:
+        f.write(contents)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class TestScratchSpace():
+    def test_outputs_copied_back_and_cached(self, dirs):
+        out_dir, root = dirs
+        a, b, c = (os.path.join(out_dir, f) for f in ("a.mnc", "b.mnc", "c.mnc"))
+        write(a, "a")
+        scratch = ScratchSpace(root, max_size=10**6)
+        staged = scratch.stage(["cp", a, b], inputs=[a], outputs=[b])
+        assert staged.cmd[1] == a and staged.cmd[2].startswith(scratch.dir)
+        run(staged)
+        assert not os.path.exists(b)
+        scratch.copy_back(staged)
+        scratch.discard(staged)
+        assert read(b) == "a" and b in scratch.cached
+        # a later stage reads the cached copy
+        staged = scratch.stage(["cp", b, c], inputs=[b], outputs=[c])
+        assert staged.cmd[1].startswith(scratch.dir)
+        run(staged)
+        scratch.copy_back(staged)
+        scratch.discard(staged)
+        assert read(c) == "a"
+        scratch.close()
+        assert not os.path.exists(scratch.dir)
+
+    def test_files_written_next_to_cached_inputs(self, dirs):
+        out_dir, root = dirs
+        xfm, out = os.path.join(out_dir, "nlin.xfm"), os.path.join(out_dir, "resampled.mnc")
+        scratch = ScratchSpace(root, max_size=10**6)
+        # (like a nonlinear registration, which writes the transform's grid next to it)
+        staged = scratch.stage(["sh", "-c", "'echo xfm > %s; echo grid > $(dirname %s)/nlin_grid_0.mnc'" % (xfm, xfm)],
+                               inputs=[], outputs=[xfm])
+        run(staged)
+        scratch.copy_back(staged)
+        scratch.discard(staged)
+        assert read(os.path.join(out_dir, "nlin_grid_0.mnc")) == "grid\n"
+        # the grid is found next to the cached transform
+        staged = scratch.stage(["sh", "-c", "'cat %s $(dirname %s)/nlin_grid_0.mnc > %s'" % (xfm, xfm, out)],
+                               inputs=[xfm], outputs=[out])
+        assert xfm not in " ".join(staged.cmd)
+        run(staged)
+        scratch.copy_back(staged)
+        assert read(out) == "xfm\ngrid\n"
+        # ... unless it's changed in the pipeline directory
+        write(os.path.join(out_dir, "nlin_grid_0.mnc"), "another grid\n")
+        staged = scratch.stage(["cp", xfm, out], inputs=[xfm], outputs=[out])
+        assert xfm in staged.cmd and xfm not in scratch.cached
+
+    def test_changed_inputs_not_used(self, dirs):
+        out_dir, root = dirs
+        a, b = os.path.join(out_dir, "a.mnc"), os.path.join(out_dir, "b.mnc")
+        scratch = ScratchSpace(root, max_size=10**6)
+        staged = scratch.stage(["sh", "-c", "'echo old > %s'" % a], inputs=[], outputs=[a])
+        run(staged)
+        scratch.copy_back(staged)
+        write(a, "new, from another node\n")
+        staged = scratch.stage(["cp", a, b], inputs=[a], outputs=[b])
+        assert staged.cmd[1] == a and a not in scratch.cached and scratch.size == 0
+
+    def test_eviction(self, dirs):
+        out_dir, root = dirs
+        scratch = ScratchSpace(root, max_size=10)
+        outputs = [os.path.join(out_dir, "%d.mnc" % i) for i in range(3)]
+        for o in outputs:
+            staged = scratch.stage(["sh", "-c", "'printf 12345 > %s'" % o], inputs=[], outputs=[o])
+            run(staged)
+            scratch.copy_back(staged)
+            scratch.discard(staged)
+        assert list(scratch.cached) == outputs[1:] and scratch.size == 10
+        assert all(read(o) == "12345" for o in outputs)
+
+    def test_unstageable(self, dirs):
+        out_dir, root = dirs
+        scratch = ScratchSpace(root, max_size=10**6)
+        # (antsRegistration is given an output prefix, not its outputs)
+        assert scratch.stage(["antsRegistration", "--output", "[%s/x]" % out_dir],
+                             inputs=[], outputs=[os.path.join(out_dir, "x.xfm")]) is None
+        # (only a prefix of an argument)
+        assert scratch.stage(["cp", "a", os.path.join(out_dir, "x.mnc.bak")],
+                             inputs=[], outputs=[os.path.join(out_dir, "x.mnc")]) is None
@@ -0,0 +1,72 @@
+import pickle
+
+import pytest
+
+from pydpiper.core.files import FileAtom
+from pydpiper.core.stages import CmdStage, Result, Stages
+
+
+def stage(prog, i, o):
+    return CmdStage(inputs=(FileAtom(i),), outputs=(FileAtom(o),), cmd=[prog, i, o])
+
+
+@pytest.fixture()
+def chain():
+    return [stage("mincblur", "/a.mnc", "/b.mnc"), stage("minctracc", "/b.mnc", "/c.xfm"),
+            stage("mincresample", "/c.xfm", "/d.mnc")]
+
+
+def nested(stages, depth):
+    """`stages` deferred through `depth` levels of procedures."""
+    s = Stages(stages)
+    for _ in range(depth):
+        t = Stages()
+        t.defer(Result(stages=s, output=None))
+        s = t
+    return s
+
+
+class TestCmdStage():
+    def test_equal_commands(self):
+        a, b = stage("mincblur", "/a.mnc", "/b.mnc"), stage("mincblur", "/a.mnc", "/b.mnc")
+        assert a == b and hash(a) == hash(b) and a is not b
+        assert a != stage("mincblur", "/a.mnc", "/c.mnc")
+
+    def test_immutable(self):
+        s = stage("mincblur", "/a.mnc", "/b.mnc")
+        with pytest.raises(AttributeError):
+            s.outputs = (FileAtom("/c.mnc"),)
+        s.to_array().append("-clobber")
+        assert s.to_array() == ["mincblur", "/a.mnc", "/b.mnc"]
+
+
+class TestStages():
+    def test_order_as_added(self, chain):
+        s = Stages()
+        s.add(chain[0])
+        s.defer(Result(stages=nested(chain[1:2], depth=5), output=None))
+        s.add(chain[2])
+        assert list(s) == chain
+
+    def test_duplicates_removed(self, chain):
+        s = Stages()
+        s.defer(Result(stages=nested(chain, depth=3), output=None))
+        s.defer(Result(stages=Stages([stage("mincblur", "/a.mnc", "/b.mnc")]), output=None))
+        s.add(chain[1])
+        assert list(s) == chain and len(s) == 3
+
+    def test_shared_and_self_deferral(self, chain):
+        shared = Stages(chain[:2])
+        s = Stages()
+        s.defer(Result(stages=shared, output=None))
+        s.defer(Result(stages=shared, output=None))
+        # a procedure given an accumulator returns it
+        s.defer(Result(stages=s, output=None))
+        s.add(chain[2])
+        assert list(s) == chain
+
+    def test_set_operations(self, chain):
+        s = nested(chain, depth=2)
+        assert chain[1] in s and stage("mincblur", "/x.mnc", "/y.mnc") not in s
+        assert s[2] == chain[2] and s.index(chain[1]) == 1
+        assert list(pickle.loads(pickle.dumps(s))) == chain
@@ -0,0 +1,121 @@
+import asyncio
+import threading
+
+import pytest
+
+from pydpiper.execution.transport import (AsyncPipelineServer, RemoteError, connect,
+                                          register_class, UNIX_URI_PREFIX)
+
+
+class Info(object):
+    def __init__(self, *, ix, cmd):
+        self.ix = ix
+        self.cmd = cmd
+
+
+register_class("test_transport.Info", Info)
+
+
+class FakePipeline(object):
+    def __init__(self):
+        self.finished = set()
+        self.loops = 0
+        self.shutdown = False
+        self.launching = None
+        self.blocked = threading.Event()
+
+    def setStageFinished(self, ix, clientURI):
+        self.finished.add(ix)
+
+    def getFinished(self):
+        return self.finished
+
+    def getInfo(self, ix):
+        return Info(ix=ix, cmd=["mincblur", str(ix)])
+
+    def fail(self):
+        raise KeyError("no such stage")
+
+    def set_shutdown_ev(self):
+        self.shutdown = True
+
+    def continueLoop(self):
+        return len(self.finished) < 3
+
+    def manageExecutors(self):
+        self.loops += 1
+        if self.launching is not None:
+            # (e.g., submitting executors to the queue)
+            with self.blocking():
+                self.blocked.set()
+                self.launching.wait(10)
+
+
+@pytest.fixture()
+def served(tmpdir):
+    """A fake pipeline served on a Unix socket by an event loop in another thread,
+    and the server's URI"""
+    pipeline = FakePipeline()
+    server = AsyncPipelineServer(pipeline, loop_interval=60)
+    loop = asyncio.new_event_loop()
+    uri = loop.run_until_complete(server.start(path=str(tmpdir.join("server.sock"))))
+    result = {}
+
+    def run():
+        result["flag"] = loop.run_until_complete(server.serve(time_to_live=10))
+    t = threading.Thread(target=run)
+    t.start()
+    yield pipeline, uri, result
+    loop.call_soon_threadsafe(server.stop)
+    t.join()
+    loop.close()
+
+
+class TestAsyncPipelineServer():
+    def test_uri(self, served):
+        _, uri, _ = served
+        assert uri.startswith(UNIX_URI_PREFIX)
+
+    def test_calls_and_serialization(self, served):
+        _, uri, _ = served
+        with connect(uri) as p:
+            p.setStageFinished(4, "fake_client_URI")
+            assert p.getFinished() == [4]
+            info = p.getInfo(7)
+            assert isinstance(info, Info) and info.ix == 7 and info.cmd == ["mincblur", "7"]
+
+    def test_errors_are_raised_remotely_and_connection_survives(self, served):
+        _, uri, _ = served
+        with connect(uri) as p:
+            with pytest.raises(RemoteError):
+                p.fail()
+            with pytest.raises(RemoteError):
+                p.no_such_method()
+            with pytest.raises(AttributeError):
+                p._private
+            assert p.getFinished() == []
+
+    def test_finishing_wakes_management_loop(self, served):
+        pipeline, uri, result = served
+        with connect(uri) as p:
+            for i in range(3):
+                p.setStageFinished(i, "fake_client_URI")
+        # the loop interval is a minute, so the loop only notices promptly if woken
+        for _ in range(100):
+            if pipeline.shutdown:
+                break
+            threading.Event().wait(0.05)
+        assert pipeline.shutdown
+        assert pipeline.loops >= 1
+
+    def test_requests_served_during_slow_management(self, served):
+        pipeline, uri, _ = served
+        pipeline.launching = threading.Event()
+        with connect(uri) as p:
+            # wake the management loop, which then blocks (outside the event loop) until told to go on
+            p.setStageFinished(0, "fake_client_URI")
+            assert pipeline.blocked.wait(5)
+            assert p.getFinished() == [0]
+            p.setStageFinished(1, "fake_client_URI")
+            assert sorted(p.getFinished()) == [0, 1]
+        pipeline.launching.set()
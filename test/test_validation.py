@@ -0,0 +1,53 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from pydpiper.execution import validation
+from pydpiper.execution.validation import find_problems, missing_executables, record_outputs, validate_stages
+
+
+def stage(cmd, outputs, log_file=None):
+    """A stand-in for a (converted) pipeline stage."""
+    return SimpleNamespace(name=cmd[0], cmd=cmd, outputFiles=outputs, logFile=log_file)
+
+
+@pytest.fixture()
+def out_dir(tmpdir):
+    return str(tmpdir.mkdir("pipeline"))
+
+
+class TestFindProblems():
+    def test_no_problems(self, out_dir):
+        stages = [stage(["sh", "a"], [os.path.join(out_dir, "a.mnc")], os.path.join(out_dir, "log", "a.log")),
+                  stage(["true", "b"], [os.path.join(out_dir, "sub", "./b.mnc")])]
+        assert find_problems(stages, out_dir) == []
+
+    def test_relative_outputs(self, out_dir, monkeypatch):
+        monkeypatch.chdir(out_dir)
+        assert find_problems([stage(["sh"], ["x/a.mnc"])], None) == []
+        assert len(find_problems([stage(["sh"], ["../a.mnc"])], None)) == 1
+
+    def test_all_problems_reported(self, out_dir):
+        long_name = os.path.join(out_dir, "x" * 300 + ".mnc")
+        a = stage(["sh", "a"], [long_name, os.path.join(out_dir, "..", "escaped.mnc")])
+        b = stage(["no-such-command-4711", "b"], [os.path.join(out_dir, "b.mnc")], "y" * 300 + ".log")
+        c = stage(["sh", "c"], [os.path.join(out_dir, "b.mnc")])
+        producers = {}
+        problems = find_problems([a, b, c], out_dir, duplicate_outputs=record_outputs(producers, [a, b, c]))
+        assert len(problems) == 5
+        assert "produced by 2 stages: 'no-such-command-4711 b'; 'sh c'" in problems[3]
+        assert problems[4] == "missing executable: no-such-command-4711"
+        with pytest.raises(ValueError, match=r"\(5\)"):
+            validate_stages([a, b, c], out_dir, duplicate_outputs=record_outputs({}, [a, b, c]))
+
+
+class TestMissingExecutables():
+    def test_lookups_memoized(self, monkeypatch):
+        calls = []
+        validation.which.cache_clear()
+        monkeypatch.setattr(validation.shutil, "which", lambda c: calls.append(c) or "/bin/" + c)
+        assert missing_executables(["mincblur", "minctracc", "mincblur"]) == []
+        assert missing_executables(["mincblur"]) == []
+        assert sorted(calls) == ["mincblur", "minctracc"]
+        validation.which.cache_clear()